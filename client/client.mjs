@@ -83,8 +83,20 @@ function readGraphSync(graph_file, files) {
     var line = graph_lines[i].split(' ');
     var name = line[0];
     var nums = []
-    line.slice(1).forEach(strnum => {nums.push(parseInt(strnum, 10))})
-    graph.push({'program': files[name], 'contacts': nums});
+    var task = {'program': files[name], 'contacts': nums};
+    line.slice(1).forEach(strnum => {
+      if (strnum.startsWith('x')) {
+        // Data-parallel vertex, e.g. x4 or x4:hash
+        const [n, partition] = strnum.slice(1).split(':');
+        task['parallelism'] = parseInt(n, 10);
+        if (partition) {
+          task['partition'] = partition;
+        }
+      } else {
+        nums.push(parseInt(strnum, 10));
+      }
+    })
+    graph.push(task);
   }
   return graph;
 }
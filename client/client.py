@@ -18,81 +18,313 @@ import argparse
 import requests
 from multiprocessing import Process
 import asyncio
+import functools
+import hashlib
+import json
+import struct
 
 IP = '127.0.0.1'
 PORT = 8888
 
-def create_payload(graph_file, folder):
+# Record framings of the data stream; see Framer.
+FRAMINGS = ('lines', 'length')
+
+# Length prefix of a record in length framing.
+LENGTH = struct.Struct('>I')
+
+# Bytes read from stdin, or from the socket, at a time.
+READ_SIZE = 1 << 20
+
+# Batches are sent once they reach this many bytes...
+BATCH_BYTES = 1 << 20
+
+# ...or once their oldest record has waited this many seconds.
+BATCH_INTERVAL = 0.05
+
+# Runs of records read ahead of the socket before reading stdin pauses.
+READ_AHEAD = 16
+
+# Directory of the on-disk cache of compiled programs; see ProgramCache.
+CACHE_DIR = '.spit_cache'
+
+class ProgramCache:
+  """
+  On-disk cache of compiled programs (a vertex's .js file behind its prelude),
+  stored under their SHA-256, which is also their program ID on the
+  scheduler. An index maps each file's path, mtime, size, and prelude to the
+  hash, so files that have not changed are neither read nor hashed again.
+  """
+  def __init__(self, path=CACHE_DIR):
+    self.path = path
+    self.index_path = os.path.join(path, 'index.json')
+    try:
+      with open(self.index_path, 'r') as file:
+        self.index = json.load(file)
+    except (OSError, ValueError):
+      self.index = {}
+
+  def compile(self, file_path, prelude):
+    """
+    Returns the program ID of a .js file behind a prelude, compiling it into
+    the cache if it is new or changed.
+    """
+    stat = os.stat(file_path)
+    key = [stat.st_mtime_ns, stat.st_size,
+           hashlib.sha256(prelude.encode()).hexdigest()]
+    entry = self.index.get(os.path.abspath(file_path))
+    if entry is not None and entry[:3] == key and \
+       os.path.exists(self.source_path(entry[3])):
+      return entry[3]
+    with open(file_path, 'r') as js_file:
+      program = prelude + js_file.read()
+    program_id = hashlib.sha256(program.encode()).hexdigest()
+    if not os.path.exists(self.source_path(program_id)):
+      os.makedirs(self.path, exist_ok=True)
+      self.write(self.source_path(program_id), program)
+    self.index[os.path.abspath(file_path)] = key + [program_id]
+    return program_id
+
+  def get(self, program_id):
+    with open(self.source_path(program_id), 'r') as file:
+      return file.read()
+
+  def save(self):
+    os.makedirs(self.path, exist_ok=True)
+    self.write(self.index_path, json.dumps(self.index))
+
+  def source_path(self, program_id):
+    return os.path.join(self.path, program_id + '.js')
+
+  def write(self, path, text):
+    # Written aside and renamed, so a crash never leaves a partial file.
+    with open(path + '.tmp', 'w') as file:
+      file.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def compile_program(file_path, prelude, cache=None):
+  """
+  Returns a vertex's program for /allocate: inline, or by ID if compiled into
+  a cache.
+  """
+  if cache is not None:
+    return {'program_id': cache.compile(file_path, prelude)}
+  with open(file_path, 'r') as js_file:
+    return {'program': prelude + js_file.read()}
+
+
+def submit(scheduler_url, payload, cache=None):
+  """
+  Submits a job to /allocate. Programs given by ID (see compile_program) are
+  uploaded first if the scheduler does not have them. If that fails, say
+  because the scheduler dropped one in the meantime or predates uploads, the
+  job is submitted again with every program inline.
+  """
+  if cache is None:
+    return requests.post(scheduler_url, json=payload)
+  base_url = scheduler_url.rsplit('/', 1)[0]
+  program_ids = sorted(set(task['program_id']
+                           for task in payload['new_tasks']))
+  response = requests.post(base_url + '/programs/missing',
+                           json={'program_ids': program_ids})
+  if response.status_code == 200 and response.json()['missing']:
+    print('Uploading {} of {} programs'.format(
+          len(response.json()['missing']), len(program_ids)), file=sys.stderr)
+    response = requests.post(base_url + '/programs', json={
+      'programs': [cache.get(program_id)
+                   for program_id in response.json()['missing']]})
+  if response.status_code == 200:
+    response = requests.post(scheduler_url, json=payload)
+    if response.status_code == 200:
+      return response
+  new_tasks = []
+  for task in payload['new_tasks']:
+    task = dict(task, program=cache.get(task['program_id']))
+    del task['program_id']
+    new_tasks.append(task)
+  return requests.post(scheduler_url, json=dict(payload, new_tasks=new_tasks))
+
+
+def create_payload(graph_file, folder, cache=None):
   payload = {'new_tasks': []}
+  prelude = 'const PORT = {}\n'.format(PORT) + 'const IP = {}\n'.format(IP)
   with open(graph_file, 'r') as file:
     for line in file:
       items = line.split()
       file_path = os.path.join(folder, items[0])
-      with open(file_path, 'r') as js_file:
-        program_string = js_file.read()
-        program_string_mod = 'const PORT = {}\n'.format(PORT) + \
-                             'const IP = {}\n'.format(IP) + program_string
-        payload['new_tasks'].append({'program': program_string_mod, \
-                                     'contacts':[int(i) for i in items[1:]]})
-        payload['client_id'] = IP + ':' + str(PORT)
+      # Contacts may carry an edge weight for locality placement, e.g. 2:10
+      # A vertex may run as several instances, e.g. x4, splitting its input
+      # round-robin, or x4:hash, routing records by key.
+      parallel = [item[1:].split(':') for item in items[1:] \
+                  if item.startswith('x')]
+      edges = [item.split(':') for item in items[1:] \
+               if not item.startswith('x')]
+      task = compile_program(file_path, prelude, cache)
+      task['contacts'] = [int(edge[0]) for edge in edges]
+      if any(len(edge) > 1 for edge in edges):
+        task['weights'] = [float(edge[1]) if len(edge) > 1 else 1.0 \
+                           for edge in edges]
+      if parallel:
+        task['parallelism'] = int(parallel[0][0])
+        if len(parallel[0]) > 1:
+          task['partition'] = parallel[0][1]
+      payload['new_tasks'].append(task)
+      payload['client_id'] = IP + ':' + str(PORT)
+  if cache is not None:
+    cache.save()
   return payload
 
 
-'''
-def wait_for_answers(ip, port):
-  async def tcp_answer_client():
-      reader, writer = await asyncio.open_connection(
-          ip, port)
-      try:
-        while True:
-          data = await reader.read(10)
-          print(f'Received: {data.decode()!r}')
-      except KeyboardInterrupt:
-        print('Stopped Reading Data')
-        print('Close the connection')
-        writer.close()
-        await writer.wait_closed()
-        pass
-
-  asyncio.run(tcp_answer_client())
-  '''
-
-async def wait_answer(reader):
-  try:
-    while True:
-      data = await reader.read(10)
-      print(f'Received: {data.decode()!r}')
-  except KeyboardInterrupt:
-    print('Stopped Reading Data')
-    print('Close the connection')
-    writer.close()
-    await writer.wait_closed()
-    pass
+class Framer:
+  """
+  Cuts a byte stream into runs of whole records, so batches never split one.
+
+  Framings:
+    lines: Each record ends with a newline.
+    length: Each record is preceded by its length, as a 4-byte big-endian
+      unsigned integer.
+  """
+  def __init__(self, framing='lines'):
+    if framing not in FRAMINGS:
+      raise ValueError(f'unknown framing {framing!r}')
+    self.framing = framing
+    self.tail = b''
+    self.records = 0  # whole records in the last run returned
+
+  def feed(self, data):
+    """
+    Returns the records completed by data, as one bytes object in the same
+    framing. The incomplete record at the end is kept for the next call.
+    """
+    data = self.tail + data if self.tail else data
+    end, self.records = self.boundary(data)
+    self.tail = data[end:]
+    return data[:end]
+
+  def finish(self):
+    """
+    Returns what is left at the end of the stream. A last line may lack its
+    newline; a cut-short length-prefixed record is dropped.
+    """
+    tail, self.tail = self.tail, b''
+    self.records = 1 if tail else 0
+    if self.framing == 'length' and tail:
+      print(f'Dropped {len(tail)} bytes of a truncated record',
+            file=sys.stderr)
+      self.records = 0
+      return b''
+    return tail
+
+  def boundary(self, data):
+    """
+    Returns the end of the last whole record in data, and the number of whole
+    records.
+    """
+    if self.framing == 'lines':
+      return data.rfind(b'\n') + 1, data.count(b'\n')
+    end = n = 0
+    limit = len(data) - LENGTH.size
+    unpack = LENGTH.unpack_from
+    while end <= limit:
+      size = end + LENGTH.size + unpack(data, end)[0]
+      if size > len(data):
+        break
+      end = size
+      n += 1
+    return end, n
+
 
-async def stream_data(writer):
+async def read_input(queue, framer, stdin):
+  """
+  Reads stdin in large chunks on a thread, and queues runs of whole records.
+  The queue is bounded, so reading pauses while the socket is backed up.
+  """
+  loop = asyncio.get_running_loop()
+  while True:
+    chunk = await loop.run_in_executor(None, stdin.read1, READ_SIZE)
+    run = framer.feed(chunk) if chunk else framer.finish()
+    if run:
+      await queue.put((run, framer.records))
+    if not chunk:
+      await queue.put(None)
+      return
+
+
+async def stream_data(writer, framing='lines', stdin=None):
+  """
+  Streams records from stdin to the writer in batches. A batch is flushed
+  once it reaches BATCH_BYTES or its oldest record has waited BATCH_INTERVAL
+  seconds, and each flush waits for the socket to drain.
+  """
+  loop = asyncio.get_running_loop()
+  framer = Framer(framing)
+  queue = asyncio.Queue(READ_AHEAD)
+  reader = asyncio.ensure_future(read_input(
+    queue, framer, stdin or sys.stdin.buffer))
+  batch, size, deadline = [], 0, None
+  n_records = n_bytes = n_batches = 0
   try:
-    buff = ''
     while True:
-        buff = sys.stdin.read(1)
-        if buff == '':
-          break
-        print(f'Send: {buff!r}')
-        await writer.write(buff.encode())
+      timeout = None if deadline is None else max(deadline - loop.time(), 0)
+      try:
+        item = await asyncio.wait_for(queue.get(), timeout)
+      except asyncio.TimeoutError:
+        item = ()  # the batch is due
+      if item:
+        run, records = item
+        if not batch:
+          deadline = loop.time() + BATCH_INTERVAL
+        batch.append(run)
+        size += len(run)
+        n_records += records
+      if batch and (not item or size >= BATCH_BYTES):
+        writer.writelines(batch)
         await writer.drain()
-  except KeyboardInterrupt:
-    print("Close the connection stop streaming")
-    writer.close()
+        n_bytes += size
+        n_batches += 1
+        batch, size, deadline = [], 0, None
+      if item is None:
+        break
+    if writer.can_write_eof():
+      writer.write_eof()
+    print(f'Sent {n_records} records ({n_bytes} bytes) in {n_batches} '
+          'batches', file=sys.stderr)
+  finally:
+    reader.cancel()
+
 
-async def handle_streaming(reader, writer):
-  await stream_data(writer)
-  await wait_answer(reader)
+async def wait_answer(reader, framing='lines', stdout=None):
+  """
+  Copies results from the reader to stdout as whole records, until the
+  connection closes.
+  """
+  framer = Framer(framing)
+  stdout = stdout or sys.stdout.buffer
+  while True:
+    data = await reader.read(READ_SIZE)
+    run = framer.feed(data) if data else framer.finish()
+    if run:
+      stdout.write(run)
+      stdout.flush()
+    if not data:
+      return
+
+
+async def handle_streaming(reader, writer, framing='lines'):
+  # Results are consumed while input is still being sent, so a pipeline that
+  # produces output early never stalls on a full socket buffer.
+  try:
+    await asyncio.gather(stream_data(writer, framing),
+                         wait_answer(reader, framing))
+  finally:
+    writer.close()
 
-async def stream():
+async def stream(framing='lines'):
     server = await asyncio.start_server(
-        handle_streaming, IP, PORT)
+        functools.partial(handle_streaming, framing=framing), IP, PORT)
 
     addr = server.sockets[0].getsockname()
-    print(f'Serving on {addr}')
+    print(f'Serving on {addr}', file=sys.stderr)
 
     async with server:
         await server.serve_forever()
@@ -106,6 +338,15 @@ if __name__ == '__main__':
                                 default='graph_file.txt')
   parser.add_argument("--scheduler_url", type=str, help="scheduler address",\
                                       default="http://127.0.0.1:5000/allocate")
+  parser.add_argument("--placement", type=str, help="greedy or locality",\
+                                     default="greedy")
+  parser.add_argument("--framing", type=str, choices=FRAMINGS,\
+                      help="newline-delimited or length-prefixed records",\
+                      default="lines")
+  parser.add_argument("--cache", type=str,\
+                      help="directory of compiled programs, so only changed"\
+                           " programs are uploaded; empty to send them all",\
+                      default=CACHE_DIR)
   FLAGS = parser.parse_args()
   folder = FLAGS.folder
   #num_workers = FLAGS.workers
@@ -113,20 +354,23 @@ if __name__ == '__main__':
   scheduler_url = FLAGS.scheduler_url
 
   #making request payload
-  payload = create_payload(graph_file, folder)
-  print(payload)
-  response = requests.post(scheduler_url, json=payload)
+  cache = ProgramCache(FLAGS.cache) if FLAGS.cache else None
+  payload = create_payload(graph_file, folder, cache)
+  payload['placement'] = FLAGS.placement
+  print(payload, file=sys.stderr)
+  response = submit(scheduler_url, payload, cache)
   if response.status_code != 200:
-    print('Failure Error Code: {}'.format(response.status_code))
-    print('Exiting please try again')
+    print('Failure Error Code: {}'.format(response.status_code),
+          file=sys.stderr)
+    print('Exiting please try again', file=sys.stderr)
     exit(1)
 
   #successful response start client and server to start streaming data and
   #waiting for answers.
   info = response.json()
-  print(info)
+  print(info, file=sys.stderr)
   #ip_port = info['task_pointers'][-1]['worker_address']
   #end_ip = ip_port.split(':')[0]
   #end_port = int(ip_port.split(':')[1])
   #p = Process(target=wait_for_answers, args=(end_ip, end_port))
-  asyncio.run(stream())
+  asyncio.run(stream(FLAGS.framing))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Client Tester
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import client
+
+class ClientTest(unittest.TestCase):
+  def test_framer_lines(self):
+    framer = client.Framer('lines')
+    self.assertEqual(framer.feed(b'a\nb'), b'a\n')
+    self.assertEqual(framer.records, 1)
+    self.assertEqual(framer.feed(b'c'), b'')
+    self.assertEqual(framer.feed(b'\nd\ne'), b'bc\nd\n')
+    self.assertEqual(framer.records, 2)
+    self.assertEqual(framer.finish(), b'e')
+    self.assertEqual(framer.records, 1)
+
+  def test_framer_length(self):
+    framer = client.Framer('length')
+    record = struct.pack('>I', 3) + b'abc'
+    self.assertEqual(framer.feed(record + record[:2]), record)
+    self.assertEqual(framer.feed(record[2:5]), b'')
+    self.assertEqual(framer.feed(record[5:] + record), record + record)
+    self.assertEqual(framer.records, 2)
+    framer.feed(record[:5])
+    self.assertEqual(framer.finish(), b'')
+
+  def test_program_cache(self):
+    folder = tempfile.mkdtemp()
+    for name in ['a.js', 'b.js']:
+      with open(os.path.join(folder, name), 'w') as file:
+        file.write(name)
+    graph = os.path.join(folder, 'graph.txt')
+    with open(graph, 'w') as file:
+      file.write('a.js 1\nb.js x2:hash\n')
+    cache_dir = os.path.join(folder, 'cache')
+    payload = client.create_payload(graph, folder,
+                                    client.ProgramCache(cache_dir))
+    prelude = 'const PORT = {}\nconst IP = {}\n'.format(client.PORT,
+                                                        client.IP)
+    a, b = [hashlib.sha256((prelude + name).encode()).hexdigest()
+            for name in ['a.js', 'b.js']]
+    self.assertEqual(payload['new_tasks'], [
+      {'program_id': a, 'contacts': [1]},
+      {'program_id': b, 'contacts': [], 'parallelism': 2,
+       'partition': 'hash'},
+    ])
+
+    # Unchanged files are served from the cache; changed ones are compiled
+    # again.
+    cache = client.ProgramCache(cache_dir)
+    self.assertEqual(cache.get(a), prelude + 'a.js')
+    os.remove(os.path.join(folder, 'b.js'))
+    self.assertEqual(cache.compile(os.path.join(folder, 'a.js'), prelude), a)
+    with open(os.path.join(folder, 'a.js'), 'w') as file:
+      file.write('changed!')
+    changed = cache.compile(os.path.join(folder, 'a.js'), prelude)
+    self.assertEqual(cache.get(changed), prelude + 'changed!')
+
+  def test_stream(self):
+    # Input goes out and results come back over one connection at once.
+    data = b''.join(b'record %d\n' % i for i in range(100000)) + b'last'
+    stdout = io.BytesIO()
+
+    async def echo(reader, writer):
+      while True:
+        chunk = await reader.read(1 << 16)
+        if not chunk:
+          break
+        writer.write(chunk)
+        await writer.drain()
+      writer.close()
+
+    async def run():
+      server = await asyncio.start_server(echo, '127.0.0.1', 0)
+      port = server.sockets[0].getsockname()[1]
+      reader, writer = await asyncio.open_connection('127.0.0.1', port)
+      stdin = io.BufferedReader(io.BytesIO(data))
+      await asyncio.gather(client.stream_data(writer, 'lines', stdin),
+                           client.wait_answer(reader, 'lines', stdout))
+      writer.close()
+      server.close()
+      await server.wait_closed()
+
+    asyncio.run(run())
+    self.assertEqual(stdout.getvalue(), data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,15 +15,99 @@ import os
 import sys
 import time
 import argparse
+import json
 import requests
+import wire
+from client import CACHE_DIR, compile_program, Framer, ProgramCache, \
+                   READ_SIZE, submit
+from collections import deque
 from flask import abort, Flask, jsonify, request, Response, send_from_directory
 from flask_cors import CORS
+from threading import Condition, Lock, Thread
 
 app: Flask = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-EOF'])
 IP = '131.179.7.201'
 PORT = 5000
 
+# Records returned by /source when the request does not say, and at most.
+DEFAULT_BATCH = 1000
+MAX_BATCH = 10000
+
+# Seconds /source waits for records when the request does not say, and at
+# most.
+DEFAULT_WAIT = 10.0
+MAX_WAIT = 30.0
+
+# Records read ahead of /source before reading stdin pauses.
+MAX_BUFFERED = 100000
+
+# Records returned by the old /send endpoint.
+SEND_BATCH = 100
+
+class Source:
+  """
+  Reads newline-delimited records from stdin on a background thread, started
+  by the first request for them, and hands them out in batches.
+  """
+  def __init__(self, stdin, max_buffered=MAX_BUFFERED):
+    self.stdin = stdin
+    self.max_buffered = max_buffered
+    self.records = deque()
+    self.eof = False
+    self.started = False
+    self.cond = Condition()
+
+  def run(self):
+    framer = Framer('lines')
+    while True:
+      chunk = self.stdin.read1(READ_SIZE)
+      text = (framer.feed(chunk) if chunk else framer.finish()) \
+        .decode('utf-8', 'replace')
+      records = text.split('\n')
+      if records[-1] == '':
+        records.pop()  # after the last newline
+      with self.cond:
+        while len(self.records) >= self.max_buffered:
+          self.cond.wait()
+        self.records.extend(records)
+        self.eof = not chunk
+        self.cond.notify_all()
+      if not chunk:
+        return
+
+  def take(self, n, wait):
+    """
+    Waits until records are read, input ends, or the wait is over.
+
+    Args:
+      n (int): Most records to return.
+      wait (float): Most seconds to wait.
+
+    Returns:
+      (Tuple[List[str], bool]): Records, and whether input has ended and
+        every record has been returned.
+    """
+    deadline = time.monotonic() + wait
+    with self.cond:
+      if not self.started:
+        self.started = True
+        Thread(target=self.run, daemon=True).start()
+      while not self.records and not self.eof:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        self.cond.wait(remaining)
+      records = [self.records.popleft()
+                 for _ in range(min(n, len(self.records)))]
+      self.cond.notify_all()
+      return records, self.eof and not self.records
+
+
+# Input records, and a lock serializing output records.
+source = Source(sys.stdin.buffer)
+output_lock = Lock()
+
 @app.route('/')
 def root() -> Response:
   return jsonify('hello')
@@ -36,26 +120,124 @@ def receive():
 
 @app.route('/send')
 def send():
-  buf = sys.stdin.buffer.read(100)
-  buff = buf.decode('utf-8', 'ignore')
+  records, _ = source.take(SEND_BATCH, 0)
+  buff = ''.join(record + '\n' for record in records)
   app.logger.info(f'Send: {buff!r}')
   return jsonify({
     'data': buff,
   })
 
-def create_payload(graph_file, folder):
+@app.route('/source')
+def source_batch() -> Response:
+  """
+  Long-polls for a batch of input records.
+
+  Args (GET):
+    max (int): Most records to return. Defaults to DEFAULT_BATCH.
+    wait (float): Seconds to wait for records. Defaults to DEFAULT_WAIT.
+    format (str): 'json' (default) or 'binary'. A binary response is one
+      batch in the format of wire.py, of numbers if every record is one and
+      of strings otherwise, with eof in the X-EOF header.
+
+  Returns (JSON):
+    records (List[str]): Records, without their newlines. Empty if none were
+      read in time.
+    eof (bool): Whether input has ended and every record has been returned.
+  """
+  try:
+    n = min(int(request.args.get('max', DEFAULT_BATCH)), MAX_BATCH)
+    wait = min(float(request.args.get('wait', DEFAULT_WAIT)), MAX_WAIT)
+  except ValueError:
+    abort(400)
+  records, eof = source.take(max(n, 1), max(wait, 0))
+  if request.args.get('format') == 'binary':
+    return Response(wire.encode(numeric(records)), mimetype=wire.MIMETYPE,
+                    headers={'X-EOF': str(int(eof))})
+  return jsonify({
+    'records': records,
+    'eof': eof,
+  })
+
+@app.route('/sink', methods=['POST'])
+def sink() -> Response:
+  """
+  Writes a batch of output records to stdout, one per line.
+
+  Args (JSON):
+    records (List[Any]): Records. Strings are written as is, whole numbers
+      without a decimal point, and anything else as JSON. A bare array of
+      records is accepted too. Alternatively, the body may be one batch in
+      the format of wire.py, sent as application/octet-stream.
+
+  Returns (JSON):
+    received (int): Number of records written.
+  """
+  if request.mimetype == wire.MIMETYPE:
+    try:
+      records, _ = wire.decode(request.get_data())
+    except ValueError:
+      abort(400)
+  else:
+    req = request.get_json(force=True)
+    records = req.get('records') if isinstance(req, dict) else req
+    if not isinstance(records, list):
+      abort(400)
+  lines = ''.join(line(record) for record in records)
+  with output_lock:
+    sys.stdout.write(lines)
+    sys.stdout.flush()
+  return jsonify({
+    'received': len(records),
+  })
+
+def numeric(records):
+  """
+  Returns the records as floats if every one is a number, else as they are.
+  """
+  try:
+    return [float(record) for record in records]
+  except ValueError:
+    return records
+
+def line(record):
+  """
+  Returns an output record as a line of text.
+  """
+  if isinstance(record, str):
+    return record + '\n'
+  if isinstance(record, float) and record.is_integer():
+    return str(int(record)) + '\n'
+  return json.dumps(record) + '\n'
+
+def create_payload(graph_file, folder, encoding='json', cache=None):
   payload = {'new_tasks': []}
+  prelude = 'const PORT = "{}"\n'.format(PORT) + \
+            'const IP = "{}"\n'.format(IP) + \
+            'const WIRE = "{}"\n'.format(encoding)
   with open(graph_file, 'r') as file:
     for line in file:
       items = line.split()
       file_path = os.path.join(folder, items[0])
-      with open(file_path, 'r') as js_file:
-        program_string = js_file.read()
-        program_string_mod = 'const PORT = "{}"\n'.format(PORT) + \
-                             'const IP = "{}"\n'.format(IP) + program_string
-        payload['new_tasks'].append({'program': program_string_mod, \
-                                     'contacts':[int(i) for i in items[1:]]})
-        payload['client_id'] = IP + ':' + str(PORT)
+      # Contacts may carry an edge weight for locality placement, e.g. 2:10
+      # A vertex may run as several instances, e.g. x4, splitting its input
+      # round-robin, or x4:hash, routing records by key.
+      parallel = [item[1:].split(':') for item in items[1:] \
+                  if item.startswith('x')]
+      edges = [item.split(':') for item in items[1:] \
+               if not item.startswith('x')]
+      task = compile_program(file_path, prelude, cache)
+      task['contacts'] = [int(edge[0]) for edge in edges]
+      if any(len(edge) > 1 for edge in edges):
+        task['weights'] = [float(edge[1]) if len(edge) > 1 else 1.0 \
+                           for edge in edges]
+      if parallel:
+        task['parallelism'] = int(parallel[0][0])
+        if len(parallel[0]) > 1:
+          task['partition'] = parallel[0][1]
+      payload['new_tasks'].append(task)
+      payload['client_id'] = IP + ':' + str(PORT)
+  if cache is not None:
+    cache.save()
   return payload
 '''
 @app.before_first_request
@@ -77,7 +259,7 @@ def before_first_request_func():
 
     #making request payload
     payload = create_payload(graph_file, folder)
-    print(payload)
+    print(payload, file=sys.stderr)
     response = requests.post(scheduler_url, json=payload)
     if response.status_code != 200:
       print('Failure Error Code: {}'.format(response.status_code))
@@ -93,6 +275,14 @@ parser.add_argument("--graph", type=str, help="graph_file",\
                               default='graph_file.txt')
 parser.add_argument("--scheduler_url", type=str, help="scheduler address",\
                                     default="http://131.179.8.99:5000/allocate")
+parser.add_argument("--placement", type=str, help="greedy or locality",\
+                                   default="greedy")
+parser.add_argument("--wire", type=str, choices=('json', 'binary'),\
+                    help="encoding of the job's data", default="json")
+parser.add_argument("--cache", type=str,\
+                    help="directory of compiled programs, so only changed"\
+                         " programs are uploaded; empty to send them all",\
+                    default=CACHE_DIR)
 parser.add_argument("--host", type=str)
 parser.add_argument("run", type=str)
 FLAGS = parser.parse_args()
@@ -102,11 +292,15 @@ graph_file = FLAGS.graph
 scheduler_url = FLAGS.scheduler_url
 
 #making request payload
-payload = create_payload(graph_file, folder)
-print(payload)
-response = requests.post(scheduler_url, json=payload)
+cache = ProgramCache(FLAGS.cache) if FLAGS.cache else None
+payload = create_payload(graph_file, folder, FLAGS.wire, cache)
+payload['placement'] = FLAGS.placement
+payload['wire'] = FLAGS.wire
+print(payload, file=sys.stderr)
+response = submit(scheduler_url, payload, cache)
 if response.status_code != 200:
-  print('Failure Error Code: {}'.format(response.status_code))
-  print('Exiting please try again')
+  print('Failure Error Code: {}'.format(response.status_code),
+        file=sys.stderr)
+  print('Exiting please try again', file=sys.stderr)
   exit(1)
 #app.run(host=IP, port= PORT)
@@ -0,0 +1,25 @@
+
+
+// Returns output records to the client's /sink endpoint, one request per batch
+// of messages delivered to this vertex. Jobs with a binary wire send batches
+// in the format of worker/wire.js.
+
+const url = 'http://' + IP + ':' + PORT;
+const BINARY = typeof WIRE !== 'undefined' && WIRE === 'binary';
+
+if (BINARY) {
+  importScripts('../wire.js');
+}
+
+onmessage = function(e) {
+  fetch(url + '/sink', {
+    'method': 'POST',
+    'headers': {
+      'content-type': BINARY ? 'application/octet-stream' : 'application/json'
+    },
+    'body': BINARY ? Wire.encodeBatch(e.data) :
+                     JSON.stringify({'records': e.data})
+  }).catch(function(error) {
+    console.error(error);
+  });
+}
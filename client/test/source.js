@@ -0,0 +1,46 @@
+
+
+// Streams input records from the client's /source endpoint. Each request
+// long-polls for up to a whole batch, so input moves as fast as the client can
+// read it rather than once per poll interval. Jobs with a binary wire fetch
+// batches in the format of worker/wire.js, so numbers arrive without parsing.
+
+const url = 'http://' + IP + ':' + PORT;
+const BINARY = typeof WIRE !== 'undefined' && WIRE === 'binary';
+const BATCH = 1000;
+const WAIT_S = 10;
+const RETRY_MS = 1000;
+
+if (BINARY) {
+  importScripts('../wire.js');
+}
+
+async function fetchBatch() {
+  const query = '/source?max=' + BATCH + '&wait=' + WAIT_S;
+  if (BINARY) {
+    const res = await fetch(url + query + '&format=binary');
+    const bytes = new Uint8Array(await res.arrayBuffer());
+    return [Wire.decodeBatch(bytes)[0], res.headers.get('X-EOF') === '1'];
+  }
+  const json = await (await fetch(url + query)).json();
+  return [json['records'], json['eof']];
+}
+
+async function pump() {
+  while (true) {
+    try {
+      const [records, eof] = await fetchBatch();
+      for (const record of records) {
+        self.postMessage(record);
+      }
+      if (eof) {
+        return;
+      }
+    } catch (error) {
+      console.error(error);
+      await new Promise(resolve => setTimeout(resolve, RETRY_MS));
+    }
+  }
+}
+
+pump();
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Client: Binary Batch Format
+
+Encodes lists of records the way worker/wire.js does, so that a job allocated
+with 'wire': 'binary' can exchange data with the client without JSON. See
+worker/wire.js for the layout.
+"""
+
+from array import array
+import json
+import struct
+import sys
+
+# Batch kinds.
+TEXT = 0
+FLOAT64 = 1
+JSON = 2
+
+# Batch header: kind, padding, number of records.
+HEADER = struct.Struct('<B3xI')
+
+# Length of a record in a TEXT batch, or of the array in a JSON batch.
+LENGTH = struct.Struct('<I')
+
+# Content type of binary batches over HTTP.
+MIMETYPE = 'application/octet-stream'
+
+def padding(n):
+  return b'\0' * (-n % 8)
+
+
+def little_endian(values):
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+
+def encode(records):
+  """
+  Args:
+    records (List[Any]): Records. A FLOAT64 batch is written if they are all
+      numbers, a TEXT batch if they are all strings, and a JSON batch
+      otherwise.
+
+  Returns:
+    (bytes): The batch.
+  """
+  if all(isinstance(record, (int, float)) and not isinstance(record, bool)
+         for record in records):
+    kind = FLOAT64
+    body = little_endian(array('d', records)).tobytes()
+  elif all(isinstance(record, str) for record in records):
+    kind = TEXT
+    strings = [record.encode('utf-8') for record in records]
+    lengths = little_endian(array('I', map(len, strings)))
+    body = lengths.tobytes() + b''.join(strings)
+  else:
+    kind = JSON
+    text = json.dumps(records, separators=(',', ':')).encode('utf-8')
+    body = LENGTH.pack(len(text)) + text
+  return HEADER.pack(kind, len(records)) + body + padding(len(body))
+
+
+def decode(data, offset=0):
+  """
+  Args:
+    data (bytes): Batches laid end to end.
+    offset (int): Where the batch to decode starts.
+
+  Returns:
+    (Tuple[List[Any], int]): The batch's records, and the offset just past
+      it. FLOAT64 records are floats.
+
+  Raises:
+    ValueError: If the batch is malformed.
+  """
+  try:
+    kind, count = HEADER.unpack_from(data, offset)
+    start = offset + HEADER.size
+    if kind == FLOAT64:
+      end = start + 8 * count
+      values = array('d')
+      values.frombytes(data[start:end])
+      records = little_endian(values).tolist()
+    elif kind == TEXT:
+      lengths = array('I')
+      lengths.frombytes(data[start:start + 4 * count])
+      end = start + 4 * count
+      records = []
+      for length in little_endian(lengths):
+        records.append(data[end:end + length].decode('utf-8'))
+        end += length
+    elif kind == JSON:
+      end = start + LENGTH.size + LENGTH.unpack_from(data, start)[0]
+      records = json.loads(data[start + LENGTH.size:end].decode('utf-8'))
+    else:
+      raise ValueError(f'unknown batch kind {kind}')
+  except struct.error as e:
+    raise ValueError(e)
+  if len(records) != count or end > len(data):
+    raise ValueError('truncated batch')
+  return records, end + -end % 8
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Client: Binary Batch Format Tester
+"""
+
+import unittest
+
+import wire
+
+class WireTest(unittest.TestCase):
+  def test_round_trip(self):
+    batches = [[1.5, 2, -3e10], ['a', 'héllo', ''], [1, 'x', None], []]
+    data = b''.join(wire.encode(records) for records in batches)
+    offset = 0
+    for records in batches:
+      decoded, offset = wire.decode(data, offset)
+      self.assertEqual(decoded, records)
+      self.assertEqual(offset % 8, 0)
+    self.assertEqual(offset, len(data))
+
+  def test_layout(self):
+    self.assertEqual(wire.encode([1.0]),
+                     b'\x01\0\0\0\x01\0\0\0' + b'\0' * 6 + b'\xf0\x3f')
+    self.assertEqual(wire.encode(['ab']),
+                     b'\0\0\0\0\x01\0\0\0\x02\0\0\0ab\0\0')
+
+  def test_truncated(self):
+    data = wire.encode(['abc', 'def'])
+    for end in (4, 12, 17):
+      with self.assertRaises(ValueError):
+        wire.decode(data[:end])
+
+
+if __name__ == '__main__':
+  unittest.main()
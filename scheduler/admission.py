@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Admission Queue
+"""
+
+from itertools import accumulate
+from task import PARTITIONS, WIRES
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Times the oldest waiting job may be passed over by smaller jobs that fit
+# before nothing may pass it any more.
+MAX_BYPASS: int = 16
+
+# Longest /allocation may be held open waiting for a queued job.
+MAX_WAIT: float = 30.0
+
+class Submission:
+  """
+  A job as submitted to /allocate.
+
+  Attributes:
+    client_id (str): ID of client.
+    sources (List[str]): Program source of each vertex.
+    contacts (List[List[int]]): Contacts of each vertex, by vertex index.
+    weights (List[Optional[List[float]]]): Traffic on each vertex's contact
+      edges, if given.
+    parallelism (List[int]): Number of instances of each vertex.
+    partitions (List[str]): How each vertex's input is split among its
+      instances; see PARTITIONS.
+    placement (str): Placement policy, 'greedy' or 'locality'.
+    wire (str): Encoding of data sent between the job's tasks.
+    queue (bool): Whether to queue the job if it does not fit yet.
+    bypassed (int): Times a later job was admitted while this one waited.
+  """
+  __slots__ = ('client_id', 'sources', 'contacts', 'weights', 'parallelism',
+               'partitions', 'placement', 'wire', 'queue', 'bypassed')
+
+  def __init__(self, req: Dict[str, Any],
+               lookup: Optional[Callable[[str], str]] = None):
+    """
+    Args:
+      req (Dict[str, Any]): Job, as given to /allocate.
+      lookup (Optional[Callable[[str], str]]): Source of a stored program by
+        ID, for vertices that give a 'program_id' instead of a 'program'.
+
+    Raises:
+      KeyError: If a required key is missing, or a program given by ID is not
+        stored.
+      TypeError, ValueError: If the job is malformed.
+    """
+    self.client_id: str = str(req['client_id'])
+    new_tasks: List[Dict[str, Any]] = list(req['new_tasks'])
+    self.sources: List[str] = \
+      [str(task['program']) if 'program' in task or lookup is None else
+       lookup(str(task['program_id'])) for task in new_tasks]
+    self.contacts: List[List[int]] = \
+      [[int(contact) for contact in task['contacts']] for task in new_tasks]
+    self.weights: List[Optional[List[float]]] = \
+      [None if task.get('weights') is None else
+       [float(weight) for weight in task['weights']] for task in new_tasks]
+    self.parallelism: List[int] = \
+      [int(task.get('parallelism', 1)) for task in new_tasks]
+    self.partitions: List[str] = \
+      [task.get('partition', 'round_robin') for task in new_tasks]
+    self.placement: str = req.get('placement', 'greedy')
+    self.wire: str = req.get('wire', 'json')
+    self.queue: bool = bool(req.get('queue', False))
+    self.bypassed: int = 0
+    if self.placement not in ('greedy', 'locality') or \
+       self.wire not in WIRES or \
+       any(not 0 <= contact < len(new_tasks)
+           for contacts in self.contacts for contact in contacts) or \
+       any(weights is not None and len(weights) != len(contacts)
+           for weights, contacts in zip(self.weights, self.contacts)) or \
+       any(n < 1 for n in self.parallelism) or \
+       any(mode not in PARTITIONS for mode in self.partitions):
+      raise ValueError('malformed job')
+
+  def __len__(self) -> int:
+    return sum(self.parallelism)
+
+  def vertices(self) -> List[int]:
+    """
+    Returns:
+      (List[int]): Vertex of each of the job's tasks. A data-parallel vertex
+        has a task for each instance, numbered consecutively.
+    """
+    return [vertex for vertex, n in enumerate(self.parallelism)
+            for _ in range(n)]
+
+  def expand(self) -> Tuple[List[List[int]], List[Optional[List[float]]]]:
+    """
+    Returns:
+      (Tuple[List[List[int]], List[Optional[List[float]]]]): Contacts of each
+        of the job's tasks, by task index, and the traffic on each contact
+        edge, if given. A task contacts every instance of the vertices its
+        vertex contacts, and the instances share each edge's traffic.
+    """
+    first: List[int] = [0, *accumulate(self.parallelism)]
+    contacts: List[List[int]] = []
+    weights: List[Optional[List[float]]] = []
+    for vertex in self.vertices():
+      contacts.append([first[contact] + i for contact in self.contacts[vertex]
+                       for i in range(self.parallelism[contact])])
+      weights.append(None if self.weights[vertex] is None else
+                     [weight / self.parallelism[contact]
+                      for contact, weight in zip(self.contacts[vertex],
+                                                 self.weights[vertex])
+                      for _ in range(self.parallelism[contact])])
+    return contacts, weights
+
+  def partition(self, vertex: int) -> Optional[List[List[Any]]]:
+    """
+    Args:
+      vertex (int): Index of vertex.
+
+    Returns:
+      (Optional[List[List[Any]]]): How the vertex's tasks split their output
+        among their contacts, as given by expand(); see Task.partition. None
+        if none of the vertex's contacts is data-parallel.
+    """
+    if all(self.parallelism[contact] == 1
+           for contact in self.contacts[vertex]):
+      return None
+    return [[self.partitions[contact], self.parallelism[contact]]
+            for contact in self.contacts[vertex]]
+
+  def to_json(self) -> Dict[str, Any]:
+    """
+    Returns:
+      (Dict[str, Any]): The job, as it would be given to /allocate.
+    """
+    new_tasks: List[Dict[str, Any]] = []
+    for vertex, source in enumerate(self.sources):
+      new_task: Dict[str, Any] = {
+        'program': source,
+        'contacts': self.contacts[vertex],
+      }
+      if self.weights[vertex] is not None:
+        new_task['weights'] = self.weights[vertex]
+      if self.parallelism[vertex] != 1:
+        new_task['parallelism'] = self.parallelism[vertex]
+        new_task['partition'] = self.partitions[vertex]
+      new_tasks.append(new_task)
+    return {
+      'client_id': self.client_id,
+      'new_tasks': new_tasks,
+      'placement': self.placement,
+      'wire': self.wire,
+      'queue': self.queue,
+    }
+
+
+class AdmissionQueue:
+  """
+  Jobs waiting for enough free cores, in submission order, one per client.
+
+  Jobs are admitted in order as cores free up. If the oldest job does not fit
+  yet, later jobs that do are admitted ahead of it (backfilling), but only
+  MAX_BYPASS times; after that, nothing passes it until it is admitted, so a
+  large job cannot be starved by a stream of small ones.
+
+  Attributes:
+    jobs (Dict[str, Submission]): Waiting jobs by client ID, oldest first.
+    admitting (Lock): Held by whoever is admitting jobs, so that concurrent
+      attempts do not race for the same cores.
+    changed (Optional[Callable[[str, Optional[Submission]], None]]): Called
+      with a client ID and its newly queued job, or None once the job leaves
+      the queue, under the queue's lock.
+  """
+  def __init__(self, max_bypass: int = MAX_BYPASS):
+    self.max_bypass: int = max_bypass
+    self.jobs: Dict[str, Submission] = {}
+    self.min_size: int = 0
+    self.lock: Lock = Lock()
+    self.admitting: Lock = Lock()
+    self.changed: Optional[Callable[[str, Optional[Submission]], None]] = None
+
+  def __len__(self) -> int:
+    return len(self.jobs)
+
+  def __contains__(self, client_id: str) -> bool:
+    return client_id in self.jobs
+
+  def push(self, job: Submission) -> int:
+    """
+    Queues a job behind every other, replacing any job the client already had
+    queued.
+
+    Args:
+      job (Submission): Job.
+
+    Returns:
+      (int): Number of jobs ahead of it.
+    """
+    with self.lock:
+      self.jobs.pop(job.client_id, None)
+      self.jobs[job.client_id] = job
+      self.min_size = min(len(queued) for queued in self.jobs.values())
+      if self.changed is not None:
+        self.changed(job.client_id, job)
+      return len(self.jobs) - 1
+
+  def remove(self, client_id: str,
+             job: Optional[Submission] = None) -> Optional[Submission]:
+    """
+    Args:
+      client_id (str): ID of client.
+      job (Optional[Submission]): If given, only remove the client's queued
+        job if it is still this one.
+
+    Returns:
+      (Optional[Submission]): The client's queued job, if any, now removed.
+    """
+    with self.lock:
+      if job is not None and self.jobs.get(client_id) is not job:
+        return None
+      job = self.jobs.pop(client_id, None)
+      if job is None:
+        return None
+      self.min_size = min((len(queued) for queued in self.jobs.values()),
+                          default=0)
+      if self.changed is not None:
+        self.changed(client_id, None)
+      return job
+
+  def position(self, client_id: str) -> int:
+    """
+    Returns:
+      (int): Number of jobs ahead of the client's job.
+
+    Raises:
+      ValueError: If the client has no job queued.
+    """
+    with self.lock:
+      return list(self.jobs).index(client_id)
+
+  def waiting(self) -> List[Submission]:
+    """
+    Returns:
+      (List[Submission]): Queued jobs, oldest first.
+    """
+    with self.lock:
+      return list(self.jobs.values())
+
+  def blocked(self) -> bool:
+    """
+    Returns:
+      (bool): Whether the oldest job has been passed over as often as it may
+        be, so no other job may be admitted ahead of it.
+    """
+    with self.lock:
+      head: Optional[Submission] = next(iter(self.jobs.values()), None)
+      return head is not None and head.bypassed >= self.max_bypass
+
+  def bypass(self):
+    """
+    Records that a job was admitted ahead of the oldest queued job.
+    """
+    with self.lock:
+      head: Optional[Submission] = next(iter(self.jobs.values()), None)
+      if head is not None:
+        head.bypassed += 1
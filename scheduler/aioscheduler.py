@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Asynchronous Server
+
+Serves the scheduler's routes from an asyncio event loop, so that workers can
+hold long-polling heartbeats open. Tasks queued by /allocate or by a worker's
+deregistration are pushed to waiting workers as soon as they are queued,
+instead of on their next heartbeat. Clients can likewise hold /allocation open
+until their queued job is admitted.
+
+Usage: python aioscheduler.py [--host HOST] [--port PORT] [--state-dir DIR]
+                              [--rebalance] [--phi-suspect PHI]
+                              [--phi-expire PHI] [--max-heartbeat-rate RATE]
+"""
+
+from aiohttp import web
+from admission import MAX_WAIT as MAX_ALLOCATION_WAIT
+from scheduler import admissions, admit, admitted, app, heartbeat_response, \
+                      observe, open_journal, pacer, reaper, rebalancer, \
+                      REQUEST_DURATION, reclaim, status, subscriptions, \
+                      workers
+from task import TIMEOUT, Worker
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+
+# Longest a heartbeat may be held open. The reaper counts a held worker as
+# seen until the response is sent (see Reaper.hold()), so the wait is not
+# bounded by how soon phi accrual expires silent workers.
+MAX_WAIT: float = TIMEOUT / 2
+
+def dispatch_sync(path: str, method: str, headers: List[Tuple[str, str]],
+                  body: bytes) -> Tuple[bytes, int, Dict[str, str]]:
+  """
+  Runs a request through the Flask app on the calling thread.
+
+  Returns:
+    (Tuple[bytes, int, Dict[str, str]]): Flask's response body, status, and
+      headers, less Content-Length.
+  """
+  with app.test_request_context(path, method=method, headers=headers,
+                                data=body):
+    res = app.full_dispatch_request()
+  return res.get_data(), res.status_code, \
+    {key: value for key, value in res.headers.items()
+     if key.lower() != 'content-length'}
+
+
+async def forward(request: web.Request, body: bytes) -> web.Response:
+  """
+  Runs a request through the Flask app on the loop's executor. Handlers wait
+  on worker locks (see reserve() in scheduler.py), which must not stall the
+  held long polls sharing the loop.
+
+  Args:
+    request (web.Request): Incoming request.
+    body (bytes): Request body.
+
+  Returns:
+    (web.Response): Flask's response.
+  """
+  data, status, headers = await asyncio.get_running_loop().run_in_executor(
+    None, dispatch_sync, request.path_qs, request.method,
+    list(request.headers.items()), body)
+  return web.Response(body=data, status=status, headers=headers)
+
+
+async def heartbeat(request: web.Request) -> web.Response:
+  """
+  Processes a heartbeat from a worker, like /heartbeat in scheduler.py, and
+  additionally supports long polling on delta heartbeats. Only the time spent
+  processing heartbeats, not waiting for tasks, counts towards the heartbeat
+  latency metric.
+
+  Args (JSON):
+    wait (float): Seconds to hold the request open if there are no new tasks
+      for the worker. Optional; at most MAX_WAIT.
+
+  Returns (JSON):
+    See /heartbeat in scheduler.py.
+  """
+  body: bytes = await request.read()
+  try:
+    req: Dict[str, Any] = json.loads(body)
+    wait: float = min(float(req.get('wait', 0)), MAX_WAIT)
+    if 'active_tasks' in req or wait <= 0:
+      return await forward(request, body)
+    worker_id: str = req['worker_id']
+    finished: List[str] = req.get('finished', [])
+    ack: int = int(req.get('ack', 0))
+    metrics: Optional[Dict[str, Dict[str, float]]] = req.get('metrics')
+  except (ValueError, TypeError):
+    raise web.HTTPBadRequest()
+  except KeyError:
+    raise web.HTTPNotFound()
+
+  loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+  deadline: float = loop.time() + wait
+  woken: asyncio.Event = asyncio.Event()
+  try:
+    with subscriptions.subscribe(
+        worker_id, lambda: loop.call_soon_threadsafe(woken.set)):
+      while True:
+        worker: Worker = workers.get(worker_id)
+        if worker is None:
+          reaper.late(worker_id)
+          raise web.HTTPNotFound()
+        woken.clear()
+        seq, new_tasks, patches = await loop.run_in_executor(
+          None, poll, worker, finished, ack, metrics)
+        finished, ack, metrics = [], seq, None
+        if new_tasks or patches or loop.time() >= deadline:
+          break
+        # The worker is not silent while we hold its heartbeat.
+        reaper.hold(worker_id)
+        try:
+          await asyncio.wait_for(woken.wait(), deadline - loop.time())
+        except asyncio.TimeoutError:
+          break
+  finally:
+    reaper.release(worker_id)
+  await loop.run_in_executor(None, reclaim, worker_id)
+
+  return web.json_response(
+    heartbeat_response(worker, new_tasks, patches, seq),
+    headers={'Access-Control-Allow-Origin': '*'})
+
+
+def poll(worker: Worker, finished: List[str], ack: int,
+         metrics: Optional[Dict[str, Dict[str, float]]]
+         ) -> Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]:
+  """
+  Processes one delta heartbeat of a long poll, then admits queued jobs. Runs
+  on the loop's executor, since both wait on worker locks.
+
+  Returns:
+    (Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]): See
+      Worker.heartbeat_delta().
+  """
+  start: float = perf_counter()
+  observe(worker, metrics)
+  res: Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]] = \
+    worker.heartbeat_delta(finished, ack, metrics)
+  admit()
+  REQUEST_DURATION['heartbeat'].observe(perf_counter() - start)
+  return res
+
+
+async def allocation(request: web.Request) -> web.Response:
+  """
+  Gets the allocation for a client, like /allocation in scheduler.py, but
+  waits for a queued job on the event loop instead of blocking it.
+
+  Returns (JSON):
+    See /allocation in scheduler.py.
+  """
+  try:
+    client_id: str = request.query['client_id']
+    wait: float = min(float(request.query.get('wait', 0)),
+                      MAX_ALLOCATION_WAIT)
+  except ValueError:
+    raise web.HTTPBadRequest()
+  except KeyError:
+    raise web.HTTPNotFound()
+
+  if wait > 0 and client_id in admissions:
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    woken: asyncio.Event = asyncio.Event()
+    with admitted.subscribe(client_id,
+                            lambda: loop.call_soon_threadsafe(woken.set)):
+      if client_id in admissions:
+        try:
+          await asyncio.wait_for(woken.wait(), wait)
+        except asyncio.TimeoutError:
+          pass
+  try:
+    return web.json_response(status(client_id),
+                             headers={'Access-Control-Allow-Origin': '*'})
+  except KeyError:
+    raise web.HTTPNotFound()
+
+
+async def dispatch(request: web.Request) -> web.Response:
+  return await forward(request, await request.read())
+
+
+def make_app() -> web.Application:
+  """
+  Returns:
+    (web.Application): The scheduler's routes, served from asyncio.
+  """
+  aioapp: web.Application = web.Application()
+  aioapp.router.add_post('/heartbeat', heartbeat)
+  aioapp.router.add_get('/allocation', allocation)
+  aioapp.router.add_route('*', '/{path:.*}', dispatch)
+  return aioapp
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', type=str, default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=5000)
+  parser.add_argument('--state-dir', type=str,
+                      help='persist scheduler state in this directory')
+  parser.add_argument('--rebalance', action='store_true',
+                      help='move tasks off overloaded workers')
+  parser.add_argument('--phi-suspect', type=float, default=reaper.phi_suspect,
+                      help='suspicion level at which workers are suspected')
+  parser.add_argument('--phi-expire', type=float, default=reaper.phi_expire,
+                      help='suspicion level at which workers are expired '
+                           'before the timeout (inf to disable)')
+  parser.add_argument('--max-heartbeat-rate', type=float,
+                      default=pacer.max_rate,
+                      help='heartbeats per second the whole fleet may send')
+  FLAGS = parser.parse_args()
+  reaper.configure(FLAGS.phi_suspect, FLAGS.phi_expire)
+  pacer.max_rate = FLAGS.max_heartbeat_rate
+  if FLAGS.state_dir:
+    open_journal(FLAGS.state_dir)
+  if FLAGS.rebalance:
+    rebalancer.start()
+  web.run_app(make_app(), host=FLAGS.host, port=FLAGS.port,
+              backlog=4096)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Asynchronous Server Tester
+"""
+
+from aiohttp.test_utils import TestClient, TestServer
+from aioscheduler import make_app
+from scheduler import admitted, reaper, reset, subscriptions, workers
+from task import TIMEOUT
+import asyncio
+import json
+import time
+import unittest
+
+class AsyncSchedulerTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.client = TestClient(TestServer(make_app()))
+    await self.client.start_server()
+
+  async def asyncTearDown(self):
+    await self.client.close()
+    reset()
+
+  async def post(self, path, data):
+    res = await self.client.post(path, data=json.dumps(data))
+    self.assertEqual(res.status, 200)
+    return await res.json()
+
+  async def test_long_poll_push(self):
+    res = await self.post('/register', {
+      "worker_id": "immortal0",
+      "n_cores": 1
+    })
+    self.assertEqual(res["worker_id"], "immortal0")
+
+    # An idle long poll times out empty.
+    start = time.monotonic()
+    res = await self.post('/heartbeat', {
+      "worker_id": "immortal0",
+      "ack": 0,
+      "wait": 0.2
+    })
+    self.assertEqual(res, {"seq": 1, "new_tasks": [], "interval": 10.0})
+    self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    # A waiting worker gets its task as soon as it is allocated.
+    poll = asyncio.ensure_future(self.post('/heartbeat', {
+      "worker_id": "immortal0",
+      "ack": 1,
+      "wait": 10
+    }))
+    while not len(subscriptions):
+      await asyncio.sleep(0.01)
+    start = time.monotonic()
+    await self.post('/allocate', {
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}]
+    })
+    res = await poll
+    self.assertLess(time.monotonic() - start, 1)
+    self.assertEqual([task["task_id"] for task in res["new_tasks"]],
+                     ["client1~0~immortal0"])
+    self.assertEqual(len(subscriptions), 0)
+
+    # /allocation answers at once when nothing is queued.
+    res = await self.client.get('/allocation?client_id=client1&wait=10')
+    self.assertEqual(await res.json(), {"task_ids": ["client1~0~immortal0"]})
+
+    # Other routes are served through the Flask app.
+    res = await self.client.options('/heartbeat', headers={
+      "Origin": "http://example.com",
+      "Access-Control-Request-Method": "POST"
+    })
+    self.assertIn("Access-Control-Allow-Origin", res.headers)
+
+  async def test_held_poll_is_not_silence(self):
+    now = [1000.0]
+    clock = reaper.clock
+    reaper.clock = lambda: now[0]
+    reaper.tick = reaper.to_tick(now[0])
+    try:
+      await self.post('/register', {
+        "worker_id": "worker0",
+        "n_cores": 1
+      })
+      # Heartbeats that come back at once teach the reaper to expect the
+      # worker again soon after each response.
+      for ack in range(3):
+        now[0] += 1
+        await self.post('/heartbeat', {
+          "worker_id": "worker0",
+          "ack": ack
+        })
+      expire_after = reaper.arrivals["worker0"].after(reaper.z_expire)
+      self.assertLess(expire_after, TIMEOUT)
+
+      # A poll held past the phi deadline does not expire the worker.
+      poll = asyncio.ensure_future(self.post('/heartbeat', {
+        "worker_id": "worker0",
+        "ack": 3,
+        "wait": 0.5
+      }))
+      while not len(subscriptions):
+        await asyncio.sleep(0.01)
+      now[0] += TIMEOUT
+      self.assertEqual(reaper.reap(now[0]), [])
+      await poll
+
+      # Silence counts from when the held response was sent.
+      self.assertEqual(reaper.reap(now[0] + 1), [])
+      self.assertEqual(reaper.reap(now[0] + expire_after + 1), ["worker0"])
+    finally:
+      reaper.clock = clock
+
+  async def test_locked_worker_does_not_stall_loop(self):
+    await self.post('/register', {"worker_id": "immortal0", "n_cores": 1})
+
+    # /allocate waits on the worker's lock without holding up other requests.
+    lock = workers["immortal0"].heartbeat_lock
+    lock.acquire()
+    try:
+      allocate = asyncio.ensure_future(self.post('/allocate', {
+        "client_id": "client1",
+        "new_tasks": [{"program": "p", "contacts": []}]
+      }))
+      await asyncio.sleep(0.1)
+      start = time.monotonic()
+      res = await self.client.get('/allocation?client_id=client2')
+      self.assertEqual(res.status, 404)
+      self.assertLess(time.monotonic() - start, 0.5)
+      self.assertFalse(allocate.done())
+    finally:
+      lock.release()
+    res = await asyncio.wait_for(allocate, 5)
+    self.assertEqual(res["task_ids"], ["client1~0~immortal0"])
+
+  async def test_allocation_long_poll(self):
+    await self.post('/register', {
+      "worker_id": "immortal0",
+      "n_cores": 1
+    })
+    res = await self.post('/allocate', {
+      "client_id": "client1",
+      "queue": True,
+      "new_tasks": [{"program": "p", "contacts": []}] * 2
+    })
+    self.assertEqual(res["position"], 0)
+
+    # The client's long poll returns as soon as its job is admitted.
+    poll = asyncio.ensure_future(
+      self.client.get('/allocation?client_id=client1&wait=10'))
+    while not len(admitted):
+      await asyncio.sleep(0.01)
+    start = time.monotonic()
+    await self.post('/register', {
+      "worker_id": "immortal1",
+      "n_cores": 1
+    })
+    res = await (await poll).json()
+    self.assertLess(time.monotonic() - start, 1)
+    self.assertEqual(len(res["task_ids"]), 2)
+    self.assertEqual(len(admitted), 0)
+    res = await self.client.get('/allocation?client_id=client2')
+    self.assertEqual(res.status, 404)
+
+
+if __name__ == '__main__':
+  unittest.main()
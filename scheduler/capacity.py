@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Free-Capacity Index
+"""
+
+from heapq import heappop, heappush
+from itertools import count
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Load scores are bucketed into levels this many per unit of load, so that
+# small differences in load do not outweigh free cores.
+LOAD_LEVELS: int = 4
+
+class CapacityIndex:
+  """
+  Indexes workers by their load and number of free cores so that allocation
+  does not have to scan (or lock) the whole cluster.
+
+  Workers are kept in a heap ordered by load level first (see LOAD_LEVELS),
+  then by most free cores. Ties go to the worker whose availability was
+  recorded earliest. Stale heap entries are skipped lazily when popped.
+
+  The index lock is a leaf lock: callers may hold a worker's heartbeat_lock
+  while updating the index, but the index never calls back into workers.
+
+  Attributes:
+    free (int): Total free cores of the indexed workers.
+  """
+  def __init__(self):
+    self.heap: List[Tuple[int, int, int, str]] = []
+    self.entries: Dict[str, Tuple[int, int, int, str]] = {}
+    self.counter: Iterator[int] = count()
+    self.lock: Lock = Lock()
+    self.free: int = 0
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def __contains__(self, worker_id: str) -> bool:
+    return worker_id in self.entries
+
+  def update(self, worker_id: str, free: int, load: float = 0.0):
+    """
+    Records a worker's current number of free cores and load. Workers without
+    free cores are dropped from the index until they report capacity again.
+
+    Args:
+      worker_id (str): ID of worker.
+      free (int): Number of free cores on the worker.
+      load (float): Worker's smoothed load score; 0 when idle.
+    """
+    with self.lock:
+      self.drop(worker_id)
+      if free <= 0:
+        return
+      entry: Tuple[int, int, int, str] = \
+        (int(load * LOAD_LEVELS), -free, next(self.counter), worker_id)
+      self.entries[worker_id] = entry
+      self.free += free
+      heappush(self.heap, entry)
+      if len(self.heap) > 2 * len(self.entries) + 64:
+        self.heap = list(self.entries.values())
+        self.heap.sort()
+
+  def remove(self, worker_id: str):
+    """
+    Drops a worker from the index.
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    with self.lock:
+      self.drop(worker_id)
+
+  def drop(self, worker_id: str):
+    entry: Optional[Tuple[int, int, int, str]] = \
+      self.entries.pop(worker_id, None)
+    if entry is not None:
+      self.free += entry[1]
+
+  def pop(self) -> Optional[str]:
+    """
+    Removes and returns the least-loaded worker with the most free cores. The
+    caller owns the worker until it records the worker's availability again
+    via update().
+
+    Returns:
+      (Optional[str]): ID of worker, or None if no worker has free cores.
+    """
+    with self.lock:
+      while self.heap:
+        entry: Tuple[int, int, int, str] = heappop(self.heap)
+        if self.entries.get(entry[3]) is entry:
+          self.drop(entry[3])
+          return entry[3]
+      return None
@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Coordinator
+
+Fronts several scheduler shards (see shard.py), so that scheduling is not
+limited to one core. Workers register here and are assigned a shard by worker
+ID; from then on they heartbeat their shard directly. Clients allocate jobs
+here, and the coordinator places each job over cores held on as many shards
+as it takes, preferring the shards with the most free cores. Shards report
+here when losing workers moves or cancels tasks of a job that spans shards,
+and the coordinator passes that on to the job's other shards.
+
+Usage:
+  python coordinator.py [--shards N] [--host HOST] [--port PORT]
+                        [--state-dir DIR]
+  python coordinator.py --shard-urls URL [URL ...] [--host HOST] [--port PORT]
+"""
+
+from admission import Submission
+from flask import abort, Flask, jsonify, redirect, request, Response, \
+                  send_from_directory
+from flask_cors import CORS
+from metrics import Histogram, render
+from programs import ProgramStore
+from telemetry import summarize
+from threading import local, Lock
+from typing import Any, Dict, List, Optional, Set, Tuple
+import argparse
+import atexit
+import os
+import placement
+import requests
+import signal
+import subprocess
+import sys
+import traceback
+import uuid
+import zlib
+
+# Seconds to wait on a shard.
+SHARD_TIMEOUT: float = 10.0
+
+app: Flask = Flask(__name__)
+CORS(app)
+
+# Shard URLs, as reached from the coordinator.
+shards: List[str] = []
+
+# Ports of shards started by this coordinator, which browsers reach on the
+# coordinator's host. None for shards given by URL.
+shard_ports: List[Optional[int]] = []
+
+# Cores last reported free on each shard.
+free: List[int] = []
+
+# Job tracker maps client peer ID to the shards holding part of its job.
+jobs: Dict[str, Set[int]] = {}
+jobs_lock: Lock = Lock()
+
+# Program store, so that browsers can fetch programs from the coordinator.
+programs: ProgramStore = ProgramStore()
+
+# Program ID's of each client's job, to release when the job is replaced.
+job_programs: Dict[str, List[str]] = {}
+
+# HTTP sessions to the shards, one per thread.
+sessions: local = local()
+
+REQUEST_DURATION: Dict[str, Histogram] = {
+  handler: Histogram('coordinator_request_duration_seconds',
+                     'Time spent handling requests.', {'handler': handler})
+  for handler in ('allocate', 'register')
+}
+
+@app.route('/')
+def root() -> Response:
+  """
+  Returns the state of every shard, merged. Takes the same arguments as / in
+  scheduler.py.
+  """
+  state: Dict[str, Dict[str, Any]] = {'clients': {}, 'workers': {}}
+  for shard in range(len(shards)):
+    part: Dict[str, Any] = call(shard, 'GET', '/?' +
+                                request.query_string.decode())
+    for client_id, tasks in part['clients'].items():
+      state['clients'].setdefault(client_id, []).extend(tasks)
+    state['workers'].update(part['workers'])
+  for tasks in state['clients'].values():
+    tasks.sort(key=lambda task: task['vertex_id'])
+  return jsonify(state)
+
+
+@app.route('/metrics')
+def metrics() -> Response:
+  """
+  Returns coordinator metrics in the Prometheus text format. Each shard
+  exports its own at its /metrics.
+  """
+  return Response(render(),
+                  content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/worker/program/<program_id>')
+def program(program_id) -> Response:
+  """
+  Returns a client-submitted program by content hash. Programs requested by
+  task ID are redirected to the shard running the task.
+
+  Args (URL):
+    program_id (str): Program's ID, or a task's ID:
+      {client_id}~{vertex_id}~{worker_id}.
+  """
+  if '~' in program_id:
+    worker_id: str = program_id.split('~')[-1]
+    return redirect(public_url(shard_of(worker_id)) + request.path)
+  try:
+    res: Response = Response(programs.get(program_id),
+                             mimetype='text/javascript')
+  except KeyError:
+    abort(404)
+  res.set_etag(program_id)
+  res.cache_control.public = True
+  res.cache_control.max_age = 31536000
+  res.cache_control.immutable = True
+  return res.make_conditional(request)
+
+
+@app.route('/programs', methods=['POST'])
+def upload() -> Response:
+  """
+  Stores programs for jobs to refer to by ID. Takes the same arguments and
+  returns the same results as /programs in scheduler.py.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    return jsonify({
+      'program_ids': [programs.add(str(source))
+                      for source in req['programs']],
+    })
+  except TypeError:
+    abort(400)
+  except KeyError:
+    abort(404)
+
+
+@app.route('/programs/missing', methods=['POST'])
+def missing_programs() -> Response:
+  """
+  Finds which programs need to be uploaded. Takes the same arguments and
+  returns the same results as /programs/missing in scheduler.py.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    return jsonify({
+      'missing': programs.missing([str(program_id)
+                                   for program_id in req['program_ids']]),
+    })
+  except TypeError:
+    abort(400)
+  except KeyError:
+    abort(404)
+
+
+@app.route('/worker/<path:path>')
+def send_js(path):
+  """
+  Serves static worker files.
+
+  Args (URL):
+    path (str): Path to static file.
+  """
+  return send_from_directory('../worker/', path)
+
+
+@app.route('/register', methods=['POST'])
+@REQUEST_DURATION['register'].time
+def register() -> Response:
+  """
+  Registers a worker with its shard.
+
+  Args (JSON):
+    worker_id (str): Optional ID of worker. Generated if not given.
+    n_cores (int): Number of cores on the worker.
+
+  Returns (JSON):
+    success (bool): Whether registration succeeded.
+    worker_id (str): ID of worker.
+    scheduler (str): URL of the worker's shard, to send heartbeats to.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  worker_id: str = req.get('worker_id') or uuid.uuid1().hex
+  shard: int = shard_of(worker_id)
+  res: requests.Response = session().post(
+    shards[shard] + '/register', json=dict(req, worker_id=worker_id),
+    timeout=SHARD_TIMEOUT)
+  if res.status_code != 200:
+    abort(res.status_code)
+  return jsonify(dict(res.json(), scheduler=public_url(shard)))
+
+
+@app.route('/allocate', methods=['POST'])
+@REQUEST_DURATION['allocate'].time
+def allocate() -> Response:
+  """
+  Allocates workers for a new job, across shards if need be. Takes the same
+  arguments and returns the same results as /allocate in scheduler.py, except
+  that jobs are not queued and only one job is taken at a time: 'queue' and
+  'jobs' are a 400 rather than being ignored. A job that does not fit gets no
+  tasks, and the client retries.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    if 'jobs' in req or req.get('queue'):
+      abort(400)
+    job: Submission = Submission(req, programs.get)
+  except (AttributeError, TypeError, ValueError):
+    abort(400)
+  except KeyError:
+    abort(404)
+  client_id: str = job.client_id
+
+  # Hold cores on the shards with the most free cores until the job fits.
+  holds: List[Tuple[int, str, List[Tuple[str, int]]]] = hold(len(job), set())
+  bins: List[Tuple[int, str]] = [(shard, worker_id)
+                                 for shard, _, slots in holds
+                                 for worker_id, _ in slots]
+  capacities: List[int] = [n for _, _, slots in holds for _, n in slots]
+
+  # Place the job over the held cores.
+  task_ids: List[str] = []
+  parts: Dict[int, List[List[Any]]] = {}
+  stored: Dict[str, str] = {}
+  cut: int = 0
+  if sum(capacities) >= len(job):
+    contacts, weights = job.expand()
+    if job.placement == 'locality':
+      assignment: List[int] = placement.locality(contacts, capacities,
+                                                 weights)
+    else:
+      assignment: List[int] = placement.greedy(len(job), capacities)
+    task_ids = [f'{client_id}~{vertex_id}~{bins[assignment[vertex_id]][1]}'
+                for vertex_id in range(len(job))]
+    for vertex_id, vertex in enumerate(job.vertices()):
+      program_id: str = programs.put(job.sources[vertex])
+      stored[program_id] = job.sources[vertex]
+      parts.setdefault(bins[assignment[vertex_id]][0], []).append([
+        task_ids[vertex_id], program_id,
+        [task_ids[contact_id] for contact_id in contacts[vertex_id]],
+        False, False, None, job.wire, job.partition(vertex)])
+    cut = placement.cut_edges(contacts, assignment)
+  for program_id in job_programs.pop(client_id, []):
+    programs.release(program_id)
+  job_programs[client_id] = \
+    [part[1] for tasks in parts.values() for part in tasks]
+
+  # Hand each shard its part. Shards that held the client's previous job are
+  # told to drop it. Unused holds are aborted.
+  with jobs_lock:
+    old: Set[int] = jobs.get(client_id, set())
+    jobs[client_id] = set(parts)
+  held: Dict[int, str] = {shard: hold_id for shard, hold_id, _ in holds}
+  try:
+    for shard in sorted(set(parts) | old):
+      commit(shard, held.get(shard), client_id, True, parts.get(shard, []),
+             stored)
+  except requests.RequestException:
+    traceback.print_exc()
+    for shard in parts:
+      try_call(shard, '/shard/cancel', {'client_id': client_id})
+    task_ids, cut = [], 0
+  finally:
+    for shard, hold_id in held.items():
+      try_call(shard, '/shard/abort', {'hold_id': hold_id})
+
+  return jsonify({
+    'task_ids': task_ids,
+    'cut_edges': cut,
+  })
+
+
+@app.route('/allocation')
+def allocation() -> Response:
+  """
+  Gets the allocation for a client, gathered from its shards.
+
+  Args (GET):
+    client_id (str): ID of client.
+
+  Returns (JSON):
+    task_ids (List[str]): Task ID's for each allocation, in the same order as
+      the original input. Empty if not enough resources.
+  """
+  client_id: str = str(request.args.get('client_id'))
+  with jobs_lock:
+    if client_id not in jobs:
+      abort(404)
+    holders: List[int] = sorted(jobs[client_id])
+  task_ids: List[str] = []
+  for shard in holders:
+    task_ids += call(shard, 'GET',
+                     f'/allocation?client_id={client_id}')['task_ids']
+  task_ids.sort(key=lambda task_id: int(task_id.split('~')[1]))
+  return jsonify({
+    'task_ids': task_ids,
+  })
+
+
+@app.route('/jobs/<client_id>/stats')
+def job_stats(client_id) -> Response:
+  """
+  Gets a job's stream telemetry, gathered from its shards.
+
+  Args (URL):
+    client_id (str): ID of client.
+
+  Returns (JSON):
+    See /jobs/<client_id>/stats in scheduler.py.
+  """
+  with jobs_lock:
+    if client_id not in jobs:
+      abort(404)
+    holders: List[int] = sorted(jobs[client_id])
+  vertices: List[Dict[str, Any]] = []
+  for shard in holders:
+    vertices += call(shard, 'GET', f'/jobs/{client_id}/stats')['vertices']
+  return jsonify(summarize(vertices))
+
+
+@app.route('/coordinator/orphans', methods=['POST'])
+def orphans() -> Response:
+  """
+  Places tasks that a shard could not reallocate after losing workers on the
+  other shards.
+
+  Args (JSON):
+    shard (int): Index of the reporting shard.
+    client_id (str): ID of client.
+    tasks (List[List[Any]]): Tasks, as given by Task.to_record().
+    programs (Dict[str, str]): Source of each program the tasks run.
+
+  Returns (JSON):
+    moves (Dict[str, str]): Maps old task ID's to new ones. 409 if the tasks
+      do not fit.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  origin, client_id, tasks = req['shard'], req['client_id'], req['tasks']
+  holds: List[Tuple[int, str, List[Tuple[str, int]]]] = \
+    hold(len(tasks), {origin})
+  held: Dict[int, str] = {shard: hold_id for shard, hold_id, _ in holds}
+  try:
+    slots: List[Tuple[int, str]] = [(shard, worker_id)
+                                    for shard, _, worker_slots in holds
+                                    for worker_id, n in worker_slots
+                                    for _ in range(n)]
+    if len(slots) < len(tasks):
+      abort(409)
+    moves: Dict[str, str] = {}
+    parts: Dict[int, List[List[Any]]] = {}
+    for task, (shard, worker_id) in zip(tasks, slots):
+      old: str = task[0]
+      _, vertex_id, _ = old.split('~')
+      moves[old] = f'{client_id}~{vertex_id}~{worker_id}'
+      parts.setdefault(shard, []).append(
+        [moves[old]] + task[1:5] + [old] + task[6:])
+    with jobs_lock:
+      jobs.setdefault(client_id, set()).update(parts)
+    try:
+      for shard, part in parts.items():
+        commit(shard, held[shard], client_id, False, part, req['programs'])
+    except requests.RequestException:
+      traceback.print_exc()
+      abort(409)
+    return jsonify({'moves': moves})
+  finally:
+    for shard, hold_id in held.items():
+      try_call(shard, '/shard/abort', {'hold_id': hold_id})
+
+
+@app.route('/coordinator/moved', methods=['POST'])
+def moved() -> Response:
+  """
+  Passes tasks moved by one shard on to the job's other shards.
+
+  Args (JSON):
+    shard (int): Index of the reporting shard.
+    client_id (str): ID of client.
+    moves (Dict[str, str]): Maps old task ID's to new ones.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  for shard in holders(req['client_id'], req['shard']):
+    try_call(shard, '/shard/rewire', {
+      'client_id': req['client_id'],
+      'moves': req['moves'],
+    })
+  return jsonify({'success': True})
+
+
+@app.route('/coordinator/cancelled', methods=['POST'])
+def cancelled() -> Response:
+  """
+  Cancels the rest of a job that one shard cancelled.
+
+  Args (JSON):
+    shard (int): Index of the reporting shard.
+    client_id (str): ID of client.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  for shard in holders(req['client_id'], req['shard']):
+    try_call(shard, '/shard/cancel', {'client_id': req['client_id']})
+  with jobs_lock:
+    jobs[req['client_id']] = set()
+  return jsonify({'success': True})
+
+
+def shard_of(worker_id: str) -> int:
+  """
+  Args:
+    worker_id (str): ID of worker.
+
+  Returns:
+    (int): Index of the shard that owns the worker.
+  """
+  return zlib.crc32(worker_id.encode()) % len(shards)
+
+
+def public_url(shard: int) -> str:
+  """
+  Args:
+    shard (int): Index of shard.
+
+  Returns:
+    (str): Shard's URL, as reached by the browser making this request.
+  """
+  if shard_ports[shard] is None:
+    return shards[shard]
+  return f'{request.scheme}://{request.host.rsplit(":", 1)[0]}:' \
+         f'{shard_ports[shard]}'
+
+
+def holders(client_id: str, origin: int) -> List[int]:
+  """
+  Args:
+    client_id (str): ID of client.
+    origin (int): Index of a shard to leave out.
+
+  Returns:
+    (List[int]): Other shards holding part of the client's job.
+  """
+  with jobs_lock:
+    return sorted(jobs.get(client_id, set()) - {origin})
+
+
+def hold(n_slots: int, exclude: Set[int]) \
+    -> List[Tuple[int, str, List[Tuple[str, int]]]]:
+  """
+  Holds cores on the shards with the most free cores until enough are held or
+  every shard was asked.
+
+  Args:
+    n_slots (int): Number of cores wanted.
+    exclude (Set[int]): Shards to leave out.
+
+  Returns:
+    (List[Tuple[int, str, List[Tuple[str, int]]]]): Shard, hold ID, and the
+      cores held per worker, for each shard holding cores.
+  """
+  holds: List[Tuple[int, str, List[Tuple[str, int]]]] = []
+  for shard in sorted(range(len(shards)), key=lambda shard: -free[shard]):
+    if n_slots <= 0:
+      break
+    if shard in exclude:
+      continue
+    res: Optional[Dict[str, Any]] = \
+      try_call(shard, '/shard/reserve', {'n_slots': n_slots})
+    if res is None:
+      continue
+    free[shard] = res['free']
+    if res['hold_id'] is not None:
+      holds.append((shard, res['hold_id'], res['slots']))
+      n_slots -= sum(n for _, n in res['slots'])
+  return holds
+
+
+def commit(shard: int, hold_id: Optional[str], client_id: str, replace: bool,
+           tasks: List[List[Any]], sources: Dict[str, str]):
+  """
+  Hands a shard its tasks.
+
+  Args:
+    shard (int): Index of shard.
+    hold_id (Optional[str]): The shard's hold, if any.
+    client_id (str): ID of client.
+    replace (bool): See /shard/commit.
+    tasks (List[List[Any]]): Tasks, as given by Task.to_record().
+    sources (Dict[str, str]): Source of each program, by ID.
+  """
+  call(shard, 'POST', '/shard/commit', {
+    'hold_id': hold_id,
+    'client_id': client_id,
+    'replace': replace,
+    'tasks': tasks,
+    'programs': {task[1]: sources[task[1]] for task in tasks},
+  })
+
+
+def session() -> requests.Session:
+  """
+  Returns:
+    (requests.Session): The calling thread's session to the shards.
+  """
+  if not hasattr(sessions, 'session'):
+    sessions.session = requests.Session()
+  return sessions.session
+
+
+def call(shard: int, method: str, path: str,
+         body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+  """
+  Sends a request to a shard.
+
+  Args:
+    shard (int): Index of shard.
+    method (str): HTTP method.
+    path (str): Route on the shard.
+    body (Optional[Dict[str, Any]]): JSON body.
+
+  Raises:
+    requests.RequestException: If the request failed.
+
+  Returns:
+    (Dict[str, Any]): JSON response.
+  """
+  res: requests.Response = session().request(
+    method, shards[shard] + path, json=body, timeout=SHARD_TIMEOUT)
+  res.raise_for_status()
+  return res.json()
+
+
+def try_call(shard: int, path: str,
+             body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+  """
+  Posts to a shard, logging failures.
+
+  Returns:
+    (Optional[Dict[str, Any]]): JSON response, or None if the request failed.
+  """
+  try:
+    return call(shard, 'POST', path, body)
+  except requests.RequestException:
+    traceback.print_exc()
+    return None
+
+
+def start_shards(n_shards: int, host: str, port: int,
+                 state_dir: Optional[str], timeout: Optional[float]):
+  """
+  Starts shard processes on the ports after the coordinator's, and stops them
+  when the coordinator exits.
+
+  Args:
+    n_shards (int): Number of shards.
+    host (str): Interface for the shards to listen on.
+    port (int): Coordinator's port.
+    state_dir (Optional[str]): Directory to persist shard state under.
+    timeout (Optional[float]): Liveness timeout for the shards' workers.
+  """
+  here: str = os.path.dirname(os.path.abspath(__file__))
+  processes: List[subprocess.Popen] = []
+  for shard in range(n_shards):
+    args: List[str] = [
+      sys.executable, os.path.join(here, 'shard.py'), f'--shard={shard}',
+      f'--host={host}', f'--port={port + 1 + shard}',
+      f'--coordinator=http://127.0.0.1:{port}']
+    if state_dir:
+      args.append(f'--state-dir={os.path.join(state_dir, f"shard{shard}")}')
+    if timeout:
+      args.append(f'--timeout={timeout}')
+    processes.append(subprocess.Popen(args, cwd=here))
+    shards.append(f'http://127.0.0.1:{port + 1 + shard}')
+    shard_ports.append(port + 1 + shard)
+  atexit.register(lambda: [process.terminate() for process in processes])
+  signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', type=str, default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=5000)
+  parser.add_argument('--shards', type=int, default=os.cpu_count() or 1,
+                      help='number of shard processes to start')
+  parser.add_argument('--shard-urls', type=str, nargs='+',
+                      help='use already running shards instead')
+  parser.add_argument('--state-dir', type=str,
+                      help='persist shard state under this directory')
+  parser.add_argument('--timeout', type=float,
+                      help='seconds without a heartbeat before a worker '
+                           'is deregistered')
+  FLAGS = parser.parse_args()
+  if FLAGS.shard_urls:
+    shards += [url.rstrip('/') for url in FLAGS.shard_urls]
+    shard_ports += [None] * len(FLAGS.shard_urls)
+  else:
+    start_shards(FLAGS.shards, FLAGS.host, FLAGS.port, FLAGS.state_dir,
+                 FLAGS.timeout)
+  free += [0] * len(shards)
+  app.run(host=FLAGS.host, port=FLAGS.port, threaded=True)
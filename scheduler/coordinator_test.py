@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Sharded Mode Tester
+"""
+
+from aiohttp.test_utils import TestClient, TestServer
+from aioscheduler import make_app
+from hashlib import sha256
+from task import Task
+from threading import Event, Thread
+import asyncio
+import json
+import os
+import requests
+import scheduler
+import shard  # adds the /shard routes
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+import zlib
+
+N_SHARDS = 2
+
+def free_port() -> int:
+  """
+  Finds a port that is free along with the N_SHARDS ports after it.
+  """
+  while True:
+    with socket.socket() as sock:
+      sock.bind(('127.0.0.1', 0))
+      port = sock.getsockname()[1]
+    try:
+      for i in range(1, N_SHARDS + 1):
+        with socket.socket() as sock:
+          sock.bind(('127.0.0.1', port + i))
+      return port
+    except OSError:
+      continue
+
+
+def worker_ids(shard, n, prefix):
+  """
+  Returns n worker ID's that the coordinator assigns to a shard.
+  """
+  ids = []
+  i = 0
+  while len(ids) < n:
+    worker_id = f'{prefix}{i}'
+    if zlib.crc32(worker_id.encode()) % N_SHARDS == shard:
+      ids.append(worker_id)
+    i += 1
+  return ids
+
+
+class CoordinatorTest(unittest.TestCase):
+  def setUp(self):
+    port = free_port()
+    self.url = f'http://127.0.0.1:{port}'
+    here = os.path.dirname(os.path.abspath(__file__))
+    self.process = subprocess.Popen(
+      [sys.executable, os.path.join(here, 'coordinator.py'),
+       f'--port={port}', f'--shards={N_SHARDS}', '--timeout=1'],
+      cwd=here, start_new_session=True, stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL)
+    self.stop = Event()
+    self.alive = set()
+    self.heartbeats = Thread(target=self.heartbeat, daemon=True)
+    for i in range(N_SHARDS + 1):
+      while True:
+        try:
+          requests.get(f'http://127.0.0.1:{port + i}/allocation')
+          break
+        except requests.ConnectionError:
+          time.sleep(0.1)
+
+  def tearDown(self):
+    self.stop.set()
+    os.killpg(self.process.pid, signal.SIGTERM)
+    self.process.wait()
+
+  def heartbeat(self):
+    seqs = {}
+    while not self.stop.is_set():
+      for worker_id, scheduler in list(self.alive):
+        res = requests.post(scheduler + '/heartbeat', json={
+          'worker_id': worker_id,
+          'ack': seqs.get(worker_id, 0),
+        })
+        if res.status_code == 200:
+          seqs[worker_id] = res.json()['seq']
+      time.sleep(0.2)
+
+  def register(self, worker_id):
+    res = requests.post(self.url + '/register', json={
+      'worker_id': worker_id,
+      'n_cores': 1,
+    }).json()
+    self.assertEqual(res['worker_id'], worker_id)
+    self.alive.add((worker_id, res['scheduler']))
+    return res['scheduler']
+
+  def allocation(self, client_id):
+    return requests.get(self.url + '/allocation',
+                        params={'client_id': client_id}).json()['task_ids']
+
+  def wait_for(self, condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+      self.assertLess(time.monotonic(), deadline)
+      time.sleep(0.2)
+
+  def test_sharded(self):
+    [a0] = worker_ids(0, 1, 'a')
+    b0, b1, b2 = worker_ids(1, 3, 'b')
+    shard0 = self.register(a0)
+    shard1 = self.register(b0)
+    self.register(b1)
+    self.assertNotEqual(shard0, shard1)
+    self.heartbeats.start()
+
+    # The job spans both shards.
+    task_ids = requests.post(self.url + '/allocate', json={
+      'client_id': 'client1',
+      'new_tasks': [
+        {'program': 'p0', 'contacts': []},
+        {'program': 'p1', 'contacts': [0]},
+        {'program': 'p2', 'contacts': [1]},
+      ],
+    }).json()['task_ids']
+    self.assertEqual(task_ids[0], f'client1~0~{a0}')
+    self.assertEqual(sorted(task_id.split('~')[2]
+                            for task_id in task_ids[1:]), [b0, b1])
+    self.assertEqual(self.allocation('client1'), task_ids)
+
+    # Queueing and batches of jobs are refused rather than ignored.
+    for extra in ({'queue': True}, {'jobs': []}):
+      res = requests.post(self.url + '/allocate', json={
+        'client_id': 'client2',
+        'new_tasks': [{'program': 'p0', 'contacts': []}],
+        **extra,
+      })
+      self.assertEqual(res.status_code, 400)
+
+    # a0 stops heartbeating. Shard 0 has nowhere to put its task, so the
+    # coordinator moves it to shard 1 and rewires the task that contacts it.
+    self.register(b2)
+    self.alive.discard((a0, shard0))
+    moved = f'client1~0~{b2}'
+    self.wait_for(lambda: self.allocation('client1')[0] == moved)
+    state = requests.get(self.url + '/').json()
+    self.assertEqual(state['clients']['client1'][0]['task_id_old'],
+                     task_ids[0])
+    self.assertEqual(state['clients']['client1'][1]['contacts'], [moved])
+    self.assertNotIn(a0, state['workers'])
+
+    # Once there is nowhere left to move tasks, the whole job is cancelled.
+    self.alive = {(b0, shard1), (b1, shard1)}
+    self.wait_for(lambda: self.allocation('client1') == [])
+
+
+
+class ShardCommitTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.client = TestClient(TestServer(make_app()))
+    await self.client.start_server()
+    self.on_orphaned = scheduler.on_orphaned
+
+  async def asyncTearDown(self):
+    scheduler.on_orphaned = self.on_orphaned
+    await self.client.close()
+    scheduler.reset()
+
+  async def test_commit_to_missing_worker(self):
+    # The task's worker left since the hold, and this shard has no room for
+    # it, so it is offered to a coordinator that takes a while to answer.
+    started, done = Event(), Event()
+    orphans = []
+    def orphaned(client_id, tasks):
+      started.set()
+      time.sleep(1)
+      orphans.extend(task.task_id for task in tasks)
+      done.set()
+      return None
+    scheduler.on_orphaned = orphaned
+
+    task = Task('client1', 0, 'gone', sha256(b'p').hexdigest(), [])
+    start = time.monotonic()
+    res = await self.client.post('/shard/commit', data=json.dumps({
+      'client_id': 'client1',
+      'replace': True,
+      'tasks': [task.to_record()],
+      'programs': {task.program_id: 'p'},
+    }))
+    self.assertEqual(res.status, 200)
+    self.assertLess(time.monotonic() - start, 0.5)
+
+    # The shard keeps serving while the coordinator is asked.
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+    res = await self.client.get('/allocation?client_id=client1')
+    self.assertEqual(res.status, 200)
+    self.assertFalse(done.is_set())
+    await asyncio.get_running_loop().run_in_executor(None, done.wait, 5)
+    self.assertEqual(orphans, ['client1~0~gone'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Instrumented Locks
+"""
+
+from metrics import Histogram
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+class TimedLock:
+  """
+  A mutex that keeps running totals of how long it was waited on and held,
+  and optionally records each wait and hold in a histogram. Totals are only
+  updated by the thread holding the lock, so they need no extra
+  synchronization.
+
+  Attributes:
+    acquisitions (int): Number of times the lock was acquired.
+    wait_time (float): Total seconds spent waiting to acquire the lock.
+    hold_time (float): Total seconds the lock was held.
+  """
+  __slots__ = ('lock', 'acquired_at', 'acquisitions', 'wait_time',
+               'hold_time', 'wait_histogram', 'hold_histogram')
+
+  def __init__(self, wait_histogram: Optional[Histogram] = None,
+               hold_histogram: Optional[Histogram] = None):
+    """
+    Args:
+      wait_histogram (Optional[Histogram]): Records seconds spent waiting.
+      hold_histogram (Optional[Histogram]): Records seconds held.
+    """
+    self.lock: Lock = Lock()
+    self.acquired_at: float = 0.0
+    self.acquisitions: int = 0
+    self.wait_time: float = 0.0
+    self.hold_time: float = 0.0
+    self.wait_histogram: Optional[Histogram] = wait_histogram
+    self.hold_histogram: Optional[Histogram] = hold_histogram
+
+  def acquire(self, blocking: bool = True) -> bool:
+    """
+    Args:
+      blocking (bool): Whether to wait for the lock if it is held.
+
+    Returns:
+      (bool): Whether the lock was acquired.
+    """
+    start: float = perf_counter()
+    if not self.lock.acquire(blocking):
+      return False
+    self.acquired_at = perf_counter()
+    self.acquisitions += 1
+    self.wait_time += self.acquired_at - start
+    if self.wait_histogram is not None:
+      self.wait_histogram.observe(self.acquired_at - start)
+    return True
+
+  def release(self):
+    held: float = perf_counter() - self.acquired_at
+    self.hold_time += held
+    self.lock.release()
+    if self.hold_histogram is not None:
+      self.hold_histogram.observe(held)
+
+  def locked(self) -> bool:
+    return self.lock.locked()
+
+  def __enter__(self) -> bool:
+    return self.acquire()
+
+  def __exit__(self, *args):
+    self.release()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Metrics
+
+Counters, gauges, and histograms, exported in the Prometheus text format.
+Every thread records into its own shard of each metric, so recording takes no
+locks and can stay on in hot paths. Shards are only summed when the metrics
+are rendered.
+"""
+
+from bisect import bisect_left
+from functools import wraps
+from threading import current_thread, local, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Upper bounds (seconds) of latency histogram buckets.
+LATENCY_BUCKETS: Tuple[float, ...] = (
+  0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+  0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric created, in creation order.
+REGISTRY: List['Metric'] = []
+
+class Metric:
+  """
+  Base class of sharded metrics. Each metric is registered in REGISTRY when
+  created.
+
+  Attributes:
+    name (str): Metric name.
+    help (str): Description of the metric.
+    labels (Dict[str, str]): Fixed label values of this series. Metrics that
+      share a name are rendered as one family.
+  """
+  kind: str = 'untyped'
+
+  def __init__(self, name: str, help: str,
+               labels: Optional[Dict[str, str]] = None, size: int = 1):
+    self.name: str = name
+    self.help: str = help
+    self.labels: Dict[str, str] = labels or {}
+    self.size: int = size
+    self.local: local = local()
+    self.shards: List[Tuple[Thread, List[float]]] = []
+    self.retired: List[float] = [0.0] * size
+    self.lock: Lock = Lock()  # guards shard creation and collection only
+    REGISTRY.append(self)
+
+  def shard(self) -> List[float]:
+    """
+    Returns:
+      (List[float]): The calling thread's shard, created on first use.
+    """
+    try:
+      return self.local.shard
+    except AttributeError:
+      shard: List[float] = [0.0] * self.size
+      with self.lock:
+        self.shards.append((current_thread(), shard))
+      self.local.shard = shard
+      return shard
+
+  def collect(self) -> List[float]:
+    """
+    Sums the shards of all threads. Shards of threads that have exited are
+    folded into a single retired shard, so short-lived threads do not pile up.
+
+    Returns:
+      (List[float]): Summed shard.
+    """
+    with self.lock:
+      live: List[Tuple[Thread, List[float]]] = []
+      for thread, shard in self.shards:
+        if thread.is_alive():
+          live.append((thread, shard))
+        else:
+          self.retired = [a + b for a, b in zip(self.retired, shard)]
+      self.shards = live
+      total: List[float] = list(self.retired)
+      for _, shard in live:
+        total = [a + b for a, b in zip(total, shard)]
+      return total
+
+  def series(self, suffix: str = '', **extra: str) -> str:
+    """
+    Args:
+      suffix (str): Appended to the metric name.
+      extra (str): Additional label values.
+
+    Returns:
+      (str): Series name with labels, e.g. name_count{handler="allocate"}.
+    """
+    labels: Dict[str, str] = dict(self.labels, **extra)
+    if not labels:
+      return self.name + suffix
+    return self.name + suffix + '{' + ','.join(
+      f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+  def render(self) -> List[str]:
+    """
+    Returns:
+      (List[str]): Lines of Prometheus text format for this series.
+    """
+    raise NotImplementedError
+
+
+class Counter(Metric):
+  """
+  A monotonically increasing count.
+  """
+  kind: str = 'counter'
+
+  def inc(self, amount: float = 1):
+    self.shard()[0] += amount
+
+  def render(self) -> List[str]:
+    return [f'{self.series()} {number(self.collect()[0])}']
+
+
+class Gauge(Metric):
+  """
+  A value read from a callback when metrics are rendered.
+  """
+  kind: str = 'gauge'
+
+  def __init__(self, name: str, help: str, read: Callable[[], float],
+               labels: Optional[Dict[str, str]] = None):
+    Metric.__init__(self, name, help, labels, 0)
+    self.read: Callable[[], float] = read
+
+  def render(self) -> List[str]:
+    return [f'{self.series()} {number(self.read())}']
+
+
+class Histogram(Metric):
+  """
+  Counts observations into buckets by upper bound. Each shard holds one
+  count per bucket, one for observations above every bound, and the sum.
+  """
+  kind: str = 'histogram'
+
+  def __init__(self, name: str, help: str,
+               labels: Optional[Dict[str, str]] = None,
+               buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+    Metric.__init__(self, name, help, labels, len(buckets) + 2)
+    self.buckets: Tuple[float, ...] = buckets
+
+  def observe(self, value: float):
+    shard: List[float] = self.shard()
+    shard[bisect_left(self.buckets, value)] += 1
+    shard[-1] += value
+
+  def time(self, fn: Callable) -> Callable:
+    """
+    Decorates a function to observe how long each call takes, including
+    calls that raise.
+    """
+    @wraps(fn)
+    def timed(*args: Any, **kwargs: Any) -> Any:
+      start: float = perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        self.observe(perf_counter() - start)
+    return timed
+
+  def render(self) -> List[str]:
+    total: List[float] = self.collect()
+    lines: List[str] = []
+    cumulative: float = 0
+    for bound, count in zip(self.buckets, total):
+      cumulative += count
+      lines.append(f'{self.series("_bucket", le=number(bound))} '
+                   f'{number(cumulative)}')
+    cumulative += total[-2]
+    lines.append(f'{self.series("_bucket", le="+Inf")} {number(cumulative)}')
+    lines.append(f'{self.series("_sum")} {number(total[-1])}')
+    lines.append(f'{self.series("_count")} {number(cumulative)}')
+    return lines
+
+
+def number(value: float) -> str:
+  """
+  Args:
+    value (float): Sample value.
+
+  Returns:
+    (str): The value in Prometheus text format, without a trailing .0.
+  """
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+  """
+  Returns:
+    (str): Every registered metric in Prometheus text format.
+  """
+  families: Dict[str, List[Metric]] = {}
+  for metric in list(REGISTRY):
+    families.setdefault(metric.name, []).append(metric)
+  lines: List[str] = []
+  for name, family in families.items():
+    lines.append(f'# HELP {name} {family[0].help}')
+    lines.append(f'# TYPE {name} {family[0].kind}')
+    for metric in family:
+      lines += metric.render()
+  return '\n'.join(lines) + '\n'
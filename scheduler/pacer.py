@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Heartbeat Pacer
+"""
+
+from math import inf
+from typing import Callable
+import time
+
+# Seconds between a worker's heartbeats in a small, steady cluster. Also what
+# supervisors use when the scheduler does not say.
+INTERVAL: float = 5.0
+
+# Bounds on the seconds between a worker's heartbeats.
+MIN_INTERVAL: float = 1.0
+MAX_INTERVAL: float = 120.0
+
+# Heartbeats per second the whole fleet may send. Beyond MAX_RATE * INTERVAL
+# workers, every interval grows with the fleet so that the total stays put.
+MAX_RATE: float = 1000.0
+
+# Seconds after a worker is lost or a job is placed during which workers
+# heartbeat more often, since tasks and contact patches are on the move.
+CHURN_WINDOW: float = 30.0
+
+class Pacer:
+  """
+  Decides how long each worker waits before its next heartbeat.
+
+  Intervals start from INTERVAL. They are halved while tasks are on the move
+  (within CHURN_WINDOW of a worker loss or a job placement), and for busy
+  workers while jobs are queued, since those jobs are admitted as the busy
+  workers report finished tasks. Idle workers in a steady cluster have nothing
+  to hear about but new jobs, and heartbeat half as often. Whatever the
+  state, no interval is shorter than the fleet size over max_rate, so the
+  heartbeat rate stays bounded however many workers join.
+  """
+  def __init__(self, interval: float = INTERVAL, max_rate: float = MAX_RATE,
+               clock: Callable[[], float] = time.monotonic):
+    """
+    Args:
+      interval (float): Seconds between heartbeats in a small, steady
+        cluster.
+      max_rate (float): Heartbeats per second the whole fleet may send.
+      clock (Callable[[], float]): Current time in seconds.
+    """
+    self.interval: float = interval
+    self.max_rate: float = max_rate
+    self.clock: Callable[[], float] = clock
+    self.churned: float = -inf
+
+  def churn(self):
+    """
+    Records that a worker was lost or a job was placed.
+    """
+    self.churned = self.clock()
+
+  def pace(self, n_workers: int, busy: bool, queued: bool) -> float:
+    """
+    Args:
+      n_workers (int): Registered workers.
+      busy (bool): Whether the worker has tasks.
+      queued (bool): Whether jobs are waiting for cores.
+
+    Returns:
+      (float): Seconds the worker should wait before its next heartbeat.
+    """
+    interval: float = self.interval
+    if self.clock() - self.churned < CHURN_WINDOW or (busy and queued):
+      interval /= 2
+    elif not busy:
+      interval *= 2
+    interval = max(interval, n_workers / self.max_rate, MIN_INTERVAL)
+    return min(interval, MAX_INTERVAL)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Write-Ahead Log
+"""
+
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, IO, Iterator, List, Optional
+import json
+import os
+import time
+import traceback
+
+# Number of logged records after which the log is compacted into a snapshot.
+SNAPSHOT_EVERY: int = 100000
+
+class Journal:
+  """
+  Durable log of scheduler state changes, compacted into periodic snapshots.
+
+  Records are JSON objects, one per line, each naming an 'op' and carrying the
+  full new state of whatever it describes, so replaying them in order rebuilds
+  the state and replaying one twice is harmless. Snapshots hold the same kinds
+  of records as the log.
+
+  The log is split into numbered segments. A snapshot starts a new segment and
+  then captures the live state, which is at least as new as the segment's
+  first record, so recovery replays the snapshot followed by every segment
+  from that one on. Superseded segments are deleted once the snapshot is
+  safely on disk.
+
+  Appends are flushed to the OS immediately and fsynced by a background thread
+  once per interval, which also takes snapshots once enough records pile up.
+
+  Files in the state directory:
+    snapshot.json: Header line {"op": "snapshot", "segment": n}, then records.
+    wal.<n>.json: Log segment n.
+  """
+  def __init__(self, path: str,
+               capture: Callable[[], Iterator[Dict[str, Any]]],
+               snapshot_every: int = SNAPSHOT_EVERY, interval: float = 1.0):
+    """
+    Args:
+      path (str): State directory, created if needed.
+      capture (Callable[[], Iterator[Dict[str, Any]]]): Yields records that
+        describe the whole live state, for snapshots.
+      snapshot_every (int): Records logged between snapshots.
+      interval (float): Seconds between fsyncs and snapshot checks.
+    """
+    self.path: str = path
+    self.capture: Callable[[], Iterator[Dict[str, Any]]] = capture
+    self.snapshot_every: int = snapshot_every
+    self.interval: float = interval
+    self.segment: int = 0
+    self.file: Optional[IO[str]] = None
+    self.count: int = 0
+    self.lock: Lock = Lock()
+    self.thread: Thread = Thread(target=self.run, daemon=True)
+    self.closed: bool = False
+    os.makedirs(path, exist_ok=True)
+
+  def segments(self) -> List[int]:
+    """
+    Returns:
+      (List[int]): Numbers of the log segments on disk, in order.
+    """
+    return sorted(int(name.split('.')[1]) for name in os.listdir(self.path)
+                  if name.startswith('wal.') and name.endswith('.json'))
+
+  def segment_path(self, segment: int) -> str:
+    return os.path.join(self.path, f'wal.{segment}.json')
+
+  def replay(self) -> Iterator[Dict[str, Any]]:
+    """
+    Reads back the latest snapshot and every log segment after it. A record
+    cut short by a crash ends its file.
+
+    Returns:
+      (Iterator[Dict[str, Any]]): Records, oldest first.
+    """
+    first: int = 0
+    snapshot: str = os.path.join(self.path, 'snapshot.json')
+    if os.path.exists(snapshot):
+      records: Iterator[Dict[str, Any]] = read(snapshot)
+      first = next(records)['segment']
+      yield from records
+    for segment in self.segments():
+      if segment >= first:
+        for record in read(self.segment_path(segment)):
+          self.count += 1  # replayed log records count towards a snapshot
+          yield record
+
+  def start(self):
+    """
+    Opens a new log segment for appends and starts the background thread.
+    Call after replay().
+    """
+    self.segment = max(self.segments(), default=0) + 1
+    self.file = open(self.segment_path(self.segment), 'a')
+    self.thread.start()
+
+  def append(self, record: Dict[str, Any]):
+    """
+    Logs a state change. Callers hold the lock guarding the state described,
+    so records of the same state are logged in the order they happened.
+
+    Args:
+      record (Dict[str, Any]): Record with an 'op' key.
+    """
+    line: str = json.dumps(record, separators=(',', ':')) + '\n'
+    with self.lock:
+      if self.file is None:
+        return
+      self.file.write(line)
+      self.file.flush()
+      self.count += 1
+
+  def snapshot(self):
+    """
+    Writes a snapshot of the live state and deletes the log segments it
+    supersedes.
+    """
+    with self.lock:
+      if self.file is None:
+        return
+      self.file.close()
+      self.segment += 1
+      self.file = open(self.segment_path(self.segment), 'a')
+      self.count = 0
+      segment: int = self.segment
+
+    temp: str = os.path.join(self.path, 'snapshot.json.tmp')
+    with open(temp, 'w') as file:
+      file.write(json.dumps({'op': 'snapshot', 'segment': segment}) + '\n')
+      for record in self.capture():
+        file.write(json.dumps(record, separators=(',', ':')) + '\n')
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(temp, os.path.join(self.path, 'snapshot.json'))
+    for old in self.segments():
+      if old < segment:
+        os.remove(self.segment_path(old))
+
+  def sync(self):
+    """
+    Forces logged records to disk.
+    """
+    with self.lock:
+      if self.file is None:
+        return
+      fileno: int = self.file.fileno()
+    os.fsync(fileno)
+
+  def close(self):
+    """
+    Stops logging. Records already logged are synced to disk.
+    """
+    self.closed = True
+    with self.lock:
+      if self.file is not None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+  def run(self):
+    # Snapshots and segment rotation only happen on this thread, so sync()
+    # never races with a rotation.
+    while True:
+      time.sleep(self.interval)
+      if self.closed:
+        return
+      try:
+        self.sync()
+        if self.count >= self.snapshot_every:
+          self.snapshot()
+      except Exception:
+        traceback.print_exc()
+
+
+def read(path: str) -> Iterator[Dict[str, Any]]:
+  """
+  Args:
+    path (str): File of JSON records, one per line.
+
+  Returns:
+    (Iterator[Dict[str, Any]]): Records up to the first incomplete one.
+  """
+  with open(path) as file:
+    for line in file:
+      try:
+        yield json.loads(line)
+      except ValueError:
+        return
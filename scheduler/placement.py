@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Task Placement Policies
+
+A placement assigns each vertex of a job to one of a list of bins (reserved
+workers), each with a number of free slots (cores).
+"""
+
+from heapq import heappop, heappush
+from typing import Dict, List, Optional, Tuple
+
+def greedy(n_vertices: int, capacities: List[int]) -> List[int]:
+  """
+  Fills bins in order with vertices in order.
+
+  Args:
+    n_vertices (int): Number of vertices in the job.
+    capacities (List[int]): Free slots per bin. Must cover n_vertices.
+
+  Returns:
+    (List[int]): Bin index of each vertex.
+  """
+  assignment: List[int] = []
+  for b, capacity in enumerate(capacities):
+    assignment += [b] * min(capacity, n_vertices - len(assignment))
+  return assignment
+
+
+def adjacency(contacts: List[List[int]],
+              weights: Optional[List[List[float]]] = None) \
+    -> List[Dict[int, float]]:
+  """
+  Builds an undirected, weighted adjacency map from contact lists. Edges in
+  both directions between two vertices are summed.
+
+  Args:
+    contacts (List[List[int]]): Each vertex's contacts.
+    weights (Optional[List[List[float]]]): Weight of each contact edge,
+      parallel to contacts. Edges without a weight count as 1.
+
+  Returns:
+    (List[Dict[int, float]]): Neighbor -> edge weight, for each vertex.
+  """
+  adj: List[Dict[int, float]] = [{} for _ in contacts]
+  for u, vs in enumerate(contacts):
+    ws: List[float] = weights[u] if weights and weights[u] else []
+    for i, v in enumerate(vs):
+      if u == v:
+        continue
+      w: float = float(ws[i]) if i < len(ws) else 1.0
+      adj[u][v] = adj[u].get(v, 0.0) + w
+      adj[v][u] = adj[v].get(u, 0.0) + w
+  return adj
+
+
+def locality(contacts: List[List[int]], capacities: List[int],
+             weights: Optional[List[List[float]]] = None,
+             passes: int = 4) -> List[int]:
+  """
+  Partitions the job graph so that heavily connected vertices share a bin.
+
+  Bins are grown one at a time: each starts from the first unplaced vertex
+  and repeatedly takes the unplaced vertex most strongly connected to it. A
+  few refinement passes then move or swap single vertices between bins while
+  that lowers the weight of cut edges and respects bin capacities.
+
+  Args:
+    contacts (List[List[int]]): Each vertex's contacts.
+    capacities (List[int]): Free slots per bin. Must cover all vertices.
+    weights (Optional[List[List[float]]]): Weight of each contact edge,
+      parallel to contacts. Edges without a weight count as 1.
+    passes (int): Maximum number of refinement passes.
+
+  Returns:
+    (List[int]): Bin index of each vertex.
+  """
+  n: int = len(contacts)
+  adj: List[Dict[int, float]] = adjacency(contacts, weights)
+  assignment: List[int] = [-1] * n
+  sizes: List[int] = [0] * len(capacities)
+
+  # Grow bins.
+  seed: int = 0
+  for b, capacity in enumerate(capacities):
+    gain: Dict[int, float] = {}
+    heap: List[Tuple[float, int]] = []
+    while sizes[b] < capacity:
+      u: int = -1
+      while heap:
+        g, v = heappop(heap)
+        if assignment[v] < 0 and -g == gain.get(v):
+          u = v
+          break
+      if u < 0:
+        while seed < n and assignment[seed] >= 0:
+          seed += 1
+        if seed == n:
+          break
+        u = seed
+      assignment[u] = b
+      sizes[b] += 1
+      for v, w in adj[u].items():
+        if assignment[v] < 0:
+          gain[v] = gain.get(v, 0.0) + w
+          heappush(heap, (-gain[v], v))
+    if seed == n:
+      break
+
+  # Refine.
+  members: List[List[int]] = [[] for _ in capacities]
+  for u, b in enumerate(assignment):
+    members[b].append(u)
+  for _ in range(passes):
+    improved: bool = False
+    for u in range(n):
+      a: int = assignment[u]
+      links: Dict[int, float] = {}
+      for v, w in adj[u].items():
+        links[assignment[v]] = links.get(assignment[v], 0.0) + w
+      here: float = links.get(a, 0.0)
+      for b, there in sorted(links.items(), key=lambda item: -item[1]):
+        if b == a or there <= here:
+          continue
+        if sizes[b] < capacities[b]:
+          members[a].remove(u)
+          members[b].append(u)
+          sizes[a] -= 1
+          sizes[b] += 1
+          assignment[u] = b
+          improved = True
+          break
+        v: Optional[int] = best_swap(adj, assignment, members[b], u,
+                                     there - here)
+        if v is not None:
+          members[a][members[a].index(u)] = v
+          members[b][members[b].index(v)] = u
+          assignment[u], assignment[v] = b, a
+          improved = True
+          break
+    if not improved:
+      break
+  return assignment
+
+
+def best_swap(adj: List[Dict[int, float]], assignment: List[int],
+              candidates: List[int], u: int, gain_u: float) -> Optional[int]:
+  """
+  Finds the vertex whose swap with u lowers the cut the most.
+
+  Args:
+    adj (List[Dict[int, float]]): Weighted adjacency map.
+    assignment (List[int]): Bin index of each vertex.
+    candidates (List[int]): Vertices in the bin u would move to.
+    u (int): Vertex to move.
+    gain_u (float): Cut reduction from moving u alone.
+
+  Returns:
+    (Optional[int]): Vertex to swap with u, if any swap helps.
+  """
+  a: int = assignment[u]
+  best: Optional[int] = None
+  best_gain: float = 0.0
+  for v in candidates:
+    b: int = assignment[v]
+    gain_v: float = sum(w if assignment[x] == a else -w if assignment[x] == b
+                        else 0.0 for x, w in adj[v].items())
+    gain: float = gain_u + gain_v - 2 * adj[u].get(v, 0.0)
+    if gain > best_gain:
+      best, best_gain = v, gain
+  return best
+
+
+def cut_edges(contacts: List[List[int]], assignment: List[int]) -> int:
+  """
+  Args:
+    contacts (List[List[int]]): Each vertex's contacts.
+    assignment (List[int]): Bin index of each vertex.
+
+  Returns:
+    (int): Number of contact edges between vertices in different bins.
+  """
+  return sum(assignment[u] != assignment[v]
+             for u, vs in enumerate(contacts) for v in vs)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Program Store
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+import gzip
+
+# Programs kept after no task uses them, or uploaded before any job refers to
+# them, so that clients resubmitting a job need not upload them again. The
+# least recently used go first.
+MAX_SPARE: int = 256
+
+class ProgramStore:
+  """
+  Content-addressed store of client-submitted programs.
+
+  Programs are keyed by the SHA-256 of their source, so every task running the
+  same program shares one copy, and a program ID never changes meaning, which
+  makes it safe to cache forever. Entries are reference counted. Programs no
+  task uses are kept as spares, up to max_spare of them, so that a client can
+  upload programs ahead of a job that refers to them by ID, and resubmit a
+  job without uploading them again.
+
+  Attributes:
+    added (Optional[Callable[[str, str], None]]): Called with the ID and
+      source of each newly stored program, under the store's lock.
+  """
+  def __init__(self, max_spare: int = MAX_SPARE):
+    self.max_spare: int = max_spare
+    self.programs: Dict[str, str] = {}
+    self.refs: Dict[str, int] = {}
+    self.spare: OrderedDict[str, None] = OrderedDict()
+    self.compressed: Dict[str, bytes] = {}
+    self.lock: Lock = Lock()
+    self.added: Optional[Callable[[str, str], None]] = None
+
+  def __contains__(self, program_id: str) -> bool:
+    return program_id in self.programs
+
+  def put(self, program: str) -> str:
+    """
+    Adds a reference to a program, storing it if needed.
+
+    Args:
+      program (str): JavaScript source.
+
+    Returns:
+      (str): Program's ID (hex SHA-256 of the source).
+    """
+    program_id: str = sha256(program.encode()).hexdigest()
+    with self.lock:
+      self.store(program_id, program)
+      self.spare.pop(program_id, None)
+      self.refs[program_id] = self.refs.get(program_id, 0) + 1
+    return program_id
+
+  def add(self, program: str) -> str:
+    """
+    Stores a program without adding a reference to it, as a spare.
+
+    Args:
+      program (str): JavaScript source.
+
+    Returns:
+      (str): Program's ID.
+    """
+    program_id: str = sha256(program.encode()).hexdigest()
+    with self.lock:
+      self.store(program_id, program)
+      if program_id not in self.refs:
+        self.spare[program_id] = None
+        self.spare.move_to_end(program_id)
+        self.trim()
+    return program_id
+
+  def missing(self, program_ids: List[str]) -> List[str]:
+    """
+    Finds which programs are not stored. Spares that are stored count as
+    recently used, since a job is likely to refer to them soon.
+
+    Args:
+      program_ids (List[str]): Programs' ID's.
+
+    Returns:
+      (List[str]): ID's of the programs not stored, in the given order.
+    """
+    with self.lock:
+      for program_id in program_ids:
+        if program_id in self.spare:
+          self.spare.move_to_end(program_id)
+      return [program_id for program_id in program_ids
+              if program_id not in self.programs]
+
+  def store(self, program_id: str, program: str):
+    """
+    Stores a program if it is not stored yet. Must be called with the lock
+    held.
+    """
+    if program_id not in self.programs:
+      self.programs[program_id] = program
+      if self.added is not None:
+        self.added(program_id, program)
+
+  def trim(self):
+    """
+    Drops the least recently used spares beyond max_spare. Must be called
+    with the lock held.
+    """
+    while len(self.spare) > self.max_spare:
+      program_id, _ = self.spare.popitem(last=False)
+      del self.programs[program_id]
+      self.compressed.pop(program_id, None)
+
+  def release(self, program_id: str):
+    """
+    Drops a reference to a program, keeping it as a spare once unused.
+
+    Args:
+      program_id (str): Program's ID.
+    """
+    with self.lock:
+      if program_id not in self.refs:
+        return
+      self.refs[program_id] -= 1
+      if self.refs[program_id] <= 0:
+        del self.refs[program_id]
+        self.spare[program_id] = None
+        self.trim()
+
+  def get(self, program_id: str) -> str:
+    """
+    Raises:
+      KeyError: If the program is not stored.
+
+    Returns:
+      (str): JavaScript source.
+    """
+    return self.programs[program_id]
+
+  def get_gzip(self, program_id: str) -> bytes:
+    """
+    Raises:
+      KeyError: If the program is not stored.
+
+    Returns:
+      (bytes): Gzip-compressed JavaScript source, compressed on first use.
+    """
+    body: Optional[bytes] = self.compressed.get(program_id)
+    if body is None:
+      body = gzip.compress(self.programs[program_id].encode(), mtime=0)
+      with self.lock:
+        if program_id in self.programs:
+          self.compressed[program_id] = body
+    return body
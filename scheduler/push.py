@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Task Push Subscriptions
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterator, List
+
+class Subscriptions:
+  """
+  Tracks callbacks waiting for new tasks on a worker, so that long-polling
+  workers can be woken as soon as allocate() or deregister() queues tasks for
+  them. Notifying a worker nobody waits on costs one dict lookup.
+
+  Callbacks run on the notifying thread while the subscription lock is held,
+  so they must only hand the wake-up over (e.g. via call_soon_threadsafe).
+  """
+  def __init__(self):
+    self.waiters: Dict[str, List[Callable[[], None]]] = {}
+    self.lock: Lock = Lock()
+
+  def __len__(self) -> int:
+    return sum(len(waiters) for waiters in self.waiters.values())
+
+  @contextmanager
+  def subscribe(self, worker_id: str,
+                wake: Callable[[], None]) -> Iterator[None]:
+    """
+    Calls wake whenever tasks are queued for a worker, for as long as the
+    context is open.
+
+    Args:
+      worker_id (str): ID of worker.
+      wake (Callable[[], None]): Thread-safe wake-up callback.
+    """
+    with self.lock:
+      self.waiters.setdefault(worker_id, []).append(wake)
+    try:
+      yield
+    finally:
+      with self.lock:
+        waiters: List[Callable[[], None]] = self.waiters[worker_id]
+        waiters.remove(wake)
+        if not waiters:
+          del self.waiters[worker_id]
+
+  def notify(self, worker_id: str):
+    """
+    Wakes everything waiting on a worker.
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    if worker_id not in self.waiters:
+      return
+    with self.lock:
+      for wake in self.waiters.get(worker_id, []):
+        wake()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Liveness Reaper
+"""
+
+from collections import OrderedDict
+from math import erfc, inf, log10, sqrt
+from metrics import Counter
+from pacer import INTERVAL
+from statistics import NormalDist
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Set
+import time
+import traceback
+
+# Suspicion levels (phi) at which a silent worker is suspected, and expired
+# before the timeout. A phi of p means the odds that a live worker would have
+# stayed silent this long are 1 in 10^p, going by its past heartbeats.
+PHI_SUSPECT: float = 3.0
+PHI_EXPIRE: float = 8.0
+
+# Heartbeat intervals observed before a worker's phi is trusted.
+MIN_SAMPLES: int = 3
+
+# Weight of the newest interval in a worker's interval mean and variance.
+ALPHA: float = 0.1
+
+# Floor on the standard deviation of heartbeat intervals, since browser
+# timers jitter more than a handful of samples show.
+MIN_STD: float = 2.0
+
+# Expired workers remembered, to notice those that heartbeat again.
+MAX_EXPIRED: int = 10000
+
+SUSPICIONS: Counter = Counter(
+  'scheduler_suspicions_total', 'Workers suspected of having failed.')
+FALSE_SUSPICIONS: Counter = Counter(
+  'scheduler_false_suspicions_total',
+  'Suspected workers that heartbeated again before expiring.')
+EXPIRATIONS: Dict[str, Counter] = {
+  reason: Counter('scheduler_expirations_total', 'Workers expired.',
+                  {'reason': reason})
+  for reason in ('phi', 'timeout')
+}
+FALSE_EXPIRATIONS: Counter = Counter(
+  'scheduler_false_expirations_total',
+  'Expired workers that heartbeated again.')
+
+class Arrivals:
+  """
+  Smoothed mean and variance of a worker's heartbeat intervals, less the
+  interval it was told to keep (see expect()), so that a new interval is
+  expected at once rather than learned.
+  """
+  __slots__ = ('count', 'mean', 'var', 'suspect', 'expected')
+
+  def __init__(self):
+    self.count: int = 0
+    self.mean: float = 0.0
+    self.var: float = 0.0
+    self.suspect: bool = False
+    self.expected: float = 0.0
+
+  def add(self, interval: float):
+    self.count += 1
+    alpha: float = max(ALPHA, 1 / self.count)
+    diff: float = interval - self.mean
+    self.mean += alpha * diff
+    self.var = (1 - alpha) * (self.var + alpha * diff * diff)
+
+  def std(self) -> float:
+    return max(sqrt(self.var), MIN_STD)
+
+  def phi(self, silence: float) -> float:
+    """
+    Returns:
+      (float): Suspicion level after this many seconds without a heartbeat,
+        modelling intervals as normally distributed.
+    """
+    p: float = 0.5 * erfc((silence - self.expected - self.mean) /
+                          (self.std() * sqrt(2)))
+    return -log10(p) if p > 0 else inf
+
+  def after(self, z: float) -> float:
+    """
+    Returns:
+      (float): Seconds of silence at which phi reaches the level whose normal
+        quantile is z; infinite before MIN_SAMPLES intervals.
+    """
+    if self.count < MIN_SAMPLES:
+      return inf
+    return self.expected + self.mean + z * self.std()
+
+
+def quantile(phi: float) -> float:
+  """
+  Returns:
+    (float): Standard normal quantile at which the suspicion level is phi.
+  """
+  p: float = 10 ** -phi
+  return -NormalDist().inv_cdf(p) if p > 0 else inf
+
+
+class Reaper:
+  """
+  Expires workers that stop heartbeating, using a single background thread.
+
+  Last-seen timestamps live in a dict, so a heartbeat is an O(1) update.
+  Workers are also filed into a hashed timing wheel under the tick at which
+  they would next need attention. When the reaper reaches a slot it checks
+  each worker's real deadline: expired workers are collected and handed to
+  the expire callback in one batch, and workers that heartbeated since are
+  refiled under their new deadline.
+
+  Deadlines adapt to each worker (phi accrual failure detection): the reaper
+  learns the mean and spread of a worker's heartbeat intervals, suspects it
+  once its silence reaches phi_suspect, and expires it at phi_expire, or
+  after the timeout at the latest. Decisions are printed and counted in
+  metrics, including suspicions and expirations that turned out wrong, so
+  that the thresholds can be traded off against recovery time.
+  """
+  def __init__(self, timeout: float, expire: Callable[..., None],
+               resolution: float = 1.0, start: bool = True,
+               clock: Callable[[], float] = time.monotonic,
+               phi_suspect: float = PHI_SUSPECT,
+               phi_expire: float = PHI_EXPIRE):
+    """
+    Args:
+      timeout (float): Seconds without a heartbeat before a worker expires,
+        however confident the detector is that it is alive.
+      expire (Callable[..., None]): Called with the ID's of expired workers.
+      resolution (float): Seconds per wheel slot.
+      start (bool): Whether to start the background thread. Without it, the
+        owner calls reap() itself.
+      clock (Callable[[], float]): Current time in seconds. Simulations pass
+        a virtual clock.
+      phi_suspect (float): Suspicion level at which workers are suspected.
+      phi_expire (float): Suspicion level at which workers are expired
+        before the timeout; inf to only expire on the timeout.
+    """
+    self.timeout: float = timeout
+    self.expire: Callable[..., None] = expire
+    self.resolution: float = resolution
+    self.clock: Callable[[], float] = clock
+    self.configure(phi_suspect, phi_expire)
+    self.last_seen: Dict[str, float] = {}
+    self.arrivals: Dict[str, Arrivals] = {}
+    self.filed: Dict[str, int] = {}
+    self.held: Set[str] = set()
+    self.expired: OrderedDict[str, None] = OrderedDict()
+    self.wheel: List[Set[str]] = \
+      [set() for _ in range(int(timeout / resolution) + 2)]
+    self.tick: int = self.to_tick(clock())
+    self.lock: Lock = Lock()
+    self.thread: Thread = Thread(target=self.run, daemon=True)
+    if start:
+      self.thread.start()
+
+  def configure(self, phi_suspect: float, phi_expire: float):
+    """
+    Sets the suspicion levels at which workers are suspected and expired.
+    """
+    self.phi_suspect: float = phi_suspect
+    self.phi_expire: float = phi_expire
+    self.z_suspect: float = quantile(phi_suspect)
+    self.z_expire: float = quantile(phi_expire)
+
+  def to_tick(self, t: float) -> int:
+    return int(t / self.resolution)
+
+  def schedule(self, worker_id: str, deadline: float):
+    # Deadlines past the end of the wheel are filed at its end, and refiled
+    # from there.
+    tick: int = min(max(self.to_tick(deadline), self.tick + 1),
+                    self.tick + len(self.wheel) - 1)
+    self.filed[worker_id] = tick
+    self.wheel[tick % len(self.wheel)].add(worker_id)
+
+  def touch(self, worker_id: str):
+    """
+    Records a heartbeat from a worker, starting to track it if needed.
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    now: float = self.clock()
+    with self.lock:
+      last: Optional[float] = self.last_seen.get(worker_id)
+      if last is None:
+        self.schedule(worker_id, now + self.timeout)
+        self.arrivals[worker_id] = Arrivals()
+      else:
+        arrivals: Arrivals = self.arrivals[worker_id]
+        if arrivals.suspect:
+          arrivals.suspect = False
+          FALSE_SUSPICIONS.inc()
+          print(f'Cleared {worker_id}: heartbeat after {now - last:.1f}s.')
+        arrivals.add(now - last - arrivals.expected)
+        if arrivals.count == MIN_SAMPLES:
+          # Refile under the first adaptive deadline, which is usually well
+          # before the timeout it was filed under. The old entry goes stale.
+          deadline: float = now + arrivals.after(self.z_suspect)
+          if self.to_tick(deadline) < self.filed[worker_id]:
+            self.schedule(worker_id, deadline)
+      self.last_seen[worker_id] = now
+
+  def expect(self, worker_id: str, interval: float):
+    """
+    Records the interval a worker was told to keep until its next heartbeat.
+    Its deadlines move accordingly. The timeout is meant for workers told to
+    heartbeat every INTERVAL or more often, and stretches in proportion for
+    workers told to heartbeat less often.
+
+    Args:
+      worker_id (str): ID of worker.
+      interval (float): Seconds.
+    """
+    with self.lock:
+      arrivals: Optional[Arrivals] = self.arrivals.get(worker_id)
+      if arrivals is not None:
+        arrivals.expected = interval
+
+  def hold(self, worker_id: str):
+    """
+    Counts a worker as seen while its heartbeat is held open, until
+    release().
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    with self.lock:
+      if worker_id in self.last_seen:
+        self.held.add(worker_id)
+
+  def release(self, worker_id: str):
+    """
+    Records that a worker's held heartbeat was answered. Its silence counts
+    from now rather than from when the heartbeat arrived.
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    now: float = self.clock()
+    with self.lock:
+      if worker_id in self.held:
+        self.held.discard(worker_id)
+        self.last_seen[worker_id] = now
+
+  def late(self, worker_id: str) -> bool:
+    """
+    Records a heartbeat from a worker that is no longer registered.
+
+    Args:
+      worker_id (str): ID of worker.
+
+    Returns:
+      (bool): Whether the worker was expired by this reaper, i.e. wrongly.
+    """
+    with self.lock:
+      if worker_id not in self.expired:
+        return False
+      del self.expired[worker_id]
+    FALSE_EXPIRATIONS.inc()
+    print(f'Expired {worker_id} was alive.')
+    return True
+
+  def forget(self, worker_id: str):
+    """
+    Stops tracking a worker. Its wheel entry is dropped lazily.
+
+    Args:
+      worker_id (str): ID of worker.
+    """
+    with self.lock:
+      self.last_seen.pop(worker_id, None)
+      self.arrivals.pop(worker_id, None)
+      self.filed.pop(worker_id, None)
+      self.held.discard(worker_id)
+
+  def reap(self, now: float) -> List[str]:
+    """
+    Advances the wheel up to the given time and expires overdue workers.
+
+    Args:
+      now (float): Current time, as given by the clock.
+
+    Returns:
+      (List[str]): ID's of expired workers.
+    """
+    expired: List[str] = []
+    with self.lock:
+      while self.tick <= self.to_tick(now):
+        slot: int = self.tick % len(self.wheel)
+        due, self.wheel[slot] = self.wheel[slot], set()
+        for worker_id in due:
+          if self.filed.get(worker_id) != self.tick:
+            continue  # forgotten or refiled
+          deadline: Optional[float] = self.check(worker_id, now)
+          if deadline is None:
+            del self.last_seen[worker_id]
+            self.arrivals.pop(worker_id, None)
+            del self.filed[worker_id]
+            self.expired[worker_id] = None
+            if len(self.expired) > MAX_EXPIRED:
+              self.expired.popitem(last=False)
+            expired.append(worker_id)
+          else:
+            self.schedule(worker_id, deadline)
+        self.tick += 1
+    if expired:
+      self.expire(*expired)
+    return expired
+
+  def check(self, worker_id: str, now: float) -> Optional[float]:
+    """
+    Suspects a worker if its silence has reached phi_suspect. Must be called
+    with the lock held.
+
+    Returns:
+      (Optional[float]): When to check the worker again, or None if it has
+        expired.
+    """
+    last: float = now if worker_id in self.held else \
+                  self.last_seen[worker_id]
+    silence: float = now - last
+    arrivals: Arrivals = self.arrivals.setdefault(worker_id, Arrivals())
+    timeout: float = self.timeout * max(1.0, arrivals.expected / INTERVAL)
+    expire_after: float = min(arrivals.after(self.z_expire), timeout)
+    if silence >= expire_after:
+      reason: str = 'timeout' if expire_after == timeout else 'phi'
+      EXPIRATIONS[reason].inc()
+      print(f'Expiring {worker_id}: {self.describe(arrivals, silence)}, '
+            f'{reason}.')
+      return None
+    suspect_after: float = arrivals.after(self.z_suspect)
+    if not arrivals.suspect and silence >= suspect_after:
+      arrivals.suspect = True
+      SUSPICIONS.inc()
+      print(f'Suspecting {worker_id}: {self.describe(arrivals, silence)}.')
+    return last + (expire_after if arrivals.suspect or
+                   suspect_after >= expire_after else suspect_after)
+
+  def describe(self, arrivals: Arrivals, silence: float) -> str:
+    if arrivals.count < MIN_SAMPLES:
+      return f'silent {silence:.1f}s'
+    return f'silent {silence:.1f}s, phi {arrivals.phi(silence):.1f} ' \
+           f'(due after {arrivals.expected:.1f}s, late ' \
+           f'{arrivals.mean:.1f}s +/- {arrivals.std():.1f}s)'
+
+  def run(self):
+    while True:
+      time.sleep(self.resolution)
+      try:
+        self.reap(self.clock())
+      except Exception:
+        traceback.print_exc()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Rebalancer
+"""
+
+from task import Task, task_load, TIMEOUT, Worker
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple
+import time
+import traceback
+
+# Seconds between rebalancing passes.
+INTERVAL: float = 10.0
+
+# Workers at or above this load score shed tasks, to workers at or below
+# LOW_LOAD. Load counts input backlog, so workers whose tasks fall behind
+# (and so add latency) shed tasks too.
+HIGH_LOAD: float = 1.0
+LOW_LOAD: float = 0.5
+
+# Most migrations in flight at once.
+MAX_MIGRATIONS: int = 8
+
+# Seconds a migrated task's old copy keeps running after the switch-over, at
+# least until its worker reports its input queue empty, so that upstream
+# tasks have applied their contact patches and data already sent to it is
+# processed. After MAX_DRAIN, it is stopped regardless.
+DRAIN: float = 10.0
+MAX_DRAIN: float = TIMEOUT
+
+# Seconds a migrated task's new copy may take to start before the migration
+# is abandoned.
+MAX_START: float = TIMEOUT
+
+class Migration:
+  """
+  A task being moved to another worker while it runs.
+
+  The new copy is started first. Once its worker has acknowledged it, it
+  takes the old copy's place in the job and upstream tasks are patched to
+  send to it (the switch-over). The old copy then drains and is stopped.
+
+  Attributes:
+    old (Task): Task being moved.
+    new (Task): Its copy on the new worker, whose task_id_old is the old
+      copy's ID.
+    started (float): When the migration started.
+    switched (Optional[float]): When the new copy took over, if it has.
+  """
+  __slots__ = ('old', 'new', 'started', 'switched')
+
+  def __init__(self, old: Task, new: Task, started: float):
+    self.old: Task = old
+    self.new: Task = new
+    self.started: float = started
+    self.switched: Optional[float] = None
+
+
+class Rebalancer:
+  """
+  Moves tasks off overloaded workers onto under-used ones, such as workers
+  that registered after the tasks were placed, using a background thread.
+
+  Attributes:
+    migrations (Dict[str, Migration]): Migrations in flight, by client ID and
+      vertex index ({client_id}~{vertex_id}). Only touched by step().
+  """
+  def __init__(self, step: Callable[[], None], interval: float = INTERVAL,
+               start: bool = True,
+               clock: Callable[[], float] = time.monotonic):
+    """
+    Args:
+      step (Callable[[], None]): Runs one rebalancing pass.
+      interval (float): Seconds between passes.
+      start (bool): Whether to start the background thread now.
+      clock (Callable[[], float]): Current time in seconds.
+    """
+    self.step: Callable[[], None] = step
+    self.interval: float = interval
+    self.clock: Callable[[], float] = clock
+    self.migrations: Dict[str, Migration] = {}
+    self.thread: Thread = Thread(target=self.run, daemon=True)
+    if start:
+      self.start()
+
+  def start(self):
+    """
+    Starts the background thread, if it has not been started.
+    """
+    if not self.thread.is_alive():
+      self.thread.start()
+
+  def plan(self, workers: List[Worker]) -> List[Tuple[Worker, Task]]:
+    """
+    Picks tasks to move: the heaviest running task of each overloaded worker
+    with more than one, most loaded workers first, up to MAX_MIGRATIONS in
+    flight.
+
+    Args:
+      workers (List[Worker]): Registered workers.
+
+    Returns:
+      (List[Tuple[Worker, Task]]): Workers and the task to move off each.
+    """
+    sources: List[Worker] = sorted(
+      (worker for worker in workers
+       if worker.load >= HIGH_LOAD and len(worker.active_tasks) > 1),
+      key=lambda worker: worker.load, reverse=True)
+    moves: List[Tuple[Worker, Task]] = []
+    for worker in sources:
+      if len(self.migrations) + len(moves) >= MAX_MIGRATIONS:
+        break
+      metrics: Dict[str, Dict[str, float]] = worker.metrics
+      candidates: List[Task] = [
+        task for task in list(worker.active_tasks.values())
+        if not task.cancel and
+           f'{task.client_id}~{task.vertex_id}' not in self.migrations]
+      if candidates:
+        moves.append((worker, max(
+          candidates,
+          key=lambda task: task_load(metrics.get(task.task_id, {})))))
+    return moves
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.step()
+      except Exception:
+        traceback.print_exc()
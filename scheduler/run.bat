@@ -6,7 +6,9 @@
 
 @echo off
 
-if %1. == prod. (
+if %1. == async. (
+  python aioscheduler.py --host=0.0.0.0
+) else if %1. == prod. (
   set FLASK_APP=scheduler.py
   set FLASK_ENV=production
   flask run --host=0.0.0.0
@@ -19,7 +21,9 @@ exit
 
 BATCH
 
-if [ "$1" == "prod" ]; then
+if [ "$1" == "async" ]; then
+  python3 aioscheduler.py --host=0.0.0.0
+elif [ "$1" == "prod" ]; then
   export FLASK_APP=scheduler.py
   export FLASK_ENV=production
   flask run --host=0.0.0.0
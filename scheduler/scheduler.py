@@ -4,11 +4,28 @@
 SPIT-Browser Scheduler
 """
 
+from admission import AdmissionQueue, MAX_WAIT, Submission
+from capacity import CapacityIndex
 from flask import abort, Flask, jsonify, request, Response, send_from_directory
 from flask_cors import CORS
-from threading import Lock
-from typing import Any, Dict, List, Set, Tuple
+from itertools import islice
+from math import inf
+from metrics import Counter, Gauge, Histogram, render
+from pacer import MAX_RATE, Pacer
+from persist import Journal
+from programs import ProgramStore
+from push import Subscriptions
+from reaper import PHI_EXPIRE, PHI_SUSPECT, Reaper
+from rebalancer import DRAIN, LOW_LOAD, MAX_DRAIN, MAX_START, Migration, \
+                       Rebalancer
+from telemetry import Telemetry
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 from task import *
+import json
+import os
+import placement
+import time
 import uuid
 
 app: Flask = Flask(__name__)
@@ -20,42 +37,260 @@ clients: Dict[str, List[Task]] = {}
 # Worker tracker maps worker peer ID to the corresponding object.
 workers: Dict[str, Worker] = {}
 
+# Workers long-polling for new tasks, woken whenever tasks are queued for them.
+subscriptions: Subscriptions = Subscriptions()
+
+# Program store shared by every task of every job.
+programs: ProgramStore = ProgramStore()
+
+# Tasks of replaced jobs that may still be queued on or running on a worker,
+# by worker ID. They hold on to their programs, which the worker may yet
+# fetch, until they leave the worker; see reclaim().
+retiring: Dict[str, List[Task]] = {}
+retiring_lock: Lock = Lock()
+
+# Reverse-dependency index maps client peer ID and vertex index to the tasks
+# that list that vertex among their contacts.
+dependents: Dict[str, Dict[int, List[Task]]] = {}
+
+# Program index maps client peer ID and vertex index to the ID of the
+# program that vertex runs, so that programs can be served by task ID.
+vertex_programs: Dict[str, Dict[int, str]] = {}
+
+# Capacity index over workers with free cores, kept up to date by register,
+# heartbeat, allocate, and deregister.
+capacity: CapacityIndex = CapacityIndex()
+
+# Jobs waiting for enough free cores, admitted by admit().
+admissions: AdmissionQueue = AdmissionQueue()
+
+# Clients long-polling /allocation, woken when their queued job is admitted.
+admitted: Subscriptions = Subscriptions()
+
+# Liveness tracker that deregisters workers which stop heartbeating. Its
+# thresholds can be set with SCHEDULER_PHI_SUSPECT and SCHEDULER_PHI_EXPIRE;
+# see reaper.py.
+reaper: Reaper = Reaper(
+  TIMEOUT, lambda *worker_ids: deregister(*worker_ids),
+  phi_suspect=float(os.environ.get('SCHEDULER_PHI_SUSPECT', PHI_SUSPECT)),
+  phi_expire=float(os.environ.get('SCHEDULER_PHI_EXPIRE', PHI_EXPIRE)))
+
+# Decides how long each worker waits between heartbeats. The fleet's heartbeat
+# rate can be capped with SCHEDULER_MAX_HEARTBEAT_RATE; see pacer.py.
+pacer: Pacer = Pacer(max_rate=float(
+  os.environ.get('SCHEDULER_MAX_HEARTBEAT_RATE', MAX_RATE)))
+
+# Per-vertex time series of the task metrics workers report, served at
+# /jobs/<client_id>/stats.
+telemetry: Telemetry = Telemetry()
+
+# Mover of tasks off overloaded workers, started if SCHEDULER_REBALANCE is set
+# or by aioscheduler.py --rebalance.
+rebalancer: Rebalancer = Rebalancer(lambda: rebalance(), start=False)
+
+# Write-ahead log of state changes, if persistence is enabled; see
+# open_journal().
+journal: Optional[Journal] = None
+
+# Hooks set by shard.py when this scheduler is one of several shards, since a
+# job's tasks may span shards. on_moved and on_cancelled are told about tasks
+# that reallocate() moved and jobs it cancelled. on_orphaned is offered tasks
+# that do not fit on this shard, and returns their moves (old task ID -> new
+# task ID) if it placed them elsewhere.
+on_moved: Optional[Callable[[str, Dict[str, str]], None]] = None
+on_cancelled: Optional[Callable[[str], None]] = None
+on_orphaned: Optional[Callable[[str, List[Task]],
+                               Optional[Dict[str, str]]]] = None
+
+# Metrics exported at /metrics.
+REQUEST_DURATION: Dict[str, Histogram] = {
+  handler: Histogram('scheduler_request_duration_seconds',
+                     'Time spent handling requests.', {'handler': handler})
+  for handler in ('allocate', 'heartbeat', 'program')
+}
+DEREGISTER_DURATION: Histogram = Histogram(
+  'scheduler_deregister_duration_seconds',
+  'Time spent deregistering workers and reallocating their tasks.')
+DEREGISTRATIONS: Counter = Counter(
+  'scheduler_deregistrations_total', 'Workers deregistered.')
+REALLOCATIONS: Counter = Counter(
+  'scheduler_reallocations_total', 'Tasks moved off deregistered workers.')
+MIGRATIONS: Counter = Counter(
+  'scheduler_migrations_total', 'Tasks moved off overloaded workers.')
+CANCELLATIONS: Counter = Counter(
+  'scheduler_cancellations_total',
+  'Jobs cancelled because their tasks could not be reallocated.')
+TASKS: List[Gauge] = [
+  Gauge('scheduler_tasks', 'Tasks queued for or running on workers.',
+        lambda queue=queue: sum(len(getattr(worker, queue))
+                                for worker in list(workers.values())),
+        {'state': state})
+  for state, queue in (('pending', 'pending_tasks'),
+                       ('active', 'active_tasks'))
+]
+WORKERS: Gauge = Gauge('scheduler_workers', 'Registered workers.',
+                       lambda: len(workers))
+QUEUED: Gauge = Gauge('scheduler_queued_jobs', 'Jobs waiting for free cores.',
+                      lambda: len(admissions))
+
 @app.route('/')
 def root() -> Response:
   """
-  Returns the state of the scheduler.
+  Returns the state of the scheduler. The response is streamed one client or
+  worker at a time, and can be narrowed down or paginated, so that polling it
+  stays cheap on large clusters.
+
+  Args (GET):
+    client_id (str): Only include this client. Optional.
+    worker_id (str): Only include this worker. Optional.
+    offset (int): Number of clients and workers to skip. Optional.
+    limit (int): Maximum number of clients and workers to include. Optional.
 
   Returns (JSON):
-    clients (Dict[str, List[Task]]): All clients registered via /allocate.
-    workers (Dict[str, Worker]): All workers registered via /register.
+    clients (Dict[str, List[Task]]): Clients registered via /allocate. Empty if
+      only worker_id is given.
+    workers (Dict[str, Worker]): Workers registered via /register. Empty if
+      only client_id is given.
   """
-  return jsonify({
-    'clients': clients,
-    'workers': workers,
-  })
+  try:
+    client_id: Optional[str] = request.args.get('client_id')
+    worker_id: Optional[str] = request.args.get('worker_id')
+    start: int = int(request.args.get('offset', 0))
+    limit: Optional[str] = request.args.get('limit')
+    stop: Optional[int] = None if limit is None else start + int(limit)
+  except ValueError:
+    abort(400)
+
+  client_ids: List[str] = [] if worker_id and not client_id else \
+    [client_id] if client_id else list(islice(list(clients), start, stop))
+  worker_ids: List[str] = [] if client_id and not worker_id else \
+    [worker_id] if worker_id else list(islice(list(workers), start, stop))
 
+  def stream() -> Iterator[str]:
+    yield '{"clients": {'
+    first: bool = True
+    for client_id in client_ids:
+      tasks: Optional[List[Task]] = clients.get(client_id)
+      if tasks is not None:
+        yield ('' if first else ', ') + json.dumps(client_id) + ': ' + \
+          json.dumps([task.to_json() for task in tasks])
+        first = False
+    yield '}, "workers": {'
+    first = True
+    for worker_id in worker_ids:
+      worker: Optional[Worker] = workers.get(worker_id)
+      if worker is not None:
+        yield ('' if first else ', ') + json.dumps(worker_id) + ': ' + \
+          json.dumps(worker.to_json())
+        first = False
+    yield '}}'
 
-@app.route('/worker/program/<task_id>')
-def program(task_id) -> Response:
+  return Response(stream(), mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics() -> Response:
   """
-  Returns a client-submitted program.
+  Returns scheduler metrics in the Prometheus text format.
+  """
+  return Response(render(),
+                  content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/worker/program/<program_id>')
+@REQUEST_DURATION['program'].time
+def program(program_id) -> Response:
+  """
+  Returns a client-submitted program. Programs requested by content hash are
+  immutable and may be cached forever; programs requested by task ID are
+  served with the same ETag but must be revalidated, since a client may
+  resubmit its job.
 
   Args (URL):
-    task_id (str): Task's ID: {client_id}~{vertex_id}~{worker_id}.
+    program_id (str): Program's ID, or a task's ID:
+      {client_id}~{vertex_id}~{worker_id}.
 
   Returns:
-    A JavaScript file.
+    A JavaScript file, gzip-compressed if the browser accepts it.
   """
   try:
-    client_id, vertex_id, _ = str(task_id).split('~')
-    program: str = clients[client_id][int(vertex_id)]['program']
-    return Response(program, mimetype="text/javascript")
+    immutable: bool = '~' not in program_id
+    if not immutable:
+      client_id, vertex_id, _ = str(program_id).split('~')
+      program_id = vertex_programs[client_id][int(vertex_id)]
+    if 'gzip' in request.accept_encodings:
+      res: Response = Response(programs.get_gzip(program_id),
+                               mimetype='text/javascript')
+      res.headers['Content-Encoding'] = 'gzip'
+      res.set_etag(f'{program_id}-gzip')
+    else:
+      res: Response = Response(programs.get(program_id),
+                               mimetype='text/javascript')
+      res.set_etag(program_id)
+    res.vary.add('Accept-Encoding')
+    if immutable:
+      res.cache_control.public = True
+      res.cache_control.max_age = 31536000
+      res.cache_control.immutable = True
+    else:
+      res.cache_control.no_cache = True
+    return res.make_conditional(request)
   except ValueError:
     abort(400)
   except (KeyError, IndexError):
     abort(404)
 
 
+@app.route('/programs', methods=['POST'])
+def upload() -> Response:
+  """
+  Stores programs for jobs to refer to by ID, so that a client resubmitting
+  a job only uploads the programs that changed (see /programs/missing).
+  Programs no job uses are kept for as long as space allows; see MAX_SPARE.
+
+  Args (JSON):
+    programs (List[str]): JavaScript sources.
+
+  Returns (JSON):
+    program_ids (List[str]): ID of each program (hex SHA-256 of its source),
+      in the same order as the input.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    return jsonify({
+      'program_ids': [programs.add(str(source))
+                      for source in req['programs']],
+    })
+  except TypeError:
+    abort(400)
+  except KeyError:
+    abort(404)
+
+
+@app.route('/programs/missing', methods=['POST'])
+def missing_programs() -> Response:
+  """
+  Finds which programs need to be uploaded before a job can refer to them.
+
+  Args (JSON):
+    program_ids (List[str]): ID's of programs.
+
+  Returns (JSON):
+    missing (List[str]): ID's of the programs that are not stored, in the
+      same order as the input.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    return jsonify({
+      'missing': programs.missing([str(program_id)
+                                   for program_id in req['program_ids']]),
+    })
+  except TypeError:
+    abort(400)
+  except KeyError:
+    abort(404)
+
+
 @app.route('/worker/<path:path>')
 def send_js(path):
   """
@@ -73,18 +308,25 @@ def register() -> Response:
   Registers a worker.
 
   Args (JSON):
-    worker_id (str): ID of worker.
+    worker_id (str): Optional ID of worker. Generated if not given.
     n_cores (int): Number of cores on the worker.
 
   Returns (JSON):
     success (bool): Whether registration succeeded.
+    worker_id (str): ID of worker.
   """
   req: Dict[str, Any] = request.get_json(force=True)
   try:
-    worker_id, n_cores = uuid.uuid1().hex, req['n_cores']
+    worker_id, n_cores = req.get('worker_id') or uuid.uuid1().hex, \
+                         req['n_cores']
     if worker_id in workers:
       abort(403)
-    workers[worker_id] = Worker(worker_id, n_cores, deregister)
+    worker: Worker = Worker(worker_id, n_cores, capacity, reaper, journal)
+    with worker.heartbeat_lock:
+      worker.log()
+    workers[worker_id] = worker
+    capacity.update(worker_id, n_cores)
+    admit()
     return jsonify({
       'success': True,
       'worker_id': worker_id,
@@ -94,75 +336,170 @@ def register() -> Response:
 
 
 @app.route('/heartbeat', methods=['POST'])
+@REQUEST_DURATION['heartbeat'].time
 def heartbeat() -> Response:
   """
-  Processes a heartbeat from a worker.
+  Processes a heartbeat from a worker. Workers either send a full heartbeat
+  listing every still-running task, or a delta heartbeat listing only the tasks
+  that stopped since the last response they applied.
 
   Args (JSON):
     worker_id (str): ID of worker.
-    active_tasks (List[str]): List of ID's of still-running tasks.
+    active_tasks (List[str]): List of ID's of still-running tasks. Full
+      heartbeats only.
+    finished (List[str]): List of ID's of tasks that finished or failed since
+      the last acknowledged response. Delta heartbeats only.
+    ack (int): Sequence number of the last response applied by the worker.
+      Delta heartbeats only.
+    metrics (Dict[str, Dict[str, float]]): Optional runtime metrics per task
+      ID: queue (messages waiting), rate (messages processed per second),
+      time (milliseconds of processing per message), and since the last
+      report, in (records delivered), out (records emitted), and bytes (bytes
+      emitted). Used to prefer lightly loaded workers when placing tasks, and
+      kept for /jobs/<client_id>/stats.
 
   Returns (JSON):
-    new_tasks (List[Task]): List of new tasks for the worker to run.
+    new_tasks (List[Task]): List of new or changed tasks for the worker to run.
+    patches (List[Patch]): New contacts for tasks already running on the
+      worker, each with the keys 'task_id' (str) and 'contacts' (List[str]).
+      Applied after new_tasks. Only present if there are any.
+    seq (int): Sequence number of this response. Delta heartbeats only.
+    interval (float): Seconds the worker should wait before its next
+      heartbeat, counted from when it sent this one. Workers that are lost
+      expire after several such intervals; see pacer.py and reaper.py.
   """
   req: Dict[str, Any] = request.get_json(force=True)
   try:
-    worker_id, active_tasks = req['worker_id'], req['active_tasks']
-    return jsonify({
-      'new_tasks': workers[worker_id].heartbeat(active_tasks),
-    })
+    worker: Optional[Worker] = workers.get(req['worker_id'])
+    if worker is None:
+      reaper.late(req['worker_id'])
+      abort(404)
+    metrics: Optional[Dict[str, Dict[str, float]]] = req.get('metrics')
+    observe(worker, metrics)
+    if 'active_tasks' in req:
+      new_tasks, patches = worker.heartbeat(req['active_tasks'], metrics)
+      reclaim(worker.worker_id)
+      admit()
+      return jsonify(heartbeat_response(worker, new_tasks, patches))
+    seq, new_tasks, patches = worker.heartbeat_delta(
+      req.get('finished', []), int(req.get('ack', 0)), metrics)
+    reclaim(worker.worker_id)
+    admit()
+    return jsonify(heartbeat_response(worker, new_tasks, patches, seq))
+  except (AttributeError, TypeError, ValueError):
+    abort(400)
   except KeyError:
     abort(404)
 
 
+def observe(worker: Worker,
+            metrics: Optional[Dict[str, Dict[str, float]]]):
+  """
+  Adds a worker's task metrics to the telemetry of their jobs, before the
+  heartbeat retires tasks that finished. Metrics of tasks that the worker was
+  not given are ignored.
+
+  Args:
+    worker (Worker): Worker.
+    metrics (Optional[Dict[str, Dict[str, float]]]): Task metrics, if any;
+      see /heartbeat.
+  """
+  if not isinstance(metrics, dict):
+    return
+  for task_id, task_metrics in metrics.items():
+    task: Optional[Task] = worker.active_tasks.get(task_id) or \
+                           worker.pending_tasks.get(task_id)
+    if task is not None:
+      telemetry.record(task.client_id, task.vertex_id, task_metrics)
+
+
+def heartbeat_response(worker: Worker, new_tasks: List[Dict[str, Any]],
+                       patches: List[Dict[str, Any]],
+                       seq: Optional[int] = None) -> Dict[str, Any]:
+  """
+  Returns:
+    (Dict[str, Any]): Response to /heartbeat from the worker.
+  """
+  res: Dict[str, Any] = {'new_tasks': new_tasks}
+  if seq is not None:
+    res = {'seq': seq, **res}
+  if patches:
+    res['patches'] = patches
+  res['interval'] = pace(worker)
+  return res
+
+
+def pace(worker: Worker) -> float:
+  """
+  Decides when a worker should next heartbeat, and tells the reaper to expect
+  it then.
+
+  Args:
+    worker (Worker): Worker.
+
+  Returns:
+    (float): Seconds until the worker's next heartbeat.
+  """
+  interval: float = pacer.pace(
+    len(workers), bool(worker.active_tasks or worker.pending_tasks),
+    bool(admissions))
+  reaper.expect(worker.worker_id, interval)
+  return interval
+
+
 @app.route('/allocate', methods=['POST'])
+@REQUEST_DURATION['allocate'].time
 def allocate() -> Response:
   """
-  Allocates workers for a new job.
+  Allocates workers for a new job, or for each of several jobs.
 
   Args (JSON):
     client_id (str): ID of client.
     new_tasks (List[NewTask]): Ordered list of vertices to allocate resources
       for. Each NewTask shall contain the keys 'program' (str) and 'contacts'
-      (List[int] of task indices that this task should be able to contact).
+      (List[int] of task indices that this task should be able to contact),
+      and may contain 'weights' (List[float], the relative traffic on each
+      contact edge; 1 by default), 'parallelism' (int, the number of
+      instances of the vertex to run; 1 by default), and 'partition' (str,
+      how records sent to the vertex are split among its instances:
+      'round_robin' by default, or 'hash' to route them by key). Instead of
+      'program', a NewTask may give 'program_id' (str), the ID of a program
+      uploaded to /programs; unknown ID's are a 404.
+    placement (str): 'greedy' (default) fills workers in vertex order;
+      'locality' partitions the job graph to keep heavily connected vertices
+      on the same worker.
+    wire (str): 'json' (default) or 'binary', the encoding of data sent
+      between the job's tasks.
+    queue (bool): If the job does not fit yet, queue it until it does instead
+      of returning no tasks. Optional; false by default.
+    jobs (List[Job]): Submits several jobs at once instead, each with the keys
+      above. placement, wire, and queue given alongside jobs apply to every
+      job that does not set them. Every job is checked before any is
+      allocated.
 
   Returns (JSON):
     task_ids (List[str]): Task ID's for each allocation, in the same order as
-      the input. Empty if not enough resources.
+      the input, with one per instance of data-parallel vertices. Empty if
+      not enough resources.
+    cut_edges (int): Number of contact edges between tasks on different
+      workers.
+    queued (bool): Whether the job was queued. Only present if so.
+    position (int): Number of jobs queued ahead of it. Only present if queued.
+    jobs (List[Dict[str, Any]]): The above for each job, if jobs were given.
   """
   req: Dict[str, Any] = request.get_json(force=True)
   try:
-    client_id, new_tasks = req['client_id'], req['new_tasks']
-
-    # Allocate new tasks.
-    tasks: List[Task] = []
-    for worker_id, worker in workers.items():
-      worker.heartbeat_lock.acquire()
-      while len(tasks) < len(new_tasks) and worker.availability() > 0:
-        tasks.append(Task(client_id, len(tasks), worker_id,
-                          new_tasks[len(tasks)]['program'], []))
-        worker['pending_tasks'].append(tasks[-1])
-
-    # Undo if not enough resources.
-    if len(tasks) < len(new_tasks):
-      for task in tasks:
-        worker[task['worker_id']]['pending_tasks'].remove(task)
-      tasks = []
-
-    # Update contact lists.
-    else:
-      for task in tasks:
-        task['contacts'] = [tasks[contact_id]['task_id']
-          for contact_id in new_tasks[task['vertex_id']]['contacts']]
-
-    # Finalize.
-    clients[client_id] = tasks
-    for worker in workers.values():
-      worker.heartbeat_lock.release()
-
+    if 'jobs' not in req:
+      return jsonify(submit(Submission(req, programs.get)))
+    defaults: Dict[str, Any] = {key: req[key] for key in
+                                ('placement', 'wire', 'queue') if key in req}
+    jobs: List[Submission] = [Submission({**defaults, **job}, programs.get)
+                              for job in req['jobs']]
     return jsonify({
-      'task_ids': [task['task_id'] for task in tasks],
+      'jobs': [submit(job) for job in jobs],
     })
+  except (IndexError, TypeError, ValueError):
+    abort(400)
   except KeyError:
     abort(404)
 
@@ -174,71 +511,791 @@ def allocation() -> Response:
 
   Args (GET):
     client_id (str): ID of client.
+    wait (float): Seconds to hold the request open while the client's job is
+      queued. Optional; at most MAX_WAIT.
 
   Returns (JSON):
     task_ids (List[str]): Task ID's for each allocation, in the same order as
-      the original input. Empty if not enough resources.
+      the original input. Empty if not enough resources or still queued.
+    queued (bool): Whether the client's job is still queued. Only present if
+      so.
+    position (int): Number of jobs queued ahead of it. Only present if queued.
   """
   try:
     client_id: str = str(request.args.get('client_id'))
-    return jsonify({
-      'task_ids': [task['task_id'] for task in clients[client_id]],
-    })
+    wait: float = min(float(request.args.get('wait', 0)), MAX_WAIT)
+    if wait > 0 and client_id in admissions:
+      woken: Event = Event()
+      with admitted.subscribe(client_id, woken.set):
+        if client_id in admissions:
+          woken.wait(wait)
+    return jsonify(status(client_id))
   except ValueError:
     abort(400)
   except KeyError:
     abort(404)
 
 
-def deregister(worker_id: str):
-  print(f'Deregistering {worker_id}.')
-  dead = workers.pop(worker_id)
-  realloc: List[Task] = dead['active_tasks'] + dead['pending_tasks']
-
-  # Reallocate tasks.
-  i: int = 0
-  for worker_id, worker in workers.items():
-    worker.heartbeat_lock.acquire()
-    while i < len(realloc) and worker.availability() > 0:
-      realloc[i]['task_id_old'] = realloc[i]['task_id']
-      client_id, vertex_id, _ = realloc[i]['task_id_old'].split('~')
-      realloc[i]['task_id'] = f'{client_id}~{vertex_id}~{worker_id}'
-      realloc[i]['worker_id'] = worker_id
-      worker['pending_tasks'].append(realloc[i])
-      i += 1
-
-  # Cancel jobs if not enough resources. (Stops outgoing tasks but doesn't kill
-  # already-active tasks. They'll have to die on their own.)
-  if i < len(realloc):
-    for client_id in set(task['client_id'] for task in realloc):
-      for task in clients[client_id]:
-        try:
-          if task['cancel']:
-            continue  # already cancelled
-          elif task in workers[task['worker_id']]['pending_tasks']:
-            workers[task['worker_id']]['pending_tasks'].remove(task)
-          elif task in workers[task['worker_id']]['active_tasks']:
-            workers[task['worker_id']]['active_tasks'].remove(task)
-            task['cancel'] = True
-            workers[task['worker_id']]['pending_tasks'].append(task)
-        except KeyError:
-          pass
-      clients[client_id] = []
-
-  # Update contact lists.
-  else:
-    realloc_map: Dict[Tuple[str, int], str] =\
-      {task['task_id_old']: task['task_id'] for task in realloc}
-    for client in clients.values():
-      for task in client:
-        for i, contact in enumerate(task['contacts']):
-          if contact in realloc_map:
-            task['contacts'][i] = realloc_map[contact]
-            task['update'] = True
-        if task['update'] and task in workers[task['worker_id']]['active_tasks']:
-          workers[task['worker_id']]['active_tasks'].remove(task)
-          workers[task['worker_id']]['pending_tasks'].append(task)
-
-  # Finalize.
-  for worker in workers.values():
+@app.route('/jobs/<client_id>/stats')
+def job_stats(client_id) -> Response:
+  """
+  Returns a job's stream telemetry, built from the metrics its tasks' workers
+  report, to find the vertex holding the pipeline back.
+
+  Args (URL):
+    client_id (str): ID of client.
+
+  Returns (JSON):
+    bucket (float): Seconds covered by each bucket of a series.
+    window (float): Seconds of complete buckets that the rates cover.
+    vertices (List[VertexStats]): Telemetry of each of the job's tasks, with
+      the keys 'vertex_id' (int), 'in_rate' and 'out_rate' (records per
+      second delivered to and emitted by the task), 'byte_rate' (bytes
+      emitted per second), 'queue' (deepest input queue reported),
+      'utilization' (fraction of a core spent processing), 'time'
+      (milliseconds of processing per record; only present if measured), and
+      'series' (List[Bucket], oldest first, each with the keys 'start' (float,
+      Unix time), 'in', 'out', 'bytes', 'queue', and 'time' as above but
+      summed over the bucket).
+    bottleneck (int): vertex_id of the busiest task, or of the one with the
+      deepest queue if none was timed. Only present once there is traffic.
+  """
+  try:
+    return jsonify(telemetry.stats(
+      client_id, [task.vertex_id for task in clients[client_id]]))
+  except KeyError:
+    abort(404)
+
+
+def status(client_id: str) -> Dict[str, Any]:
+  """
+  Args:
+    client_id (str): ID of client.
+
+  Returns:
+    (Dict[str, Any]): The client's allocation, as returned by /allocation.
+
+  Raises:
+    KeyError: If the client has no job.
+  """
+  res: Dict[str, Any] = {
+    'task_ids': [task.task_id for task in clients[client_id]],
+  }
+  try:
+    res['position'] = admissions.position(client_id)
+    res['queued'] = True
+  except ValueError:
+    pass
+  return res
+
+
+def submit(job: Submission) -> Dict[str, Any]:
+  """
+  Allocates workers for a job if it fits, and otherwise queues it if asked
+  to. Either way, the job replaces any job the client had. Jobs are not
+  placed ahead of a queued job that has been passed over too often.
+
+  Args:
+    job (Submission): Job.
+
+  Returns:
+    (Dict[str, Any]): Response to /allocate.
+  """
+  placed: Optional[Tuple[List[Task], int]] = \
+    None if admissions.blocked() else place(job)
+  if placed is not None:
+    admissions.remove(job.client_id)
+    if admissions:
+      admissions.bypass()
+    admitted.notify(job.client_id)
+    return {
+      'task_ids': [task.task_id for task in placed[0]],
+      'cut_edges': placed[1],
+    }
+  if not job.queue:
+    admissions.remove(job.client_id)
+  replace(job.client_id, [])
+  if not job.queue:
+    return {
+      'task_ids': [],
+      'cut_edges': 0,
+    }
+  return {
+    'task_ids': [],
+    'cut_edges': 0,
+    'queued': True,
+    'position': admissions.push(job),
+  }
+
+
+def admit():
+  """
+  Allocates workers for queued jobs that fit now, oldest first. A job that
+  does not fit yet is passed over by later jobs that do, until it has been
+  passed over MAX_BYPASS times. Called whenever cores may have been freed;
+  returns at once if another thread is already admitting jobs, since that
+  thread's heartbeat, or the next one, will see the freed cores.
+  """
+  if not admissions or not admissions.admitting.acquire(blocking=False):
+    return
+  try:
+    skipped: bool = False
+    for job in admissions.waiting():
+      if skipped and admissions.blocked():
+        break
+      if capacity.free < admissions.min_size:
+        break
+      placed: Optional[Tuple[List[Task], int]] = \
+        place(job) if len(job) <= capacity.free else None
+      if placed is None:
+        skipped = True
+        continue
+      admissions.remove(job.client_id, job)
+      if skipped:
+        admissions.bypass()
+      admitted.notify(job.client_id)
+  finally:
+    admissions.admitting.release()
+
+
+def place(job: Submission) -> Optional[Tuple[List[Task], int]]:
+  """
+  Allocates workers for a job, but only if all of its tasks fit. If they do,
+  the job replaces any job the client had.
+
+  Args:
+    job (Submission): Job.
+
+  Returns:
+    (Optional[Tuple[List[Task], int]]): The job's tasks and number of cut
+      contact edges, or None if the job does not fit.
+  """
+  reserved: List[Worker] = reserve(len(job))
+  try:
+    capacities: List[int] = [worker.availability() for worker in reserved]
+    if sum(capacities) < len(job):
+      return None
+    contacts, weights = job.expand()
+    if job.placement == 'locality':
+      assignment: List[int] = placement.locality(contacts, capacities,
+                                                 weights)
+    else:
+      assignment: List[int] = placement.greedy(len(job), capacities)
+    tasks: List[Task] = []
+    for vertex_id, vertex in enumerate(job.vertices()):
+      tasks.append(Task(job.client_id, vertex_id,
+                        reserved[assignment[vertex_id]].worker_id,
+                        programs.put(job.sources[vertex]), [], job.wire,
+                        job.partition(vertex)))
+    for task in tasks:
+      task.contacts = [tasks[contact_id].task_id
+                       for contact_id in contacts[task.vertex_id]]
+      reserved[assignment[task.vertex_id]].enqueue(task)
+    replace(job.client_id, tasks)
+    for worker in reserved:
+      worker.log()
+    pacer.churn()
+    return tasks, placement.cut_edges(contacts, assignment)
+  finally:
+    release(reserved)
+
+
+def replace(client_id: str, tasks: List[Task]):
+  """
+  Makes a client's job consist of the given tasks, letting go of the programs
+  of its old tasks.
+
+  Args:
+    client_id (str): ID of client.
+    tasks (List[Task]): New tasks.
+  """
+  let_go(clients.get(client_id, []))
+  clients[client_id] = tasks
+  dependents[client_id] = index_dependents(tasks)
+  vertex_programs[client_id] = index_programs(tasks)
+  telemetry.forget(client_id)
+  log_job(client_id)
+
+
+def let_go(tasks: List[Task]):
+  """
+  Lets go of the programs of tasks that were replaced. Tasks whose worker is
+  still registered keep their program until they leave it, since the worker
+  may not have fetched it yet; see reclaim(). Takes no worker locks.
+
+  Args:
+    tasks (List[Task]): Replaced tasks.
+  """
+  for task in tasks:
+    if task.worker_id in workers:
+      with retiring_lock:
+        retiring.setdefault(task.worker_id, []).append(task)
+    else:
+      programs.release(task.program_id)
+
+
+def reclaim(worker_id: str):
+  """
+  Releases the programs of replaced tasks that have left a worker, or of all
+  of them if the worker is gone. Called after the worker's heartbeats, and
+  when it is deregistered.
+
+  Args:
+    worker_id (str): ID of worker.
+  """
+  if worker_id not in retiring:
+    return
+  with retiring_lock:
+    tasks: List[Task] = retiring.pop(worker_id, [])
+  worker: Optional[Worker] = workers.get(worker_id)
+  kept: List[Task] = []
+  gone: List[Task] = tasks
+  if worker is not None:
+    with worker.heartbeat_lock:
+      gone = []
+      for task in tasks:
+        hosted: bool = worker.pending_tasks.get(task.task_id) is task or \
+                       worker.active_tasks.get(task.task_id) is task
+        (kept if hosted else gone).append(task)
+  for task in gone:
+    programs.release(task.program_id)
+  if kept:
+    with retiring_lock:
+      retiring.setdefault(worker_id, []).extend(kept)
+
+
+def reserve(n_slots: int) -> List[Worker]:
+  """
+  Takes the workers with the most free cores out of the capacity index and
+  locks them, until they cover the requested number of slots or no capacity
+  is left. Only the returned workers are locked.
+
+  Only the first lock is waited for, since no other is held yet. Workers
+  whose lock is busy after that are passed over and put back in the index,
+  so that two threads reserving at once cannot wait on each other. A worker
+  that a heartbeat put back in the index while we waited for its lock is
+  not reserved twice.
+
+  Args:
+    n_slots (int): Number of free cores wanted.
+
+  Returns:
+    (List[Worker]): Locked workers, most free cores first. Must be handed
+      back via release().
+  """
+  reserved: List[Worker] = []
+  reserved_ids: Set[str] = set()
+  busy: List[Worker] = []
+  while n_slots > 0:
+    worker_id: Optional[str] = capacity.pop()
+    if worker_id is None:
+      break
+    worker: Optional[Worker] = workers.get(worker_id)
+    if worker is None or worker_id in reserved_ids:
+      continue
+    if not worker.heartbeat_lock.acquire(blocking=not reserved):
+      busy.append(worker)
+      continue
+    if workers.get(worker_id) is not worker:
+      worker.heartbeat_lock.release()  # deregistered while we waited
+      continue
+    reserved.append(worker)
+    reserved_ids.add(worker_id)
+    n_slots -= worker.availability()
+  # Whoever holds a busy worker's lock reindexes it if its cores change, so
+  # an unlocked read of its availability is good enough here.
+  for worker in busy:
+    if workers.get(worker.worker_id) is worker:
+      capacity.update(worker.worker_id, worker.availability(), worker.load)
+  return reserved
+
+
+def release(reserved: List[Worker]):
+  """
+  Returns reserved workers to the capacity index, unlocks them, and wakes any
+  of them that are waiting for tasks.
+
+  Args:
+    reserved (List[Worker]): Workers returned by reserve().
+  """
+  for worker in reserved:
+    worker.reindex()
     worker.heartbeat_lock.release()
+    if worker.pending_tasks:
+      subscriptions.notify(worker.worker_id)
+
+
+def index_programs(tasks: List[Task]) -> Dict[int, str]:
+  """
+  Builds the program index for one job. Moving a task keeps its vertex index
+  and program, so the index only changes with the job's set of tasks.
+
+  Args:
+    tasks (List[Task]): The job's tasks.
+
+  Returns:
+    (Dict[int, str]): Maps each vertex index to its program's ID.
+  """
+  return {task.vertex_id: task.program_id for task in tasks}
+
+
+def index_dependents(tasks: List[Task]) -> Dict[int, List[Task]]:
+  """
+  Builds the reverse-dependency index for one job.
+
+  Args:
+    tasks (List[Task]): The job's tasks.
+
+  Returns:
+    (Dict[int, List[Task]]): Maps each vertex index to the tasks that contact
+      it.
+  """
+  index: Dict[int, List[Task]] = {}
+  for task in tasks:
+    for vertex_id in set(int(contact.split('~')[1])
+                         for contact in task.contacts):
+      index.setdefault(vertex_id, []).append(task)
+  return index
+
+
+@DEREGISTER_DURATION.time
+def deregister(*worker_ids: str):
+  """
+  Deregisters workers and reallocates their tasks. Workers that expire
+  together are deregistered as one batch, so that none of their tasks are
+  moved onto a worker that is also going away.
+
+  Args:
+    worker_ids (str): ID's of workers.
+  """
+  realloc: List[Task] = []
+  for worker_id in worker_ids:
+    print(f'Deregistering {worker_id}.')
+    dead: Optional[Worker] = workers.get(worker_id)
+    if dead is None:
+      continue
+    with dead.heartbeat_lock:
+      workers.pop(worker_id)
+      capacity.remove(worker_id)
+      reaper.forget(worker_id)
+      if journal is not None:
+        journal.append({'op': 'drop', 'worker_id': worker_id})
+    # Copies of tasks being migrated that are not (or no longer) part of
+    # their job are dropped rather than moved; see advance().
+    realloc += [task for task in dead.tasks() if not task.cancel and
+                any(task is live for live in clients.get(task.client_id, []))]
+    reclaim(worker_id)
+    DEREGISTRATIONS.inc()
+    pacer.churn()
+  reallocate(realloc)
+  admit()
+
+
+def reallocate(realloc: List[Task]):
+  """
+  Moves tasks off workers that are gone, then points the tasks that contact
+  them at their new IDs. Tasks are only moved if all of them fit; otherwise
+  each affected job is handed to on_orphaned(), if set, or cancelled.
+
+  Args:
+    realloc (List[Task]): Tasks whose worker is gone.
+  """
+  moves: Dict[str, Dict[str, str]] = {}
+  reserved: List[Worker] = reserve(len(realloc))
+  placed: bool = \
+    sum(worker.availability() for worker in reserved) >= len(realloc)
+  if placed:
+    i: int = 0
+    for worker in reserved:
+      while i < len(realloc) and worker.availability() > 0:
+        realloc[i].task_id_old = realloc[i].task_id
+        client_id, vertex_id, _ = realloc[i].task_id_old.split('~')
+        worker_id = worker.worker_id
+        realloc[i].task_id = f'{client_id}~{vertex_id}~{worker_id}'
+        realloc[i].worker_id = worker_id
+        worker.enqueue(realloc[i])
+        moves.setdefault(client_id, {})[realloc[i].task_id_old] = \
+          realloc[i].task_id
+        i += 1
+    REALLOCATIONS.inc(len(realloc))
+  for worker in reserved:
+    worker.log()
+  release(reserved)
+
+  # Hand jobs to other shards, or cancel them, if not enough resources.
+  if not placed:
+    for client_id in set(task.client_id for task in realloc):
+      orphans: List[Task] = [task for task in realloc
+                             if task.client_id == client_id]
+      handed: Optional[Dict[str, str]] = \
+        on_orphaned(client_id, orphans) if on_orphaned else None
+      if handed is None:
+        cancel(client_id)
+        if on_cancelled:
+          on_cancelled(client_id)
+        continue
+      gone: Set[str] = set(handed)
+      for task in orphans:
+        programs.release(task.program_id)
+      clients[client_id] = [task for task in clients.get(client_id, [])
+                            if task.task_id not in gone]
+      dependents[client_id] = index_dependents(clients[client_id])
+      vertex_programs[client_id] = index_programs(clients[client_id])
+      moves[client_id] = handed
+
+  for client_id, moved in moves.items():
+    rewire(client_id, moved)
+    log_job(client_id)
+    if on_moved:
+      on_moved(client_id, moved)
+
+
+def cancel(client_id: str):
+  """
+  Cancels a client's job. (Stops outgoing tasks but doesn't kill
+  already-active tasks. They'll have to die on their own.)
+
+  Args:
+    client_id (str): ID of client.
+  """
+  for task in clients.get(client_id, []):
+    stop(task)
+  for task in clients.get(client_id, []):
+    programs.release(task.program_id)
+  clients[client_id] = []
+  dependents.pop(client_id, None)
+  vertex_programs.pop(client_id, None)
+  telemetry.forget(client_id)
+  log_job(client_id)
+  CANCELLATIONS.inc()
+
+
+def stop(task: Task):
+  """
+  Stops a task on its worker: unsent tasks are dropped, and running ones are
+  resent with their cancel flag set.
+
+  Args:
+    task (Task): Task.
+  """
+  worker: Optional[Worker] = workers.get(task.worker_id)
+  if worker is None:
+    return
+  with worker.heartbeat_lock:
+    if task.cancel:
+      return  # already cancelled
+    elif worker.discard(task) == 'active_tasks':
+      task.cancel = True
+      worker.enqueue(task)
+    worker.reindex()
+    worker.log()
+  subscriptions.notify(worker.worker_id)
+
+
+def rewire(client_id: str, moves: Dict[str, str]):
+  """
+  Updates the contact lists of a job's tasks that contact moved tasks. Tasks
+  that are running are sent just their new contacts, as a patch on their
+  worker's next heartbeat; pending tasks go out with them anyway.
+
+  Args:
+    client_id (str): ID of client.
+    moves (Dict[str, str]): Maps old task ID's to new ones.
+  """
+  for old, new in moves.items():
+    vertex_id: int = int(old.split('~')[1])
+    for task in dependents.get(client_id, {}).get(vertex_id, []):
+      worker: Optional[Worker] = workers.get(task.worker_id)
+      if worker is None:
+        continue
+      with worker.heartbeat_lock:
+        patched: bool = False
+        for i, contact in enumerate(task.contacts):
+          if contact == old:
+            task.contacts[i] = new
+            patched = True
+        if patched:
+          if task.task_id in worker.active_tasks:
+            worker.patch(task)
+          worker.log()
+      if patched:
+        subscriptions.notify(worker.worker_id)
+
+
+def rebalance():
+  """
+  Runs one rebalancing pass: advances the migrations in flight, then starts
+  moving tasks off overloaded workers onto the least loaded worker with a
+  free core, as long as it is lightly loaded.
+  """
+  now: float = rebalancer.clock()
+  for key, migration in list(rebalancer.migrations.items()):
+    if advance(migration, now):
+      del rebalancer.migrations[key]
+  for source, task in rebalancer.plan(list(workers.values())):
+    if task.task_id not in source.active_tasks:
+      continue  # finished meanwhile
+    reserved: List[Worker] = reserve(1)
+    try:
+      if not reserved or reserved[0] is source or \
+         reserved[0].load > LOW_LOAD:
+        break
+      target: Worker = reserved[0]
+      new: Task = Task(task.client_id, task.vertex_id, target.worker_id,
+                       programs.put(programs.get(task.program_id)),
+                       list(task.contacts), task.wire, task.partition)
+      new.task_id_old = task.task_id
+      target.enqueue(new)
+      target.log()
+      rebalancer.migrations[f'{task.client_id}~{task.vertex_id}'] = \
+        Migration(task, new, now)
+      MIGRATIONS.inc()
+    finally:
+      release(reserved)
+
+
+def advance(migration: Migration, now: float) -> bool:
+  """
+  Moves a migration along: switches over to the new copy once its worker has
+  acknowledged it, and stops the old copy once it has drained. A migration is
+  abandoned if the copy it is moving away from stops being part of the job,
+  e.g. because the job was cancelled or the copy was lost with its worker.
+
+  Args:
+    migration (Migration): Migration in flight.
+    now (float): Current time, as given by the rebalancer's clock.
+
+  Returns:
+    (bool): Whether the migration is over.
+  """
+  old, new = migration.old, migration.new
+  tasks: List[Task] = clients.get(old.client_id, [])
+  if migration.switched is None:
+    source: Optional[Worker] = workers.get(old.worker_id)
+    target: Optional[Worker] = workers.get(new.worker_id)
+    if not any(task is old for task in tasks) or source is None or \
+       old.task_id not in source.active_tasks or target is None or \
+       now - migration.started > MAX_START:
+      return retire(new)
+    with target.heartbeat_lock:
+      started: bool = new.task_id in target.active_tasks and \
+        not any(sent['task_id'] == new.task_id for sent in target.unacked)
+      if started and new.contacts != old.contacts:
+        new.contacts = list(old.contacts)  # rewired meanwhile
+        target.patch(new)
+        target.log()
+    if not started:
+      return False
+
+    # Switch over: the new copy takes the old one's place, and upstream tasks
+    # are patched to send to it.
+    tasks[next(i for i, task in enumerate(tasks) if task is old)] = new
+    dependents[old.client_id] = index_dependents(tasks)
+    moves: Dict[str, str] = {old.task_id: new.task_id}
+    rewire(old.client_id, moves)
+    log_job(old.client_id)
+    if on_moved:
+      on_moved(old.client_id, moves)
+    migration.switched = now
+    return False
+
+  if not any(task is new for task in tasks):
+    return retire(old)
+  source: Optional[Worker] = workers.get(old.worker_id)
+  if source is None:
+    return retire(old)
+  backlog: float = float(source.metrics.get(old.task_id, {}).get('queue', 0))
+  if now - migration.switched >= MAX_DRAIN or \
+     (now - migration.switched >= DRAIN and backlog <= 0):
+    return retire(old)
+  return False
+
+
+def retire(task: Task) -> bool:
+  """
+  Stops the copy of a migrated task that is not part of its job.
+
+  Args:
+    task (Task): Task.
+
+  Returns:
+    (bool): True, since the migration is over.
+  """
+  stop(task)
+  programs.release(task.program_id)
+  return True
+
+
+def log_job(client_id: str):
+  """
+  Logs a client's job to the journal, if any.
+
+  Args:
+    client_id (str): ID of client.
+  """
+  if journal is not None:
+    journal.append({
+      'op': 'job',
+      'client_id': client_id,
+      'tasks': [task.to_record() for task in clients.get(client_id, [])],
+    })
+
+
+def capture() -> Iterator[Dict[str, Any]]:
+  """
+  Describes the whole scheduler state as journal records, for snapshots.
+
+  Returns:
+    (Iterator[Dict[str, Any]]): Program, worker, job, and queue records.
+  """
+  for program_id, source in list(programs.programs.items()):
+    yield {'op': 'program', 'program_id': program_id, 'source': source}
+  for worker in list(workers.values()):
+    with worker.heartbeat_lock:
+      if workers.get(worker.worker_id) is not worker:
+        continue  # deregistered meanwhile
+      record: Dict[str, Any] = worker.to_record()
+    yield record
+  for client_id, tasks in list(clients.items()):
+    yield {
+      'op': 'job',
+      'client_id': client_id,
+      'tasks': [task.to_record() for task in list(tasks)],
+    }
+  for job in admissions.waiting():
+    yield {'op': 'queue', 'client_id': job.client_id, 'job': job.to_json()}
+
+
+def restore(records: Iterator[Dict[str, Any]]):
+  """
+  Rebuilds scheduler state from journal records. The last record about each
+  worker, job, queued job, or program wins. Restored workers keep their
+  sequence numbers, so their heartbeat sessions carry on: a worker whose idle
+  heartbeats went unlogged acknowledges a later sequence number than the
+  restored one, which still clears its unacknowledged tasks, since every
+  response up to then resent them.
+
+  Args:
+    records (Iterator[Dict[str, Any]]): Output of Journal.replay().
+  """
+  sources: Dict[str, str] = {}
+  worker_records: Dict[str, Dict[str, Any]] = {}
+  job_records: Dict[str, List[Dict[str, Any]]] = {}
+  queue_records: Dict[str, Dict[str, Any]] = {}
+  for record in records:
+    if record['op'] == 'program':
+      sources[record['program_id']] = record['source']
+    elif record['op'] == 'worker':
+      worker_records[record['worker_id']] = record
+    elif record['op'] == 'drop':
+      worker_records.pop(record['worker_id'], None)
+    elif record['op'] == 'job':
+      job_records[record['client_id']] = record['tasks']
+    elif record['op'] == 'queue':
+      queue_records.pop(record['client_id'], None)
+      if record['job'] is not None:
+        queue_records[record['client_id']] = record['job']
+
+  # Tasks are shared between their job and their worker's queues. Worker
+  # records are logged under the lock guarding their tasks, so their copy
+  # wins.
+  tasks: Dict[str, Task] = {}
+  for record in worker_records.values():
+    for task in record['active_tasks'] + record['pending_tasks']:
+      tasks[task[0]] = Task.from_record(task)
+  for client_id, job in job_records.items():
+    clients[client_id] = [tasks.get(task[0]) or Task.from_record(task)
+                          for task in job]
+    for task in clients[client_id]:
+      if task.program_id in sources:
+        programs.put(sources[task.program_id])
+    dependents[client_id] = index_dependents(clients[client_id])
+    vertex_programs[client_id] = index_programs(clients[client_id])
+
+  for worker_id, record in worker_records.items():
+    worker: Worker = Worker(worker_id, record['n_cores'], capacity, reaper,
+                            journal)
+    worker.seq = record['seq']
+    worker.unacked = record['unacked']
+    worker.patches = record['patches']
+    for task in record['active_tasks']:
+      worker.active_tasks[task[0]] = tasks[task[0]]
+    for task in record['pending_tasks']:
+      worker.pending_tasks[task[0]] = tasks[task[0]]
+    workers[worker_id] = worker
+
+  # Copies of migrating tasks are not part of their job. Stop them; the
+  # rebalancer moves the tasks again if it still needs to.
+  live: Set[int] = {id(task) for job in clients.values() for task in job}
+  for worker in workers.values():
+    for task in worker.tasks():
+      if not task.cancel and id(task) not in live and \
+         worker.discard(task) == 'active_tasks':
+        task.cancel = True
+        worker.enqueue(task)
+    worker.reindex()
+
+  for job in queue_records.values():
+    admissions.push(Submission(job))
+
+
+def open_journal(path: str):
+  """
+  Enables persistence: restores any state saved in a directory, then logs
+  every later state change there.
+
+  Args:
+    path (str): State directory.
+  """
+  global journal
+  opened: Journal = Journal(path, capture)
+  start: float = time.perf_counter()
+  restore(opened.replay())
+  print(f'Restored {len(workers)} workers and {len(clients)} jobs from '
+        f'{path} in {time.perf_counter() - start:.2f}s.')
+  journal = opened
+  for worker in workers.values():
+    worker.journal = journal
+  programs.added = lambda program_id, source: journal.append({
+    'op': 'program', 'program_id': program_id, 'source': source,
+  })
+  admissions.changed = lambda client_id, job: journal.append({
+    'op': 'queue', 'client_id': client_id,
+    'job': None if job is None else job.to_json(),
+  })
+  journal.start()
+
+
+def reset():
+  """
+  Clears all scheduler state and stops persisting it. Used by tests and tools
+  that drive the scheduler in-process.
+  """
+  global journal
+  if journal is not None:
+    journal.close()
+    journal = None
+  workers.clear()
+  clients.clear()
+  dependents.clear()
+  vertex_programs.clear()
+  retiring.clear()
+  programs.__init__()
+  capacity.__init__()
+  admissions.__init__()
+  rebalancer.migrations.clear()
+  telemetry.jobs.clear()
+  pacer.churned = -inf
+  with reaper.lock:
+    reaper.last_seen.clear()
+    reaper.arrivals.clear()
+    reaper.expired.clear()
+    reaper.filed.clear()
+    reaper.held.clear()
+    reaper.tick = reaper.to_tick(reaper.clock())
+
+
+if os.environ.get('SCHEDULER_STATE_DIR'):
+  open_journal(os.environ['SCHEDULER_STATE_DIR'])
+if os.environ.get('SCHEDULER_REBALANCE'):
+  rebalancer.start()
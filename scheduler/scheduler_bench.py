@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Benchmarks
+
+Drives the scheduler in-process through app.test_client() with synthetic
+workers and jobs, and reports throughput, p50/p99 latency, and heartbeat lock
+contention for each operation. Allocation and deregistration are timed while
+other threads send heartbeats, as they would in a live cluster. Results are
+written as JSON so that runs from different versions can be compared.
+
+With --shards, it also starts the sharded scheduler (coordinator.py) with
+each given number of shards, and measures heartbeat throughput over HTTP from
+one load-generating process per shard. Load generators share the machine with
+the shards, so leave spare cores.
+
+Usage:
+  python scheduler_bench.py [--sizes 100 1000 10000] [--shards 1 2 4]
+                            [--output FILE] [--compare BASELINE]
+                            [--tolerance 0.2]
+"""
+
+from scheduler import app, clients, deregister, reset, workers
+from task import Worker
+from multiprocessing import Pool
+from threading import Event, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import argparse
+import json
+import os
+import platform
+import random
+import requests
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Cores per synthetic worker.
+N_CORES: int = 4
+
+# Vertices per synthetic job (a pipeline).
+JOB_SIZE: int = 4
+
+# Maximum number of timed calls per operation and size.
+MAX_CALLS: int = 10000
+
+# Threads sending heartbeats while allocate and deregister are timed, so that
+# their lock wait reflects contention with the heartbeat path.
+HEARTBEAT_THREADS: int = 4
+
+# Seconds to drive heartbeats against the sharded scheduler.
+SHARDED_DURATION: float = 5.0
+
+def summarize(latencies: List[float], elapsed: float,
+              lock_wait: float) -> Dict[str, float]:
+  """
+  Args:
+    latencies (List[float]): Seconds taken by each call.
+    elapsed (float): Seconds taken by all calls together.
+    lock_wait (float): Seconds spent waiting on heartbeat locks.
+
+  Returns:
+    (Dict[str, float]): Call count, throughput (calls/s), p50 and p99
+      latency (ms), and lock wait (ms).
+  """
+  latencies = sorted(latencies)
+  def percentile(q: float) -> float:
+    return latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0
+  return {
+    'calls': len(latencies),
+    'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+    'p50_ms': percentile(0.50),
+    'p99_ms': percentile(0.99),
+    'lock_wait_ms': lock_wait * 1000,
+  }
+
+
+def lock_wait(tracked: List[Worker]) -> float:
+  """
+  Args:
+    tracked (List[Worker]): Workers to count, including deregistered ones.
+
+  Returns:
+    (float): Total seconds spent waiting on their heartbeat locks.
+  """
+  return sum(worker.heartbeat_lock.wait_time for worker in tracked)
+
+
+def heartbeat_load(worker_ids: List[str], seed: int, stop: Event):
+  """
+  Sends delta heartbeats for random workers until stopped.
+
+  Args:
+    worker_ids (List[str]): Workers to send heartbeats for.
+    seed (int): Seed for picking workers.
+    stop (Event): Set once the timed calls are done.
+  """
+  client = app.test_client()
+  rng: random.Random = random.Random(seed)
+  while not stop.is_set():
+    worker_id: str = rng.choice(worker_ids)
+    worker: Optional[Worker] = workers.get(worker_id)
+    client.post('/heartbeat', data=json.dumps({
+      'worker_id': worker_id,
+      'ack': worker.seq if worker else 0,
+    }))
+
+
+def measure(calls: List[Callable[[], Any]],
+            heartbeats: Optional[List[str]] = None) -> Dict[str, float]:
+  """
+  Times a list of calls, one after the other, optionally while
+  HEARTBEAT_THREADS threads send heartbeats. Lock wait covers all threads.
+
+  Args:
+    calls (List[Callable[[], Any]]): Calls to time.
+    heartbeats (Optional[List[str]]): Workers to send heartbeats for
+      meanwhile, if any.
+
+  Returns:
+    (Dict[str, float]): See summarize().
+  """
+  latencies: List[float] = []
+  tracked: List[Worker] = list(workers.values())
+  wait: float = lock_wait(tracked)
+  stop: Event = Event()
+  threads: List[Thread] = [
+    Thread(target=heartbeat_load, args=(heartbeats, i, stop), daemon=True)
+    for i in range(HEARTBEAT_THREADS if heartbeats else 0)]
+  for thread in threads:
+    thread.start()
+  start: float = perf_counter()
+  try:
+    for call in calls:
+      t: float = perf_counter()
+      call()
+      latencies.append(perf_counter() - t)
+  finally:
+    elapsed: float = perf_counter() - start
+    stop.set()
+    for thread in threads:
+      thread.join()
+  return summarize(latencies, elapsed, lock_wait(tracked) - wait)
+
+
+def bench(n_workers: int) -> Dict[str, Dict[str, float]]:
+  """
+  Benchmarks each scheduler operation against a cluster of n_workers.
+
+  Args:
+    n_workers (int): Number of synthetic workers.
+
+  Returns:
+    (Dict[str, Dict[str, float]]): Summary per operation.
+  """
+  reset()
+  client = app.test_client()
+  post: Callable[[str, Dict[str, Any]], Any] = \
+    lambda path, data: client.post(path, data=json.dumps(data))
+  results: Dict[str, Dict[str, float]] = {}
+
+  # Workers are 'immortal' so that the reaper leaves them alone mid-run.
+  worker_ids: List[str] = [f'immortal-bench-{i}' for i in range(n_workers)]
+  results['register'] = measure([
+    lambda worker_id=worker_id: post('/register', {
+      'worker_id': worker_id,
+      'n_cores': N_CORES,
+    }) for worker_id in worker_ids])
+
+  # Fill about half the cluster with pipelines.
+  n_jobs: int = min(n_workers * N_CORES // (2 * JOB_SIZE), MAX_CALLS)
+  job: List[Dict[str, Any]] = [{
+    'program': f'program{i}',
+    'contacts': [i + 1] if i + 1 < JOB_SIZE else [],
+  } for i in range(JOB_SIZE)]
+  results['allocate'] = measure([
+    lambda client_id=f'client{i}': post('/allocate', {
+      'client_id': client_id,
+      'new_tasks': job,
+    }) for i in range(n_jobs)], worker_ids)
+
+  sample: List[str] = random.sample(worker_ids, min(n_workers, MAX_CALLS))
+  results['heartbeat'] = measure([
+    lambda worker_id=worker_id: post('/heartbeat', {
+      'worker_id': worker_id,
+      'ack': 0,
+    }) for worker_id in sample])
+  results['heartbeat_idle'] = measure([
+    lambda worker_id=worker_id: post('/heartbeat', {
+      'worker_id': worker_id,
+      'ack': workers[worker_id].seq,
+    }) for worker_id in sample])
+
+  busy: List[str] = [worker_id for worker_id in sample
+                     if workers[worker_id].active_tasks]
+  results['deregister'] = measure([
+    lambda worker_id=worker_id: deregister(worker_id)
+    for worker_id in busy[:max(len(busy) // 10, 1)]], worker_ids)
+  results['deregister']['surviving_jobs'] = \
+    sum(1 for tasks in clients.values() if tasks)
+  reset()
+  return results
+
+
+def heartbeat_loop(targets: List[Tuple[str, str]],
+                   duration: float) -> List[float]:
+  """
+  Sends delta heartbeats for some workers, round robin, for a while.
+
+  Args:
+    targets (List[Tuple[str, str]]): Worker ID and shard URL of each worker.
+    duration (float): Seconds to run for.
+
+  Returns:
+    (List[float]): Seconds taken by each heartbeat.
+  """
+  session: requests.Session = requests.Session()
+  latencies: List[float] = []
+  seqs: Dict[str, int] = {}
+  deadline: float = perf_counter() + duration
+  while perf_counter() < deadline:
+    for worker_id, url in targets:
+      t: float = perf_counter()
+      res: requests.Response = session.post(url + '/heartbeat', json={
+        'worker_id': worker_id,
+        'ack': seqs.get(worker_id, 0),
+      })
+      latencies.append(perf_counter() - t)
+      seqs[worker_id] = res.json()['seq']
+  return latencies
+
+
+def bench_sharded(n_shards: int, n_workers: int) -> Dict[str, float]:
+  """
+  Measures heartbeat throughput of the sharded scheduler.
+
+  Args:
+    n_shards (int): Number of shards.
+    n_workers (int): Number of synthetic workers.
+
+  Returns:
+    (Dict[str, float]): See summarize().
+  """
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    port: int = sock.getsockname()[1]
+  here: str = os.path.dirname(os.path.abspath(__file__))
+  coordinator: subprocess.Popen = subprocess.Popen(
+    [sys.executable, os.path.join(here, 'coordinator.py'), f'--port={port}',
+     f'--shards={n_shards}'],
+    cwd=here, start_new_session=True, stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL)
+  try:
+    url: str = f'http://127.0.0.1:{port}'
+    targets: List[Tuple[str, str]] = []
+    for i in range(n_workers):
+      while True:
+        try:
+          res: requests.Response = requests.post(url + '/register', json={
+            'worker_id': f'immortal-bench-{i}',
+            'n_cores': N_CORES,
+          })
+          if res.status_code == 200:
+            break
+        except requests.ConnectionError:
+          pass
+        time.sleep(0.1)  # shards still starting
+      targets.append((f'immortal-bench-{i}', res.json()['scheduler']))
+
+    with Pool(n_shards) as pool:
+      runs: List[List[float]] = pool.starmap(heartbeat_loop, [
+        (targets[i::n_shards], SHARDED_DURATION) for i in range(n_shards)])
+    return summarize([latency for run in runs for latency in run],
+                     SHARDED_DURATION, 0.0)
+  finally:
+    os.killpg(coordinator.pid, signal.SIGTERM)
+    coordinator.wait()
+
+
+def version() -> str:
+  """
+  Returns:
+    (str): Git revision of the scheduler, if available.
+  """
+  try:
+    return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            tolerance: float) -> List[str]:
+  """
+  Finds operations that got slower than a baseline run.
+
+  Args:
+    results (Dict[str, Any]): Output of this run.
+    baseline (Dict[str, Any]): Output of an earlier run.
+    tolerance (float): Allowed relative slowdown, e.g. 0.2 for 20%.
+
+  Returns:
+    (List[str]): Descriptions of regressions.
+  """
+  regressions: List[str] = []
+  for size, ops in results['results'].items():
+    for op, summary in ops.items():
+      old: Dict[str, float] = \
+        baseline.get('results', {}).get(size, {}).get(op)
+      if not old:
+        continue
+      if summary['throughput'] < old['throughput'] * (1 - tolerance):
+        regressions.append(f'{op} @ {size} workers: throughput '
+                           f'{old["throughput"]:.0f} -> '
+                           f'{summary["throughput"]:.0f}/s')
+      if summary['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+        regressions.append(f'{op} @ {size} workers: p99 '
+                           f'{old["p99_ms"]:.3f} -> '
+                           f'{summary["p99_ms"]:.3f} ms')
+  return regressions
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=int, nargs='+',
+                      default=[100, 1000, 10000],
+                      help='cluster sizes to benchmark, e.g. 100 1000 100000')
+  parser.add_argument('--output', type=str, default='bench_output.json',
+                      help='where to write results')
+  parser.add_argument('--compare', type=str,
+                      help='earlier results to check for regressions')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='allowed relative slowdown before failing')
+  parser.add_argument('--shards', type=int, nargs='*', default=[],
+                      help='shard counts to benchmark the sharded scheduler '
+                           'with, e.g. 1 2 4')
+  parser.add_argument('--seed', type=int, default=0)
+  FLAGS = parser.parse_args()
+  random.seed(FLAGS.seed)
+
+  results: Dict[str, Any] = {
+    'version': version(),
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'results': {},
+  }
+  for size in FLAGS.sizes:
+    results['results'][str(size)] = bench(size)
+    for op, summary in results['results'][str(size)].items():
+      print(f'{size:>7} workers  {op:<15} {summary["throughput"]:>10.0f}/s  '
+            f'p50 {summary["p50_ms"]:.3f} ms  p99 {summary["p99_ms"]:.3f} ms  '
+            f'lock wait {summary["lock_wait_ms"]:.3f} ms')
+  for n_shards in FLAGS.shards:
+    size: int = min(FLAGS.sizes)
+    summary: Dict[str, float] = bench_sharded(n_shards, size)
+    results['results'].setdefault(f'sharded-{size}', {})[
+      f'heartbeat_{n_shards}_shards'] = summary
+    print(f'{size:>7} workers  {n_shards} shards       '
+          f'{summary["throughput"]:>10.0f}/s  '
+          f'p50 {summary["p50_ms"]:.3f} ms  p99 {summary["p99_ms"]:.3f} ms')
+  with open(FLAGS.output, 'w') as file:
+    json.dump(results, file, indent=2)
+
+  if FLAGS.compare:
+    with open(FLAGS.compare) as file:
+      regressions: List[str] = compare(results, json.load(file),
+                                       FLAGS.tolerance)
+    for regression in regressions:
+      print(f'REGRESSION: {regression}')
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,8 +4,21 @@
 SPIT-Browser Scheduler: Tester
 """
 
+from hashlib import sha256
+from metrics import Histogram, REGISTRY
+from pacer import CHURN_WINDOW, MAX_INTERVAL, Pacer
+from reaper import Reaper
+from rebalancer import DRAIN
 import json
-from scheduler import app
+from scheduler import app, capacity, clients, dependents, deregister, \
+                      open_journal, programs, reaper, reset, workers
+from task import TIMEOUT
+from telemetry import BUCKET, BUCKETS, Telemetry
+import scheduler
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 class SchedulerTest(unittest.TestCase):
@@ -14,6 +27,9 @@ class SchedulerTest(unittest.TestCase):
     self.app.testing = True
     self.maxDiff = None
 
+  def tearDown(self):
+    reset()
+
   def test_pipeline(self):
     res = self.app.post('/register', data=json.dumps({
       "worker_id": "worker0",
@@ -21,6 +37,7 @@ class SchedulerTest(unittest.TestCase):
     }))
     self.assertEqual(json.loads(res.data), {
       "success": True,
+      "worker_id": "worker0",
     })
 
     res = self.app.post('/register', data=json.dumps({
@@ -29,6 +46,7 @@ class SchedulerTest(unittest.TestCase):
     }))
     self.assertEqual(json.loads(res.data), {
       "success": True,
+      "worker_id": "worker1",
     })
 
     res = self.app.post('/allocate', data=json.dumps({
@@ -53,7 +71,8 @@ class SchedulerTest(unittest.TestCase):
         "client1~0~worker0",
         "client1~1~worker0",
         "client1~2~worker1"
-      ]
+      ],
+      "cut_edges": 1
     })
 
     res = self.app.post('/heartbeat', data=json.dumps({
@@ -67,7 +86,7 @@ class SchedulerTest(unittest.TestCase):
           "contacts": [
             "client1~1~worker0"
           ],
-          "program": "program0",
+          "program_id": sha256(b"program0").hexdigest(),
           "task_id": "client1~0~worker0",
           "update": False,
           "vertex_id": 0,
@@ -79,13 +98,14 @@ class SchedulerTest(unittest.TestCase):
           "contacts": [
             "client1~2~worker1"
           ],
-          "program": "program1",
+          "program_id": sha256(b"program1").hexdigest(),
           "task_id": "client1~1~worker0",
           "update": False,
           "vertex_id": 1,
           "worker_id": "worker0"
         }
-      ]
+      ],
+      "interval": 2.5
     })
 
     res = self.app.post('/heartbeat', data=json.dumps({
@@ -97,14 +117,1024 @@ class SchedulerTest(unittest.TestCase):
         "cancel": False,
         "client_id": "client1",
         "contacts": [],
-        "program": "program2",
+        "program_id": sha256(b"program2").hexdigest(),
         "task_id": "client1~2~worker1",
         "update": False,
         "vertex_id": 2,
         "worker_id": "worker1"
-      }]
+      }],
+      "interval": 2.5
     })
 
+  def test_allocate_uses_capacity_index(self):
+    for worker_id, n_cores in [("worker0", 1), ("worker1", 3),
+                               ("worker2", 2)]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": n_cores
+      }))
+
+    # Workers with the most free cores are filled first.
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}] * 4
+    }))
+    self.assertEqual(json.loads(res.data)["task_ids"], [
+      "client1~0~worker1",
+      "client1~1~worker1",
+      "client1~2~worker1",
+      "client1~3~worker2",
+    ])
+    self.assertEqual(workers["worker0"].pending_tasks, {})
+    self.assertNotIn("worker1", capacity)
+    self.assertIn("worker2", capacity)
+
+    # Not enough capacity: nothing is allocated and capacity is restored.
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client2",
+      "new_tasks": [{"program": "p", "contacts": []}] * 3
+    }))
+    self.assertEqual(json.loads(res.data)["task_ids"], [])
+    self.assertEqual(workers["worker2"].availability(), 1)
+    self.assertIn("worker0", capacity)
+    self.assertIn("worker2", capacity)
+
+    # Completed tasks free capacity on the next heartbeat.
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "worker1",
+      "active_tasks": []
+    }))
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "worker1",
+      "active_tasks": ["client1~0~worker1"]
+    }))
+    self.assertEqual(workers["worker1"].availability(), 2)
+    self.assertIn("worker1", capacity)
+
+  def test_reserve_locks(self):
+    for worker_id in ["immortal0", "immortal1"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+    worker0, worker1 = workers["immortal0"], workers["immortal1"]
+
+    # A heartbeat puts immortal0 back in the index while reserve() waits for
+    # its lock; immortal0 is not reserved, nor locked, twice.
+    capacity.remove("immortal1")
+    worker0.heartbeat_lock.acquire()
+    results = []
+    thread = threading.Thread(
+      target=lambda: results.append(scheduler.reserve(3)), daemon=True)
+    thread.start()
+    while "immortal0" in capacity:
+      time.sleep(0.01)
+    worker0.reindex()
+    worker0.heartbeat_lock.release()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(results, [[worker0]])
+    scheduler.release(results[0])
+    worker1.reindex()
+
+    # Workers whose lock is busy are passed over rather than waited for, and
+    # stay in the index.
+    with worker1.heartbeat_lock:
+      reserved = scheduler.reserve(4)
+      self.assertEqual(reserved, [worker0])
+      self.assertIn("immortal1", capacity)
+      scheduler.release(reserved)
+
+  def test_reaper_expires_silent_workers(self):
+    for worker_id in ["worker0", "worker1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 1
+      }))
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}]
+    }))
+    self.assertEqual(json.loads(res.data)["task_ids"], ["client1~0~worker0"])
+
+    # worker1 keeps heartbeating; worker0 goes silent.
+    now = time.monotonic()
+    reaper.last_seen["worker1"] = now + TIMEOUT / 2
+    self.assertEqual(reaper.reap(now + TIMEOUT / 2), [])
+    self.assertEqual(reaper.reap(now + TIMEOUT + 1), ["worker0"])
+    self.assertEqual(sorted(workers), ["immortal2", "worker1"])
+    self.assertEqual(list(workers["worker1"].pending_tasks),
+                     ["client1~0~worker1"])
+    self.assertEqual(reaper.reap(now + TIMEOUT * 2), ["worker1"])
+
+  def test_phi_accrual(self):
+    now = [0.0]
+    expired = []
+    detector = Reaper(TIMEOUT, lambda *ids: expired.extend(ids), start=False,
+                      clock=lambda: now[0])
+
+    # Both workers heartbeat every 5s, then go silent.
+    for t in range(0, 25, 5):
+      now[0] = t
+      detector.touch("worker0")
+      detector.touch("worker1")
+    self.assertEqual(detector.reap(30), [])
+    self.assertFalse(detector.arrivals["worker0"].suspect)
+    self.assertEqual(detector.reap(32), [])
+    self.assertTrue(detector.arrivals["worker0"].suspect)
+
+    # worker1 heartbeats again and is cleared; worker0 expires long before
+    # the timeout.
+    now[0] = 33
+    detector.touch("worker1")
+    self.assertFalse(detector.arrivals["worker1"].suspect)
+    self.assertEqual(detector.reap(37), ["worker0"])
+    self.assertEqual(expired, ["worker0"])
+
+    # A heartbeat from an expired worker shows it was expired wrongly.
+    self.assertTrue(detector.late("worker0"))
+    self.assertFalse(detector.late("worker0"))
+    self.assertFalse(detector.late("worker1"))
+
+    # Workers heartbeating at the same rate are not expired early.
+    self.assertEqual(detector.reap(38), [])
+
+    reaper.expired["worker2"] = None
+    res = self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "worker2",
+    }))
+    self.assertEqual(res.status_code, 404)
+    self.assertNotIn("worker2", reaper.expired)
+
+  def test_heartbeat_pacing(self):
+    now = [0.0]
+    pacer = Pacer(clock=lambda: now[0])
+    self.assertEqual(pacer.pace(10, busy=False, queued=False), 10)
+    self.assertEqual(pacer.pace(10, busy=True, queued=False), 5)
+    self.assertEqual(pacer.pace(10, busy=True, queued=True), 2.5)
+    pacer.churn()
+    self.assertEqual(pacer.pace(10, busy=False, queued=False), 2.5)
+    now[0] = CHURN_WINDOW
+
+    # Intervals grow with the fleet, keeping the heartbeat rate bounded.
+    self.assertEqual(pacer.pace(10 ** 5, busy=True, queued=True), 100)
+    self.assertEqual(pacer.pace(10 ** 7, busy=False, queued=False),
+                     MAX_INTERVAL)
+
+    # The reaper expects workers when they were told to come back, and waits
+    # longer for workers told to come back later.
+    expired = []
+    detector = Reaper(TIMEOUT, lambda *ids: expired.extend(ids), start=False,
+                      clock=lambda: now[0])
+    for t in range(0, 100, 20):
+      now[0] = t
+      detector.touch("worker0")
+      detector.expect("worker0", 20)
+    detector.expect("worker0", 100)
+    self.assertEqual(detector.reap(80 + TIMEOUT + 1), [])
+    self.assertEqual(detector.reap(80 + 100 + 12), ["worker0"])
+
+    res = self.app.post('/register', data=json.dumps({
+      "worker_id": "worker1",
+      "n_cores": 1
+    }))
+    res = self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "worker1",
+      "ack": 0
+    }))
+    self.assertEqual(json.loads(res.data)["interval"], 10)
+    self.assertEqual(reaper.arrivals["worker1"].expected, 10)
+
+  def test_deregister_rewires_dependents(self):
+    for worker_id in ["immortal0", "immortal1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+    for client_id in ["client1", "client2"]:
+      self.app.post('/allocate', data=json.dumps({
+        "client_id": client_id,
+        "new_tasks": [
+          {"program": "p", "contacts": [1]},
+          {"program": "p", "contacts": []},
+        ]
+      }))
+    for worker_id in list(workers):
+      self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": worker_id,
+        "active_tasks": []
+      }))
+
+    # Only client2's upstream task is rewired and resent.
+    deregister("immortal1")
+    self.assertEqual(clients["client1"][0].contacts, ["client1~1~immortal0"])
+    self.assertEqual(clients["client2"][0].contacts, ["client2~1~immortal2"])
+    self.assertEqual(list(workers["immortal2"].pending_tasks),
+                     ["client2~0~immortal2", "client2~1~immortal2"])
+    self.assertEqual(list(workers["immortal0"].pending_tasks), [])
+    res = self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal2",
+      "active_tasks": []
+    }))
+    self.assertEqual([task.get("task_id_old")
+                      for task in json.loads(res.data)["new_tasks"]],
+                     ["client2~0~immortal1", "client2~1~immortal1"])
+
+    # Without spare capacity the job is cancelled instead.
+    deregister("immortal0")
+    self.assertEqual(clients["client1"], [])
+    self.assertNotIn("client1", dependents)
+    self.assertEqual(len(clients["client2"]), 2)
+
+  def test_data_parallel(self):
+    for worker_id, n_cores in [("immortal0", 2), ("immortal1", 4)]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": n_cores
+      }))
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [
+        {"program": "p", "contacts": [1]},
+        {"program": "q", "contacts": [2], "parallelism": 3,
+         "partition": "hash"},
+        {"program": "r", "contacts": []},
+      ]
+    }))
+    task_ids = json.loads(res.data)["task_ids"]
+    self.assertEqual(task_ids, [
+      "client1~0~immortal1", "client1~1~immortal1", "client1~2~immortal1",
+      "client1~3~immortal1", "client1~4~immortal0",
+    ])
+
+    # The source splits its output among the instances, which all send to the
+    # sink.
+    source, *instances, sink = clients["client1"]
+    self.assertEqual(source.contacts, task_ids[1:4])
+    self.assertEqual(source.to_json()["partition"], [["hash", 3]])
+    for task in instances:
+      self.assertEqual(task.contacts, task_ids[4:])
+      self.assertNotIn("partition", task.to_json())
+    self.assertEqual(len(set(task.program_id for task in instances)), 1)
+    self.assertEqual(scheduler.place(scheduler.Submission({
+      "client_id": "client2",
+      "new_tasks": [{"program": "p", "contacts": [], "parallelism": 2}],
+    })), None)
+    for task in [{"program": "p", "contacts": [], "parallelism": 0},
+                 {"program": "p", "contacts": [], "partition": "key"}]:
+      res = self.app.post('/allocate', data=json.dumps({
+        "client_id": "client2",
+        "new_tasks": [task]
+      }))
+      self.assertEqual(res.status_code, 400)
+
+    # A lost instance is replaced in its place among the source's contacts.
+    for worker_id in list(workers):
+      self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": worker_id,
+        "active_tasks": []
+      }))
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal2",
+      "n_cores": 5
+    }))
+    deregister("immortal0")
+    self.assertEqual(source.contacts, task_ids[1:4])
+    self.assertEqual(sink.task_id, "client1~4~immortal2")
+    for task in instances:
+      self.assertEqual(task.contacts, ["client1~4~immortal2"])
+    deregister("immortal1")
+    self.assertEqual(source.contacts, ["client1~1~immortal2",
+                                       "client1~2~immortal2",
+                                       "client1~3~immortal2"])
+    self.assertEqual(source.partition, [["hash", 3]])
+
+  def test_contact_patches(self):
+    def heartbeat(worker_id, ack):
+      return json.loads(self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": worker_id,
+        "ack": ack
+      })).data)
+
+    for worker_id in ["immortal0", "immortal1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 1
+      }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [
+        {"program": "p", "contacts": [1]},
+        {"program": "p", "contacts": []},
+      ]
+    }))
+    upstream, downstream = [task.worker_id for task in clients["client1"]]
+    heartbeat(upstream, 0)
+    heartbeat(downstream, 0)
+
+    # The running upstream task keeps its core and gets only a patch, resent
+    # until acknowledged.
+    deregister(downstream)
+    moved = clients["client1"][1].task_id
+    self.assertEqual(workers[upstream].pending_tasks, {})
+    self.assertEqual(workers[upstream].availability(), 0)
+    patch = [{"task_id": f"client1~0~{upstream}", "contacts": [moved]}]
+    self.assertEqual(heartbeat(upstream, 1), {"seq": 2, "new_tasks": [],
+                                              "patches": patch,
+                                              "interval": 2.5})
+    self.assertEqual(heartbeat(upstream, 1), {"seq": 3, "new_tasks": [],
+                                              "patches": patch,
+                                              "interval": 2.5})
+    self.assertEqual(heartbeat(upstream, 3),
+                     {"seq": 4, "new_tasks": [], "interval": 2.5})
+
+    # Full heartbeats get patches once.
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal3",
+      "n_cores": 1
+    }))
+    deregister(moved.split("~")[2])
+    full = {"worker_id": upstream, "active_tasks": [f"client1~0~{upstream}"]}
+    res = json.loads(self.app.post('/heartbeat', data=json.dumps(full)).data)
+    self.assertEqual(res["patches"], [{"task_id": f"client1~0~{upstream}",
+                                       "contacts": ["client1~1~immortal3"]}])
+    res = json.loads(self.app.post('/heartbeat', data=json.dumps(full)).data)
+    self.assertEqual(res, {"new_tasks": [], "interval": 2.5})
+
+  def test_rebalancer(self):
+    def heartbeat(worker_id, ack, metrics=None):
+      return json.loads(self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": worker_id,
+        "ack": ack,
+        "metrics": metrics or {}
+      })).data)
+
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 2
+    }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [
+        {"program": "p", "contacts": [1]},
+        {"program": "p", "contacts": []},
+      ]
+    }))
+    heartbeat("immortal0", 0)
+    backlog = {"client1~0~immortal0": {"queue": 500},
+               "client1~1~immortal0": {"queue": 900}}
+    for ack in range(1, 4):
+      heartbeat("immortal0", ack, backlog)
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal1",
+      "n_cores": 2
+    }))
+
+    # The most backed-up task is started on the new worker first.
+    scheduler.rebalance()
+    res = heartbeat("immortal1", 0)
+    self.assertEqual([(task["task_id"], task["task_id_old"])
+                      for task in res["new_tasks"]],
+                     [("client1~1~immortal1", "client1~1~immortal0")])
+    scheduler.rebalance()
+    self.assertEqual(clients["client1"][1].task_id, "client1~1~immortal0")
+    # The upstream task starts moving too, since its worker is still
+    # overloaded.
+    self.assertEqual(list(scheduler.rebalancer.migrations),
+                     ["client1~1", "client1~0"])
+
+    # Once started, it takes over and the upstream task is patched.
+    heartbeat("immortal1", 1)
+    scheduler.rebalance()
+    self.assertEqual(clients["client1"][1].task_id, "client1~1~immortal1")
+    res = heartbeat("immortal0", 4, backlog)
+    self.assertEqual(res["new_tasks"], [])
+    self.assertEqual(res["patches"], [{"task_id": "client1~0~immortal0",
+                                       "contacts": ["client1~1~immortal1"]}])
+
+    # The old copy is stopped once it has drained.
+    scheduler.rebalancer.migrations["client1~1"].switched -= 2 * DRAIN
+    scheduler.rebalance()
+    self.assertEqual(len(scheduler.rebalancer.migrations), 2)
+    heartbeat("immortal0", 5, {"client1~0~immortal0": {"queue": 500},
+                               "client1~1~immortal0": {"queue": 0}})
+    scheduler.rebalance()
+    self.assertEqual(list(scheduler.rebalancer.migrations), ["client1~0"])
+    res = heartbeat("immortal0", 6)
+    self.assertEqual([(task["task_id"], task["cancel"])
+                      for task in res["new_tasks"]],
+                     [("client1~1~immortal0", True)])
+    self.assertEqual(programs.refs[sha256(b"p").hexdigest()], 3)
+
+    # A migration whose job is cancelled before switch-over is abandoned.
+    scheduler.cancel("client1")
+    scheduler.rebalance()
+    self.assertEqual(scheduler.rebalancer.migrations, {})
+    self.assertEqual({task_id: task.cancel for task_id, task
+                      in workers["immortal1"].pending_tasks.items()},
+                     {"client1~1~immortal1": True,
+                      "client1~0~immortal1": True})
+    self.assertNotIn(sha256(b"p").hexdigest(), programs.refs)
+
+  def test_program_store(self):
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 3
+    }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [
+        {"program": "same", "contacts": [1]},
+        {"program": "same", "contacts": [2]},
+        {"program": "other", "contacts": []},
+      ]
+    }))
+    same = sha256(b"same").hexdigest()
+    self.assertEqual(programs.refs, {same: 2, sha256(b"other").hexdigest(): 1})
+
+    res = self.app.get(f'/worker/program/{same}')
+    self.assertEqual(res.data, b"same")
+    self.assertIn("immutable", res.headers["Cache-Control"])
+    res = self.app.get(f'/worker/program/{same}',
+                       headers={"If-None-Match": f'"{same}"'})
+    self.assertEqual(res.status_code, 304)
+    res = self.app.get('/worker/program/client1~0~immortal0')
+    self.assertEqual(res.data, b"same")
+    self.assertEqual(res.headers["Cache-Control"], "no-cache")
+    res = self.app.get('/worker/program/client1~3~immortal0')
+    self.assertEqual(res.status_code, 404)
+
+    # Resubmitting uploads only the changed program, and refers to the rest
+    # by ID.
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal1",
+      "n_cores": 3
+    }))
+    new = sha256(b"new").hexdigest()
+    res = self.app.post('/programs/missing', data=json.dumps({
+      "program_ids": [same, new]
+    }))
+    self.assertEqual(json.loads(res.data), {"missing": [new]})
+    res = self.app.post('/programs', data=json.dumps({
+      "programs": ["new"]
+    }))
+    self.assertEqual(json.loads(res.data), {"program_ids": [new]})
+    self.assertNotIn(new, programs.refs)
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [
+        {"program_id": same, "contacts": [1]},
+        {"program_id": same, "contacts": [2]},
+        {"program_id": new, "contacts": []},
+      ]
+    }))
+    self.assertEqual(len(json.loads(res.data)["task_ids"]), 3)
+    res = self.app.get('/worker/program/client1~2~immortal1')
+    self.assertEqual(res.data, b"new")
+
+    # The old tasks are still queued on immortal0, which may yet fetch their
+    # programs, so those are kept until the tasks leave it.
+    other = sha256(b"other").hexdigest()
+    self.assertEqual(programs.refs, {same: 4, other: 1, new: 1})
+    res = self.app.get(f'/worker/program/{other}')
+    self.assertEqual(res.status_code, 200)
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0
+    }))
+    self.assertEqual(programs.refs, {same: 4, other: 1, new: 1})
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 1,
+      "finished": [f"client1~{i}~immortal0" for i in range(3)]
+    }))
+    self.assertEqual(programs.refs, {same: 2, new: 1})
+
+    # Programs no job uses are kept as spares, the oldest dropped first.
+    self.assertEqual(list(programs.spare), [other])
+    programs.max_spare = 1
+    scheduler.cancel("client1")
+    self.assertEqual(list(programs.spare), [new])
+    res = self.app.get('/worker/program/client1~2~immortal1')
+    self.assertEqual(res.status_code, 404)
+    res = self.app.post('/programs/missing', data=json.dumps({
+      "program_ids": [same, new]
+    }))
+    self.assertEqual(json.loads(res.data), {"missing": [same]})
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program_id": same, "contacts": []}]
+    }))
+    self.assertEqual(res.status_code, 404)
+
+  def test_delta_heartbeat(self):
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 2
+    }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}] * 2
+    }))
+
+    def heartbeat(ack, finished=[]):
+      res = self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": "immortal0",
+        "ack": ack,
+        "finished": finished
+      }))
+      res = json.loads(res.data)
+      return res["seq"], [task["task_id"] for task in res["new_tasks"]]
+
+    self.assertEqual(heartbeat(0), (1, ["client1~0~immortal0",
+                                        "client1~1~immortal0"]))
+    # Response 1 was lost, so its tasks are resent.
+    self.assertEqual(heartbeat(0), (2, ["client1~0~immortal0",
+                                        "client1~1~immortal0"]))
+    self.assertEqual(heartbeat(2), (3, []))
+    self.assertEqual(heartbeat(3, ["client1~1~immortal0"]), (4, []))
+    self.assertEqual(list(workers["immortal0"].active_tasks),
+                     ["client1~0~immortal0"])
+    self.assertIn("immortal0", capacity)
+
+  def test_state(self):
+    for worker_id in ["immortal0", "immortal1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 1
+      }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}]
+    }))
+
+    res = json.loads(self.app.get('/').data)
+    self.assertEqual(list(res["clients"]), ["client1"])
+    self.assertEqual(res["clients"]["client1"][0]["task_id"],
+                     "client1~0~immortal0")
+    self.assertEqual(res["workers"]["immortal0"], {
+      "worker_id": "immortal0",
+      "n_cores": 1,
+      "active_tasks": [],
+      "pending_tasks": ["client1~0~immortal0"],
+      "load": 0.0,
+    })
+
+    res = json.loads(self.app.get('/?offset=1&limit=1').data)
+    self.assertEqual(res, {"clients": {}, "workers": {
+      "immortal1": {
+        "worker_id": "immortal1",
+        "n_cores": 1,
+        "active_tasks": [],
+        "pending_tasks": [],
+        "load": 0.0,
+      },
+    }})
+    res = json.loads(self.app.get('/?worker_id=immortal2').data)
+    self.assertEqual(list(res["clients"]), [])
+    self.assertEqual(list(res["workers"]), ["immortal2"])
+    res = json.loads(self.app.get('/?client_id=client1').data)
+    self.assertEqual(list(res["clients"]), ["client1"])
+    self.assertEqual(list(res["workers"]), [])
+    self.assertEqual(self.app.get('/?limit=x').status_code, 400)
+
+  def test_locality_placement(self):
+    for worker_id in ["immortal0", "immortal1"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+
+    # Two independent pipelines, 0 -> 2 and 1 -> 3.
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "placement": "locality",
+      "new_tasks": [
+        {"program": "p", "contacts": [2], "weights": [10]},
+        {"program": "p", "contacts": [3]},
+        {"program": "p", "contacts": []},
+        {"program": "p", "contacts": []},
+      ]
+    }))
+    self.assertEqual(json.loads(res.data), {
+      "task_ids": [
+        "client1~0~immortal0",
+        "client1~1~immortal1",
+        "client1~2~immortal0",
+        "client1~3~immortal1",
+      ],
+      "cut_edges": 0
+    })
+    self.assertEqual(clients["client1"][0].contacts, ["client1~2~immortal0"])
+
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client2",
+      "placement": "random",
+      "new_tasks": []
+    }))
+    self.assertEqual(res.status_code, 400)
+
+  def test_wire(self):
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 2
+    }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "wire": "binary",
+      "new_tasks": [{"program": "p", "contacts": [1]},
+                    {"program": "p", "contacts": []}]
+    }))
+    res = json.loads(self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0
+    })).data)
+    self.assertEqual([task["wire"] for task in res["new_tasks"]],
+                     ["binary", "binary"])
+
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client2",
+      "wire": "xml",
+      "new_tasks": []
+    }))
+    self.assertEqual(res.status_code, 400)
+
+  def test_admission_queue(self):
+    def allocate(client_id, n_tasks, **kwargs):
+      return json.loads(self.app.post('/allocate', data=json.dumps(dict({
+        "client_id": client_id,
+        "new_tasks": [{"program": "p", "contacts": []}] * n_tasks
+      }, **kwargs))).data)
+
+    def allocation(client_id, wait=0):
+      return json.loads(self.app.get(
+        f'/allocation?client_id={client_id}&wait={wait}').data)
+
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 2
+    }))
+    self.assertEqual(len(allocate("client1", 2)["task_ids"]), 2)
+    self.assertEqual(allocate("client2", 2, queue=True),
+                     {"task_ids": [], "cut_edges": 0, "queued": True,
+                      "position": 0})
+    self.assertEqual(allocate("client3", 1, queue=True)["position"], 1)
+    self.assertEqual(allocate("client4", 1), {"task_ids": [], "cut_edges": 0})
+    self.assertEqual(allocation("client2"),
+                     {"task_ids": [], "position": 0, "queued": True})
+
+    # client3 is backfilled ahead of client2, which does not fit yet.
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal1",
+      "n_cores": 1
+    }))
+    self.assertEqual(allocation("client3"),
+                     {"task_ids": ["client3~0~immortal1"]})
+    self.assertEqual(scheduler.admissions.jobs["client2"].bypassed, 1)
+
+    # Once passed over often enough, nothing more passes client2.
+    scheduler.admissions.max_bypass = 1
+    allocate("client5", 1, queue=True)
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal2",
+      "n_cores": 1
+    }))
+    self.assertEqual(list(scheduler.admissions.jobs), ["client2", "client5"])
+
+    # client2 is admitted as soon as client1's tasks finish, waking its
+    # long poll.
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+      allocation("client2", wait=5)))
+    start = time.monotonic()
+    thread.start()
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0
+    }))
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 1,
+      "finished": ["client1~0~immortal0", "client1~1~immortal0"]
+    }))
+    thread.join()
+    self.assertLess(time.monotonic() - start, 5)
+    self.assertEqual(results, [{
+      "task_ids": ["client2~0~immortal0", "client2~1~immortal0"],
+    }])
+    self.assertEqual(allocation("client5")["task_ids"],
+                     ["client5~0~immortal2"])
+    self.assertEqual(len(scheduler.admissions), 0)
+
+    # Batches are checked as a whole before any job is allocated.
+    res = self.app.post('/allocate', data=json.dumps({
+      "jobs": [
+        {"client_id": "client6",
+         "new_tasks": [{"program": "p", "contacts": []}]},
+        {"client_id": "client7",
+         "new_tasks": [{"program": "p", "contacts": [5]}]},
+      ]
+    }))
+    self.assertEqual(res.status_code, 400)
+    self.assertNotIn("client6", clients)
+    res = json.loads(self.app.post('/allocate', data=json.dumps({
+      "queue": True,
+      "jobs": [
+        {"client_id": "client6",
+         "new_tasks": [{"program": "p", "contacts": []}]},
+        {"client_id": "client7", "queue": False,
+         "new_tasks": [{"program": "p", "contacts": []}]},
+      ]
+    })).data)
+    self.assertEqual(res, {"jobs": [
+      {"task_ids": [], "cut_edges": 0, "queued": True, "position": 0},
+      {"task_ids": [], "cut_edges": 0},
+    ]})
+    self.assertEqual(self.app.get('/allocation?client_id=client8').status_code,
+                     404)
+
+  def test_load_aware_placement(self):
+    for worker_id in ["immortal0", "immortal1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}]
+    }))
+
+    # immortal0's task is backed up; immortal1 reports an idle worker.
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0,
+      "metrics": {"client1~0~immortal0": {"queue": 500, "rate": 10,
+                                          "time": 90}}
+    }))
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal1",
+      "ack": 0,
+      "metrics": {}
+    }))
+    self.assertGreater(workers["immortal0"].load, 0.5)
+    self.assertEqual(workers["immortal1"].load, 0)
+
+    # The busy worker has a free core, but idle workers are preferred.
+    res = self.app.post('/allocate', data=json.dumps({
+      "client_id": "client2",
+      "new_tasks": [{"program": "p", "contacts": []}] * 3
+    }))
+    self.assertEqual(json.loads(res.data)["task_ids"], [
+      "client2~0~immortal2",
+      "client2~1~immortal2",
+      "client2~2~immortal1",
+    ])
+
+    # Reallocation after a failure avoids it too.
+    deregister("immortal2")
+    self.assertEqual(list(workers["immortal1"].pending_tasks),
+                     ["client2~2~immortal1", "client2~0~immortal1"])
+    self.assertEqual(list(workers["immortal0"].pending_tasks),
+                     ["client2~1~immortal0"])
+
+  def test_job_stats(self):
+    now = [0.0]
+    stats = Telemetry(clock=lambda: now[0])
+    stats.record("client1", 0, {"in": 100, "out": 50, "bytes": 800,
+                                "time": 20, "queue": 3})
+    now[0] = BUCKET
+    stats.record("client1", 0, {"in": 300, "out": 150, "bytes": 2400,
+                                "queue": 7})
+    stats.record("client1", 0, {"in": "many"})  # malformed, dropped
+    now[0] = 2 * BUCKET
+    vertex = stats.stats("client1", [0, 1])["vertices"][0]
+    self.assertEqual(vertex["in_rate"], 400 / (2 * BUCKET))
+    self.assertEqual(vertex["byte_rate"], 3200 / (2 * BUCKET))
+    self.assertEqual(vertex["queue"], 7)
+    self.assertEqual(vertex["time"], 20)
+    self.assertEqual([bucket["start"] for bucket in vertex["series"]],
+                     [0, BUCKET])
+    self.assertNotIn("time", vertex["series"][1])
+
+    # The ring keeps the newest BUCKETS buckets.
+    for i in range(BUCKETS + 5):
+      now[0] = i * BUCKET
+      stats.record("client1", 0, {"in": i})
+    series = stats.stats("client1", [0])["vertices"][0]["series"]
+    self.assertEqual(len(series), BUCKETS)
+    self.assertEqual(series[0]["in"], 5)
+    stats.forget("client1")
+    self.assertEqual(stats.jobs, {})
+
+    # Heartbeat metrics are kept per vertex, and the vertex that keeps its
+    # core busiest is named the bottleneck.
+    self.app.post('/register', data=json.dumps({
+      "worker_id": "immortal0",
+      "n_cores": 3
+    }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": [1]},
+                    {"program": "p", "contacts": [2]},
+                    {"program": "p", "contacts": []}]
+    }))
+    clock = scheduler.telemetry.clock
+    scheduler.telemetry.clock = lambda: now[0]
+    try:
+      now[0] = 0
+      self.app.post('/heartbeat', data=json.dumps({
+        "worker_id": "immortal0",
+        "ack": 0,
+        "metrics": {
+          "client1~0~immortal0": {"in": 0, "out": 600},
+          "client1~1~immortal0": {"in": 600, "out": 600, "time": 15,
+                                  "queue": 200},
+          "client1~2~immortal0": {"in": 600, "time": 1},
+          "client2~0~immortal0": {"in": 5},
+        }
+      }))
+      now[0] = BUCKET
+      res = self.app.get('/jobs/client1/stats')
+    finally:
+      scheduler.telemetry.clock = clock
+    job = json.loads(res.data)
+    self.assertEqual(job["bottleneck"], 1)
+    self.assertEqual([vertex["out_rate"] for vertex in job["vertices"]],
+                     [600 / BUCKET, 600 / BUCKET, 0])
+    self.assertEqual(job["vertices"][1]["utilization"], 600 * 15 / 1000 /
+                                                        BUCKET)
+    self.assertNotIn("client2", scheduler.telemetry.jobs)
+    self.assertEqual(self.app.get('/jobs/client2/stats').status_code, 404)
+
+    # Resubmitting the job starts its telemetry afresh.
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}]
+    }))
+    res = self.app.get('/jobs/client1/stats')
+    self.assertNotIn("bottleneck", json.loads(res.data))
+
+  def test_metrics(self):
+    def sample(text, series):
+      for line in text.splitlines():
+        if line.startswith(series + " "):
+          return float(line.split()[-1])
+      return 0.0
+
+    before = self.app.get('/metrics').data.decode()
+    for worker_id in ["immortal0", "immortal1"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client1",
+      "new_tasks": [{"program": "p", "contacts": []}] * 3
+    }))
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0
+    }))
+    deregister("immortal1")
+
+    res = self.app.get('/metrics')
+    self.assertTrue(res.content_type.startswith("text/plain; version=0.0.4"))
+    after = res.data.decode()
+    self.assertIn("# TYPE scheduler_request_duration_seconds histogram",
+                  after)
+    for series, delta in [
+        ('scheduler_request_duration_seconds_count{handler="allocate"}', 1),
+        ('scheduler_request_duration_seconds_count{handler="heartbeat"}', 1),
+        ('scheduler_deregister_duration_seconds_count', 1),
+        ('scheduler_deregistrations_total', 1),
+        ('scheduler_cancellations_total', 1)]:
+      self.assertEqual(sample(after, series) - sample(before, series), delta,
+                       series)
+    self.assertGreater(
+      sample(after, "scheduler_heartbeat_lock_wait_seconds_count"),
+      sample(before, "scheduler_heartbeat_lock_wait_seconds_count"))
+    # Cancellations are queued for the surviving worker.
+    self.assertEqual(sample(after, 'scheduler_tasks{state="active"}'), 0)
+    self.assertEqual(sample(after, 'scheduler_tasks{state="pending"}'), 2)
+    self.assertEqual(sample(after, "scheduler_workers"), 1)
+
+  def test_histogram_shards(self):
+    histogram = Histogram("test_seconds", "Test.", buckets=(1.0, 2.0))
+    threads = [threading.Thread(
+      target=lambda: [histogram.observe(value) for value in (0.5, 1.5, 3)])
+      for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    histogram.observe(1.0)
+    self.assertEqual(histogram.collect(), [5, 4, 4, 21])
+    self.assertEqual(len(histogram.shards), 1)  # exited threads are folded
+    self.assertEqual(histogram.render()[-2:],
+                     ["test_seconds_sum 21", "test_seconds_count 13"])
+    REGISTRY.remove(histogram)
+
+  def test_journal(self):
+    def state():
+      return json.loads(self.app.get('/').data)
+
+    path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, path)
+    open_journal(path)
+    for worker_id in ["immortal0", "immortal1", "immortal2"]:
+      self.app.post('/register', data=json.dumps({
+        "worker_id": worker_id,
+        "n_cores": 2
+      }))
+    for client_id, wire in [("client1", "json"), ("client2", "binary")]:
+      self.app.post('/allocate', data=json.dumps({
+        "client_id": client_id,
+        "wire": wire,
+        "new_tasks": [
+          {"program": client_id, "contacts": [1]},
+          {"program": "p", "contacts": []},
+        ]
+      }))
+    self.app.post('/allocate', data=json.dumps({
+      "client_id": "client3",
+      "queue": True,
+      "new_tasks": [{"program": "p", "contacts": []}] * 3
+    }))
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 0
+    }))
+    scheduler.journal.snapshot()
+    self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal1",
+      "active_tasks": []
+    }))
+    deregister("immortal1")
+    before = state()
+
+    # Restart.
+    reset()
+    open_journal(path)
+    self.assertEqual(state(), before)
+    self.assertEqual(list(scheduler.admissions.jobs), ["client3"])
+    self.assertEqual(workers["immortal0"].seq, 1)
+    self.assertEqual(len(workers["immortal0"].unacked), 2)
+    self.assertEqual(programs.refs[sha256(b"p").hexdigest()], 2)
+    self.assertEqual([task.task_id for task in dependents["client2"][1]],
+                     ["client2~0~immortal2"])
+    self.assertIs(dependents["client2"][1][0],
+                  workers["immortal2"].pending_tasks["client2~0~immortal2"])
+
+    # The heartbeat session carries on where it left off.
+    res = self.app.post('/heartbeat', data=json.dumps({
+      "worker_id": "immortal0",
+      "ack": 1
+    }))
+    self.assertEqual(json.loads(res.data),
+                     {"seq": 2, "new_tasks": [], "interval": 2.5})
+
+  def test_bench(self):
+    from scheduler_bench import bench, compare
+    results = bench(8)
+    self.assertEqual(list(results), ["register", "allocate", "heartbeat",
+                                     "heartbeat_idle", "deregister"])
+    self.assertEqual(results["register"]["calls"], 8)
+    self.assertEqual(results["allocate"]["calls"], 4)
+    for summary in results.values():
+      self.assertGreaterEqual(summary["lock_wait_ms"], 0)
+    self.assertEqual(workers, {})
+
+    run = {"results": {"8": results}}
+    self.assertEqual(compare(run, run, 0.2), [])
+    slower = json.loads(json.dumps(run))
+    slower["results"]["8"]["register"]["throughput"] /= 2
+    self.assertEqual(len(compare(slower, run, 0.2)), 1)
+
+  def test_simulator(self):
+    from simulator import Simulator
+    reaper = scheduler.reaper
+    report = Simulator(n_workers=50, duration=600, timeout=20, heartbeat=5,
+                       arrival_rate=0.2, job_duration=120, lifetime=300,
+                       rejoin=10).run()
+    self.assertIs(scheduler.reaper, reaper)
+    self.assertEqual(workers, {})
+    self.assertGreater(report["speedup"], 1)
+    self.assertGreater(report["counts"]["workers_lost"], 0)
+    self.assertGreater(report["start_latency"]["count"], 0)
+    self.assertLessEqual(report["start_latency"]["p50"], 5)
+    # Lost tasks run again once the reaper notices, within about a timeout.
+    self.assertGreater(report["recovery"]["count"], 0)
+    self.assertLessEqual(report["recovery"]["p50"], 25)
+    self.assertEqual(report["counts"]["workers_expired_alive"], 0)
+
+    # With a queue, an overloaded cluster admits jobs instead of rejecting.
+    report = Simulator(n_workers=5, duration=600, arrival_rate=0.2,
+                       job_duration=120, queue=True).run()
+    self.assertEqual(report["counts"]["jobs_rejected"], 0)
+    self.assertGreater(report["counts"]["jobs_queued"], 0)
+    self.assertGreater(report["counts"]["jobs_completed"], 0)
+    self.assertEqual(len(scheduler.admitted), 0)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Shard
+
+Runs the scheduler as one of several shards behind coordinator.py. Workers are
+partitioned across shards by worker ID, and each shard owns its workers and
+serves their heartbeats itself, so heartbeat throughput grows with the number
+of shards. The coordinator only steps in for work that spans shards:
+allocating a job across them, and moving or cancelling the rest of a job when
+one shard loses workers.
+
+Cross-shard allocation takes two steps. /shard/reserve holds free cores on
+some workers and reports them; the coordinator places the job over the cores
+held on every shard, then hands each shard its tasks via /shard/commit. Holds
+that are not committed in time lapse.
+
+Usage: python shard.py --shard N --coordinator URL [--host HOST] [--port PORT]
+                       [--state-dir DIR] [--timeout SECONDS]
+"""
+
+from aiohttp import web
+from aioscheduler import make_app
+from flask import abort, jsonify, request, Response
+from scheduler import app, capacity, cancel, clients, dependents, \
+                      index_dependents, index_programs, let_go, log_job, \
+                      open_journal, programs, reallocate, reaper, release, \
+                      reserve, rewire, subscriptions, telemetry, \
+                      vertex_programs, workers
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from task import Task, Worker
+import argparse
+import requests
+import scheduler
+import time
+import traceback
+import uuid
+
+# Seconds before cores held for an uncommitted allocation are freed again.
+HOLD_TIMEOUT: float = 10.0
+
+# Seconds to wait on the coordinator.
+COORDINATOR_TIMEOUT: float = 10.0
+
+# Holds map hold ID to their deadline and the cores held on each worker.
+holds: Dict[str, Tuple[float, List[Tuple[Worker, int]]]] = {}
+holds_lock: Lock = Lock()
+
+# This shard's index, and the coordinator's URL; see connect().
+shard_id: int = 0
+coordinator: Optional[str] = None
+
+@app.route('/shard/reserve', methods=['POST'])
+def shard_reserve() -> Response:
+  """
+  Holds free cores for a cross-shard allocation.
+
+  Args (JSON):
+    n_slots (int): Number of cores wanted.
+
+  Returns (JSON):
+    hold_id (Optional[str]): ID of the hold, to commit or abort. None if no
+      cores are free.
+    slots (List[Tuple[str, int]]): Worker ID and number of cores held, for
+      each worker in the hold. May cover fewer cores than asked for.
+    free (int): Cores still free on this shard.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    n_slots: int = int(req['n_slots'])
+  except (TypeError, ValueError):
+    abort(400)
+  except KeyError:
+    abort(404)
+  expire()
+
+  held: List[Tuple[Worker, int]] = []
+  reserved: List[Worker] = reserve(n_slots)
+  for worker in reserved:
+    n: int = min(worker.availability(), n_slots)
+    if n > 0:
+      worker.held += n
+      n_slots -= n
+      held.append((worker, n))
+  release(reserved)
+
+  hold_id: Optional[str] = None
+  if held:
+    hold_id = uuid.uuid4().hex
+    with holds_lock:
+      holds[hold_id] = (time.monotonic() + HOLD_TIMEOUT, held)
+  return jsonify({
+    'hold_id': hold_id,
+    'slots': [(worker.worker_id, n) for worker, n in held],
+    'free': capacity.free,
+  })
+
+
+@app.route('/shard/commit', methods=['POST'])
+def shard_commit() -> Response:
+  """
+  Adds tasks placed by the coordinator, freeing the cores held for them.
+  Tasks whose worker left since the hold are reallocated as usual.
+
+  Args (JSON):
+    hold_id (Optional[str]): Hold returned by /shard/reserve, if any.
+    client_id (str): ID of client.
+    replace (bool): Whether the tasks replace this shard's part of the
+      client's job (a new allocation), or are added to it (tasks moved here
+      from another shard).
+    tasks (List[List[Any]]): Tasks, as given by Task.to_record().
+    programs (Dict[str, str]): Source of each program the tasks run.
+
+  Returns (JSON):
+    success (bool): Whether the tasks were added. 409 if the hold lapsed.
+      Tasks being reallocated may still be on their way to a worker.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    client_id: str = req['client_id']
+    tasks: List[Task] = [Task.from_record(task) for task in req['tasks']]
+    sources: Dict[str, str] = req['programs']
+    if any(task.program_id not in sources for task in tasks):
+      abort(400)
+  except (TypeError, ValueError):
+    abort(400)
+  except KeyError:
+    abort(404)
+  if req.get('hold_id') and unhold(req['hold_id']) is None:
+    abort(409)
+
+  for task in tasks:
+    programs.put(sources[task.program_id])
+  if req.get('replace'):
+    let_go(clients.get(client_id, []))
+    clients[client_id] = tasks
+    telemetry.forget(client_id)
+  else:
+    clients[client_id] = clients.get(client_id, []) + tasks
+  dependents[client_id] = index_dependents(clients[client_id])
+  vertex_programs[client_id] = index_programs(clients[client_id])
+
+  missing: List[Task] = []
+  for task in tasks:
+    worker: Optional[Worker] = workers.get(task.worker_id)
+    if worker is None:
+      missing.append(task)
+      continue
+    with worker.heartbeat_lock:
+      if workers.get(task.worker_id) is not worker:
+        missing.append(task)  # deregistered while we waited
+        continue
+      worker.enqueue(task)
+      worker.reindex()
+      worker.log()
+    subscriptions.notify(worker.worker_id)
+  log_job(client_id)
+  if missing:
+    off_loop(reallocate, missing)
+  return jsonify({'success': True})
+
+
+@app.route('/shard/abort', methods=['POST'])
+def shard_abort() -> Response:
+  """
+  Frees the cores held for an allocation that will not be committed.
+
+  Args (JSON):
+    hold_id (str): Hold returned by /shard/reserve.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  unhold(str(req.get('hold_id')))
+  return jsonify({'success': True})
+
+
+@app.route('/shard/rewire', methods=['POST'])
+def shard_rewire() -> Response:
+  """
+  Points this shard's tasks at tasks that moved on another shard.
+
+  Args (JSON):
+    client_id (str): ID of client.
+    moves (Dict[str, str]): Maps old task ID's to new ones.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    rewire(req['client_id'], dict(req['moves']))
+    log_job(req['client_id'])
+  except (AttributeError, IndexError, TypeError, ValueError):
+    abort(400)
+  except KeyError:
+    abort(404)
+  return jsonify({'success': True})
+
+
+@app.route('/shard/cancel', methods=['POST'])
+def shard_cancel() -> Response:
+  """
+  Cancels this shard's part of a job.
+
+  Args (JSON):
+    client_id (str): ID of client.
+  """
+  req: Dict[str, Any] = request.get_json(force=True)
+  try:
+    cancel(req['client_id'])
+  except KeyError:
+    abort(404)
+  return jsonify({'success': True})
+
+
+def off_loop(fn: Callable[..., None], *args: Any):
+  """
+  Runs a function on a thread of its own, since it may block on the
+  coordinator (see orphaned()), which may in turn call back into this shard
+  while the handler that started it holds an executor thread.
+
+  Args:
+    fn (Callable[..., None]): Function.
+    args (Any): Its arguments.
+  """
+  def run():
+    try:
+      fn(*args)
+    except Exception:
+      traceback.print_exc()
+  Thread(target=run, daemon=True).start()
+
+
+def unhold(hold_id: str) -> Optional[List[Tuple[Worker, int]]]:
+  """
+  Frees the cores of a hold.
+
+  Args:
+    hold_id (str): ID of hold.
+
+  Returns:
+    (Optional[List[Tuple[Worker, int]]]): The hold's workers and cores, or
+      None if there is no such hold.
+  """
+  with holds_lock:
+    hold: Optional[Tuple[float, List[Tuple[Worker, int]]]] = \
+      holds.pop(hold_id, None)
+  if hold is None:
+    return None
+  for worker, n in hold[1]:
+    with worker.heartbeat_lock:
+      worker.held -= n
+      if workers.get(worker.worker_id) is worker:
+        worker.reindex()
+  return hold[1]
+
+
+def expire():
+  """
+  Frees the cores of lapsed holds.
+  """
+  now: float = time.monotonic()
+  with holds_lock:
+    lapsed: List[str] = [hold_id for hold_id, (deadline, _) in holds.items()
+                         if deadline < now]
+  for hold_id in lapsed:
+    unhold(hold_id)
+
+
+def notify(path: str, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+  """
+  Posts to the coordinator.
+
+  Args:
+    path (str): Coordinator route.
+    body (Dict[str, Any]): JSON body.
+
+  Returns:
+    (Optional[Dict[str, Any]]): JSON response, or None if the request failed.
+  """
+  try:
+    res: requests.Response = requests.post(coordinator + path, json=body,
+                                           timeout=COORDINATOR_TIMEOUT)
+    if res.status_code == 200:
+      return res.json()
+  except requests.RequestException:
+    traceback.print_exc()
+  return None
+
+
+def moved(client_id: str, moves: Dict[str, str]):
+  notify('/coordinator/moved', {
+    'shard': shard_id,
+    'client_id': client_id,
+    'moves': moves,
+  })
+
+
+def cancelled(client_id: str):
+  notify('/coordinator/cancelled', {
+    'shard': shard_id,
+    'client_id': client_id,
+  })
+
+
+def orphaned(client_id: str, tasks: List[Task]) -> Optional[Dict[str, str]]:
+  res: Optional[Dict[str, Any]] = notify('/coordinator/orphans', {
+    'shard': shard_id,
+    'client_id': client_id,
+    'tasks': [task.to_record() for task in tasks],
+    'programs': {task.program_id: programs.get(task.program_id)
+                 for task in tasks if task.program_id in programs},
+  })
+  return None if res is None else res['moves']
+
+
+def connect(index: int, url: str):
+  """
+  Makes this scheduler a shard, reporting to a coordinator.
+
+  Args:
+    index (int): This shard's index.
+    url (str): Coordinator's URL.
+  """
+  global shard_id, coordinator
+  shard_id, coordinator = index, url.rstrip('/')
+  scheduler.on_moved = moved
+  scheduler.on_cancelled = cancelled
+  scheduler.on_orphaned = orphaned
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', type=str, default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=5001)
+  parser.add_argument('--shard', type=int, required=True,
+                      help="this shard's index")
+  parser.add_argument('--coordinator', type=str, required=True,
+                      help="coordinator's URL")
+  parser.add_argument('--state-dir', type=str,
+                      help='persist shard state in this directory')
+  parser.add_argument('--timeout', type=float,
+                      help='seconds without a heartbeat before a worker '
+                           'is deregistered')
+  FLAGS = parser.parse_args()
+  connect(FLAGS.shard, FLAGS.coordinator)
+  if FLAGS.timeout:
+    reaper.timeout = FLAGS.timeout
+  if FLAGS.state_dir:
+    open_journal(FLAGS.state_dir)
+  web.run_app(make_app(), host=FLAGS.host, port=FLAGS.port, backlog=4096)
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Cluster Simulator
+
+Runs the real scheduler in-process against a simulated cluster on a virtual
+clock, so that TIMEOUT, the heartbeat interval, and the placement policy can
+be tuned without a fleet of browsers. Workers register, heartbeat, run tasks,
+and vanish through the same routes and Worker methods that serve real
+workers, and the reaper expires them on the virtual clock.
+
+The cluster model:
+  - Workers live for an exponentially distributed time, then vanish without
+    a word, as browser tabs do. A replacement joins a little later.
+  - Workers send delta heartbeats at a fixed interval, with random phase
+    and optional jitter. With --adaptive they wait as long as each response
+    says instead; see pacer.py.
+    With --long-poll they are also answered as soon as tasks are queued for
+    them, as under aioscheduler.py.
+  - Jobs are pipelines that arrive as a Poisson process. Each runs for an
+    exponentially distributed time once all of its tasks have started. Jobs
+    that do not fit are rejected, or with --queue wait in the admission
+    queue.
+  - Supervisors batch messages between tasks: each hop waits for the
+    receiver's delivery interval, and hops between workers also wait for the
+    sender's batch and the link latency.
+
+Reports (seconds unless noted):
+  start_latency: Job arrival to each task first starting on a worker,
+    including any time spent queued.
+  recovery: Worker loss to each of its tasks running again elsewhere.
+  edge_latency: Sampled latency of a record through each job's pipeline.
+  cut_edge_ratio: Fraction of pipeline edges between tasks on different
+    workers.
+  utilization: Fraction of cores running tasks, averaged over time.
+  heartbeat_rate: Heartbeats per second, over the whole cluster.
+
+Usage: python simulator.py [--workers 1000] [--duration 3600] [--timeout 60]
+                           [--heartbeat 5] [--placement greedy] [...]
+"""
+
+from contextlib import redirect_stdout
+from scheduler import allocate, app, clients, register, reset, workers
+from pacer import MAX_RATE, Pacer
+from reaper import PHI_EXPIRE, PHI_SUSPECT, Reaper
+from time import perf_counter
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Set, \
+                   Tuple
+from task import TIMEOUT
+import argparse
+import heapq
+import json
+import os
+import random
+import scheduler
+
+class SimWorker:
+  """
+  A simulated worker's view of itself: what it runs and what it has yet to
+  report.
+  """
+  __slots__ = ('worker_id', 'alive', 'ack', 'running', 'finished',
+               'subscription')
+
+  def __init__(self, worker_id: str):
+    self.worker_id: str = worker_id
+    self.alive: bool = True
+    self.ack: int = 0
+    self.running: Set[str] = set()
+    self.finished: List[str] = []
+    self.subscription: Optional[ContextManager[None]] = None
+
+
+class Job:
+  """
+  A simulated client's job.
+  """
+  __slots__ = ('client_id', 'arrival', 'size', 'duration', 'started', 'down',
+               'done')
+
+  def __init__(self, client_id: str, arrival: float, size: int,
+               duration: float):
+    self.client_id: str = client_id
+    self.arrival: float = arrival
+    self.size: int = size
+    self.duration: float = duration
+    self.started: Set[int] = set()    # vertices that have run
+    self.down: Dict[int, float] = {}  # vertex -> when its worker was lost
+    self.done: bool = False
+
+
+class Simulator:
+  """
+  Discrete-event simulation of a cluster driving the scheduler.
+  """
+  def __init__(self, n_workers: int = 1000, n_cores: int = 4,
+               duration: float = 3600.0, timeout: float = TIMEOUT,
+               phi_suspect: float = PHI_SUSPECT,
+               phi_expire: float = PHI_EXPIRE,
+               heartbeat: float = 5.0, jitter: float = 0.0,
+               adaptive: bool = False, max_rate: float = MAX_RATE,
+               long_poll: bool = False,
+               rtt: float = 0.05, placement: str = 'greedy',
+               queue: bool = False,
+               arrival_rate: float = 2.0, job_size: int = 4,
+               job_duration: float = 600.0, lifetime: float = 3600.0,
+               rejoin: float = 30.0, batch_delay: float = 1.0,
+               link_latency: float = 0.05, sample: float = 10.0,
+               seed: int = 0):
+    """
+    Args:
+      n_workers (int): Workers in the cluster at the start, and on average.
+      n_cores (int): Cores per worker.
+      duration (float): Simulated seconds.
+      timeout (float): Seconds without a heartbeat before a worker expires.
+      phi_suspect (float): Suspicion level at which the reaper suspects a
+        worker.
+      phi_expire (float): Suspicion level at which the reaper expires a
+        worker before the timeout.
+      heartbeat (float): Seconds between heartbeats.
+      jitter (float): Most seconds a heartbeat comes early or late.
+      adaptive (bool): Whether workers heartbeat at the interval the
+        scheduler gives them, starting from heartbeat, rather than at a
+        fixed one.
+      max_rate (float): Heartbeats per second the scheduler allows the whole
+        cluster, if adaptive.
+      long_poll (bool): Whether workers are answered as soon as tasks are
+        queued for them, rather than at their next heartbeat.
+      rtt (float): Seconds for a scheduler response to reach a worker.
+      placement (str): Placement policy passed to /allocate.
+      queue (bool): Whether jobs that do not fit are queued rather than
+        rejected.
+      arrival_rate (float): Jobs per second.
+      job_size (int): Mean vertices per job.
+      job_duration (float): Mean seconds a job runs.
+      lifetime (float): Mean seconds a worker lives.
+      rejoin (float): Mean seconds before a lost worker is replaced.
+      batch_delay (float): Seconds between a supervisor's message batches.
+      link_latency (float): Seconds for a batch to cross between workers.
+      sample (float): Seconds between utilization samples.
+      seed (int): Random seed.
+    """
+    self.config: Dict[str, Any] = {
+      'n_workers': n_workers, 'n_cores': n_cores, 'duration': duration,
+      'timeout': timeout, 'phi_suspect': phi_suspect,
+      'phi_expire': phi_expire, 'heartbeat': heartbeat, 'jitter': jitter,
+      'adaptive': adaptive, 'max_rate': max_rate, 'long_poll': long_poll,
+      'rtt': rtt, 'placement': placement, 'queue': queue,
+      'arrival_rate': arrival_rate,
+      'job_size': job_size, 'job_duration': job_duration,
+      'lifetime': lifetime, 'rejoin': rejoin, 'batch_delay': batch_delay,
+      'link_latency': link_latency, 'sample': sample, 'seed': seed,
+    }
+    self.n_workers: int = n_workers
+    self.n_cores: int = n_cores
+    self.duration: float = duration
+    self.heartbeat_interval: float = heartbeat
+    self.jitter: float = jitter
+    self.adaptive: bool = adaptive
+    self.long_poll: bool = long_poll
+    self.rtt: float = rtt
+    self.placement: str = placement
+    self.queue: bool = queue
+    self.arrival_rate: float = arrival_rate
+    self.job_size: int = job_size
+    self.job_duration: float = job_duration
+    self.lifetime: float = lifetime
+    self.rejoin: float = rejoin
+    self.batch_delay: float = batch_delay
+    self.link_latency: float = link_latency
+    self.sample_interval: float = sample
+    self.random: random.Random = random.Random(seed)
+
+    self.now: float = 0.0
+    self.events: List[Tuple[float, int, Callable[..., None], Tuple]] = []
+    self.seq: int = 0
+    self.reaper: Reaper = Reaper(timeout, self.expire, start=False,
+                                 clock=lambda: self.now,
+                                 phi_suspect=phi_suspect,
+                                 phi_expire=phi_expire)
+    self.pacer: Pacer = Pacer(heartbeat, max_rate, clock=lambda: self.now)
+    self.sim_workers: Dict[str, SimWorker] = {}
+    self.jobs: Dict[str, Job] = {}
+    self.waiting: Dict[str, Tuple[float, int, ContextManager]] = {}
+    self.n_joined: int = 0
+
+    self.counts: Dict[str, int] = {
+      'jobs_arrived': 0, 'jobs_rejected': 0, 'jobs_queued': 0,
+      'jobs_completed': 0,
+      'jobs_cancelled': 0, 'workers_lost': 0, 'workers_expired_alive': 0,
+      'tasks_lost': 0, 'edges': 0, 'cut_edges': 0, 'heartbeats': 0,
+    }
+    self.start_latency: List[float] = []
+    self.recovery: List[float] = []
+    self.edge_latency: List[float] = []
+    self.utilization: List[float] = []
+
+  def at(self, t: float, fn: Callable[..., None], *args: Any):
+    """
+    Schedules fn(*args) at virtual time t.
+    """
+    self.seq += 1
+    heapq.heappush(self.events, (t, self.seq, fn, args))
+
+  def run(self) -> Dict[str, Any]:
+    """
+    Runs the simulation against a freshly reset scheduler, and restores the
+    scheduler afterwards.
+
+    Returns:
+      (Dict[str, Any]): Report; see report().
+    """
+    saved: Tuple[Reaper, Pacer, Any] = \
+      (scheduler.reaper, scheduler.pacer, scheduler.on_cancelled)
+    reset()
+    scheduler.reaper = self.reaper
+    scheduler.pacer = self.pacer
+    scheduler.on_cancelled = self.cancelled
+    start: float = perf_counter()
+    try:
+      with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(self.n_workers):
+          self.join()
+        self.at(self.random.expovariate(self.arrival_rate), self.arrive)
+        self.at(self.reaper.resolution, self.reap)
+        self.at(self.sample_interval, self.sample)
+        while self.events and self.events[0][0] <= self.duration:
+          self.now, _, fn, args = heapq.heappop(self.events)
+          fn(*args)
+    finally:
+      for _, _, subscription in self.waiting.values():
+        subscription.__exit__(None, None, None)
+      scheduler.reaper, scheduler.pacer, scheduler.on_cancelled = saved
+      reset()
+    return self.report(perf_counter() - start)
+
+  def post(self, route: Callable[[], Any], body: Dict[str, Any]) \
+      -> Optional[Dict[str, Any]]:
+    """
+    Calls a scheduler route in a request context.
+
+    Returns:
+      (Optional[Dict[str, Any]]): JSON response, or None if it aborted.
+    """
+    with app.test_request_context(method='POST', json=body):
+      try:
+        return route().get_json()
+      except Exception:
+        return None
+
+  def join(self):
+    self.n_joined += 1
+    worker_id: str = f'sim-worker-{self.n_joined}'
+    self.post(register, {'worker_id': worker_id, 'n_cores': self.n_cores})
+    sim_worker: SimWorker = SimWorker(worker_id)
+    self.sim_workers[worker_id] = sim_worker
+    if self.long_poll:
+      sim_worker.subscription = scheduler.subscriptions.subscribe(
+        worker_id, lambda: self.at(self.now + self.rtt, self.heartbeat,
+                                   sim_worker, False))
+      sim_worker.subscription.__enter__()
+    self.at(self.now + self.random.uniform(0, self.heartbeat_interval),
+            self.heartbeat, sim_worker, True)
+    self.at(self.now + self.random.expovariate(1 / self.lifetime), self.lose,
+            sim_worker)
+
+  def lose(self, sim_worker: SimWorker):
+    """
+    Makes a worker vanish. Its tasks are down until they run elsewhere.
+    """
+    if not sim_worker.alive:
+      return
+    sim_worker.alive = False
+    self.counts['workers_lost'] += 1
+    if sim_worker.subscription is not None:
+      sim_worker.subscription.__exit__(None, None, None)
+    for task_id in sim_worker.running:
+      client_id, vertex_id, _ = task_id.split('~')
+      job: Optional[Job] = self.jobs.get(client_id)
+      if job is not None and not job.done:
+        job.down.setdefault(int(vertex_id), self.now)
+    del self.sim_workers[sim_worker.worker_id]
+    self.at(self.now + self.random.expovariate(1 / self.rejoin), self.join)
+
+  def heartbeat(self, sim_worker: SimWorker, periodic: bool):
+    if not sim_worker.alive:
+      return
+    worker: Optional[Any] = workers.get(sim_worker.worker_id)
+    if worker is None:
+      # Expired while still alive, e.g. the timeout is shorter than the
+      # heartbeat interval. Real workers would be lost to the cluster too.
+      self.counts['workers_expired_alive'] += 1
+      self.lose(sim_worker)
+      return
+    finished, sim_worker.finished = sim_worker.finished, []
+    seq, new_tasks, _ = worker.heartbeat_delta(finished, sim_worker.ack)
+    sim_worker.ack = seq
+    scheduler.admit()
+    self.counts['heartbeats'] += 1
+    if periodic:
+      interval: float = \
+        scheduler.pace(worker) if self.adaptive else self.heartbeat_interval
+      self.at(self.now + interval +
+              self.random.uniform(-self.jitter, self.jitter), self.heartbeat,
+              sim_worker, True)
+    for task in new_tasks:
+      self.start(sim_worker, task)
+
+  def start(self, sim_worker: SimWorker, task: Dict[str, Any]):
+    """
+    Runs a task sent to a worker.
+    """
+    task_id: str = task['task_id']
+    if task['cancel']:
+      sim_worker.running.discard(task_id)
+      return
+    if task_id in sim_worker.running:
+      return  # contacts changed
+    sim_worker.running.add(task_id)
+    job: Optional[Job] = self.jobs.get(task['client_id'])
+    if job is None or job.done:
+      self.finish_task(sim_worker, task_id)
+      return
+    vertex_id: int = task['vertex_id']
+    if vertex_id in job.down:
+      self.recovery.append(self.now - job.down.pop(vertex_id))
+    elif vertex_id not in job.started:
+      job.started.add(vertex_id)
+      self.start_latency.append(self.now - job.arrival)
+      if len(job.started) == job.size:
+        self.sample_edges(job)
+        self.at(self.now + job.duration, self.complete, job)
+
+  def finish_task(self, sim_worker: SimWorker, task_id: str):
+    sim_worker.running.discard(task_id)
+    sim_worker.finished.append(task_id)
+
+  def arrive(self):
+    self.at(self.now + self.random.expovariate(self.arrival_rate),
+            self.arrive)
+    self.counts['jobs_arrived'] += 1
+    client_id: str = f'sim-client-{self.counts["jobs_arrived"]}'
+    size: int = self.random.randint(1, 2 * self.job_size - 1)
+    res: Optional[Dict[str, Any]] = self.post(allocate, {
+      'client_id': client_id,
+      'placement': self.placement,
+      'queue': self.queue,
+      'new_tasks': [{
+        'program': f'vertex {vertex_id}',
+        'contacts': [vertex_id + 1] if vertex_id + 1 < size else [],
+      } for vertex_id in range(size)],
+    })
+    if res and res.get('queued'):
+      self.counts['jobs_queued'] += 1
+      subscription: ContextManager = scheduler.admitted.subscribe(
+        client_id, lambda: self.at(self.now, self.admitted, client_id))
+      subscription.__enter__()
+      self.waiting[client_id] = (self.now, size, subscription)
+      return
+    if not res or not res['task_ids']:
+      self.counts['jobs_rejected'] += 1
+      return
+    self.accept(client_id, self.now, size, res['cut_edges'])
+
+  def admitted(self, client_id: str):
+    """
+    Starts tracking a queued job once the scheduler admits it.
+    """
+    if client_id not in self.waiting:
+      return
+    arrival, size, subscription = self.waiting.pop(client_id)
+    subscription.__exit__(None, None, None)
+    hosts: List[str] = [task.worker_id
+                        for task in clients.get(client_id, [])]
+    self.accept(client_id, arrival, size,
+                sum(sender != receiver
+                    for sender, receiver in zip(hosts, hosts[1:])))
+
+  def accept(self, client_id: str, arrival: float, size: int, cut: int):
+    self.jobs[client_id] = Job(
+      client_id, arrival, size,
+      self.random.expovariate(1 / self.job_duration))
+    self.counts['edges'] += size - 1
+    self.counts['cut_edges'] += cut
+
+  def complete(self, job: Job):
+    """
+    Ends a job: its workers report its tasks finished.
+    """
+    if job.done:
+      return
+    job.done = True
+    self.counts['jobs_completed'] += 1
+    for task in clients.get(job.client_id, []):
+      sim_worker: Optional[SimWorker] = self.sim_workers.get(task.worker_id)
+      if sim_worker is not None and task.task_id in sim_worker.running:
+        self.finish_task(sim_worker, task.task_id)
+    del self.jobs[job.client_id]
+
+  def cancelled(self, client_id: str):
+    job: Optional[Job] = self.jobs.pop(client_id, None)
+    if job is not None and not job.done:
+      job.done = True
+      self.counts['jobs_cancelled'] += 1
+      self.counts['tasks_lost'] += len(job.down)
+
+  def expire(self, *worker_ids: str):
+    scheduler.deregister(*worker_ids)
+
+  def reap(self):
+    self.at(self.now + self.reaper.resolution, self.reap)
+    self.reaper.reap(self.now)
+
+  def sample(self):
+    self.at(self.now + self.sample_interval, self.sample)
+    cores: int = sum(worker.n_cores for worker in workers.values())
+    busy: int = sum(len(worker.active_tasks) for worker in workers.values())
+    self.utilization.append(busy / cores if cores else 0.0)
+
+  def sample_edges(self, job: Job):
+    """
+    Samples the latency of a record through a job's pipeline as placed.
+    """
+    hosts: List[str] = [task.worker_id
+                        for task in clients.get(job.client_id, [])]
+    latency: float = 0.0
+    for sender, receiver in zip(hosts, hosts[1:]):
+      latency += self.random.uniform(0, self.batch_delay)
+      if sender != receiver:
+        latency += self.random.uniform(0, self.batch_delay) + \
+                   self.link_latency
+    if len(hosts) > 1:
+      self.edge_latency.append(latency)
+
+  def report(self, wall: float) -> Dict[str, Any]:
+    """
+    Args:
+      wall (float): Real seconds the simulation took.
+
+    Returns:
+      (Dict[str, Any]): Configuration, event counts, and summaries of each
+        measurement; see the module docstring.
+    """
+    return {
+      'config': self.config,
+      'wall_seconds': wall,
+      'speedup': self.duration / wall if wall > 0 else 0.0,
+      'counts': self.counts,
+      'start_latency': distribution(self.start_latency),
+      'recovery': distribution(self.recovery),
+      'edge_latency': distribution(self.edge_latency),
+      'cut_edge_ratio': self.counts['cut_edges'] / self.counts['edges']
+                        if self.counts['edges'] else 0.0,
+      'utilization': sum(self.utilization) / len(self.utilization)
+                     if self.utilization else 0.0,
+      'heartbeat_rate': self.counts['heartbeats'] / self.duration
+                        if self.duration > 0 else 0.0,
+    }
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+  """
+  Args:
+    values (List[float]): Samples.
+
+  Returns:
+    (Dict[str, float]): Count, mean, p50, p99, and max.
+  """
+  values = sorted(values)
+  def percentile(q: float) -> float:
+    return values[int(q * (len(values) - 1))] if values else 0.0
+  return {
+    'count': len(values),
+    'mean': sum(values) / len(values) if values else 0.0,
+    'p50': percentile(0.50),
+    'p99': percentile(0.99),
+    'max': values[-1] if values else 0.0,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--workers', type=int, default=1000)
+  parser.add_argument('--cores', type=int, default=4)
+  parser.add_argument('--duration', type=float, default=3600.0,
+                      help='simulated seconds')
+  parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                      help='seconds without a heartbeat before a worker '
+                           'expires')
+  parser.add_argument('--phi-suspect', type=float, default=PHI_SUSPECT,
+                      help='suspicion level at which workers are suspected')
+  parser.add_argument('--phi-expire', type=float, default=PHI_EXPIRE,
+                      help='suspicion level at which workers are expired '
+                           'before the timeout (inf to disable)')
+  parser.add_argument('--heartbeat', type=float, default=5.0,
+                      help='seconds between heartbeats')
+  parser.add_argument('--jitter', type=float, default=0.0,
+                      help='most seconds a heartbeat comes early or late')
+  parser.add_argument('--adaptive', action='store_true',
+                      help='heartbeat at the interval the scheduler gives')
+  parser.add_argument('--max-heartbeat-rate', type=float, default=MAX_RATE,
+                      help='heartbeats per second the whole fleet may send')
+  parser.add_argument('--long-poll', action='store_true',
+                      help='answer workers as soon as tasks are queued')
+  parser.add_argument('--placement', type=str, default='greedy',
+                      choices=('greedy', 'locality'))
+  parser.add_argument('--queue', action='store_true',
+                      help='queue jobs that do not fit instead of rejecting '
+                           'them')
+  parser.add_argument('--arrival-rate', type=float, default=2.0,
+                      help='jobs per second')
+  parser.add_argument('--job-size', type=int, default=4,
+                      help='mean vertices per job')
+  parser.add_argument('--job-duration', type=float, default=600.0,
+                      help='mean seconds a job runs')
+  parser.add_argument('--lifetime', type=float, default=3600.0,
+                      help='mean seconds a worker lives')
+  parser.add_argument('--rejoin', type=float, default=30.0,
+                      help='mean seconds before a lost worker is replaced')
+  parser.add_argument('--batch-delay', type=float, default=1.0,
+                      help="seconds between a supervisor's message batches")
+  parser.add_argument('--link-latency', type=float, default=0.05,
+                      help='seconds for a batch to cross between workers')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', type=str,
+                      help='also write the report to this JSON file')
+  FLAGS = parser.parse_args()
+
+  report: Dict[str, Any] = Simulator(
+    n_workers=FLAGS.workers, n_cores=FLAGS.cores, duration=FLAGS.duration,
+    timeout=FLAGS.timeout, phi_suspect=FLAGS.phi_suspect,
+    phi_expire=FLAGS.phi_expire, heartbeat=FLAGS.heartbeat,
+    jitter=FLAGS.jitter, adaptive=FLAGS.adaptive,
+    max_rate=FLAGS.max_heartbeat_rate,
+    long_poll=FLAGS.long_poll, placement=FLAGS.placement, queue=FLAGS.queue,
+    arrival_rate=FLAGS.arrival_rate, job_size=FLAGS.job_size,
+    job_duration=FLAGS.job_duration, lifetime=FLAGS.lifetime,
+    rejoin=FLAGS.rejoin, batch_delay=FLAGS.batch_delay,
+    link_latency=FLAGS.link_latency, seed=FLAGS.seed).run()
+  print(json.dumps(report, indent=2))
+  if FLAGS.output:
+    with open(FLAGS.output, 'w') as file:
+      json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -4,99 +4,427 @@
 SPIT-Browser Scheduler: Task Management Library
 """
 
-from threading import Lock, Timer
-from typing import Callable, List, Set
+from capacity import CapacityIndex
+from itertools import islice
+from locks import TimedLock
+from metrics import Histogram
+from persist import Journal
+from reaper import Reaper
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 TIMEOUT: int = 60
 
-class Task(dict):
+# Weight of the newest sample in a worker's smoothed load score.
+LOAD_ALPHA: float = 0.3
+
+# Queued messages per core that count as one unit of load.
+QUEUE_CAPACITY: int = 100
+
+# Encodings of data exchanged between a job's tasks: JSON text, or the binary
+# batch format of worker/wire.js and client/wire.py.
+WIRES: Tuple[str, ...] = ('json', 'binary')
+
+# How a data-parallel vertex's input is split among its instances: records
+# dealt out in turn, or routed by a hash of their key, so that records with
+# the same key reach the same instance.
+PARTITIONS: Tuple[str, ...] = ('round_robin', 'hash')
+
+HEARTBEAT_LOCK_WAIT: Histogram = Histogram(
+  'scheduler_heartbeat_lock_wait_seconds',
+  'Time spent waiting to acquire a worker\'s heartbeat lock.')
+HEARTBEAT_LOCK_HOLD: Histogram = Histogram(
+  'scheduler_heartbeat_lock_hold_seconds',
+  'Time a worker\'s heartbeat lock was held.')
+
+class Task:
   """
   Representation of a Task.
 
-  Keys:
+  Attributes:
     task_id (str): Task's ID: {client_id}~{vertex_id}~{worker_id}.
     client_id (str): Initiating client's ID.
-    vertex_id (int): Task's index within the job.
+    vertex_id (int): Task's index within the job. Each instance of a
+      data-parallel vertex is a task of its own, with its own index.
     worker_id (str): Assigned worker's ID.
-    program (str): JavaScript program for this task.
+    program_id (str): ID of this task's program in the program store.
     contacts (List[str]): ID's for this task's contacts.
     update (bool): Whether this task needs to be updated on the worker.
     cancel (bool): Whether this task needs to be cancelled on the worker.
+    task_id_old (Optional[str]): Task's ID before it was last reallocated.
+    wire (str): Encoding of data sent between the job's tasks; see WIRES.
+    partition (Optional[List[List[Any]]]): How the task's output is split
+      among its contacts, if any of them are instances of a data-parallel
+      vertex: runs of consecutive contacts that are instances of the same
+      vertex, each given as [mode, length] with mode one of PARTITIONS. Each
+      record goes to one contact of every run. None to send every record to
+      every contact.
   """
+  __slots__ = ('task_id', 'client_id', 'vertex_id', 'worker_id', 'program_id',
+               'contacts', 'update', 'cancel', 'task_id_old', 'wire',
+               'partition')
+
   def __init__(self, client_id: str, vertex_id: int, worker_id: str,
-               program: str, contacts: List[str]):
-    dict.__init__(self)
-    self['task_id'] = f'{client_id}~{vertex_id}~{worker_id}'
-    self['client_id'] = client_id
-    self['vertex_id'] = vertex_id
-    self['worker_id'] = worker_id
-    self['program'] = program
-    self['contacts'] = contacts
-    self['update'] = False
-    self['cancel'] = False
-
-
-class Worker(dict):
+               program_id: str, contacts: List[str], wire: str = 'json',
+               partition: Optional[List[List[Any]]] = None):
+    self.task_id: str = f'{client_id}~{vertex_id}~{worker_id}'
+    self.client_id: str = client_id
+    self.vertex_id: int = vertex_id
+    self.worker_id: str = worker_id
+    self.program_id: str = program_id
+    self.contacts: List[str] = contacts
+    self.update: bool = False
+    self.cancel: bool = False
+    self.task_id_old: Optional[str] = None
+    self.wire: str = wire
+    self.partition: Optional[List[List[Any]]] = partition
+
+  def to_json(self) -> Dict[str, Any]:
+    """
+    Returns:
+      (Dict[str, Any]): JSON representation of the task, as sent to workers.
+    """
+    task: Dict[str, Any] = {
+      'task_id': self.task_id,
+      'client_id': self.client_id,
+      'vertex_id': self.vertex_id,
+      'worker_id': self.worker_id,
+      'program_id': self.program_id,
+      'contacts': list(self.contacts),
+      'update': self.update,
+      'cancel': self.cancel,
+    }
+    if self.task_id_old is not None:
+      task['task_id_old'] = self.task_id_old
+    if self.wire != 'json':
+      task['wire'] = self.wire
+    if self.partition is not None:
+      task['partition'] = self.partition
+    return task
+
+  def to_record(self) -> List[Any]:
+    """
+    Returns:
+      (List[Any]): Compact representation of the task, for the journal.
+    """
+    return [self.task_id, self.program_id, self.contacts, self.update,
+            self.cancel, self.task_id_old, self.wire, self.partition]
+
+  @staticmethod
+  def from_record(record: List[Any]) -> 'Task':
+    """
+    Args:
+      record (List[Any]): Output of to_record().
+
+    Returns:
+      (Task): Task with the same state.
+    """
+    task_id, program_id, contacts, update, cancel, task_id_old, wire = \
+      record[:7]
+    client_id, vertex_id, worker_id = task_id.split('~')
+    task: Task = Task(client_id, int(vertex_id), worker_id, program_id,
+                      contacts, wire, record[7] if len(record) > 7 else None)
+    task.update = update
+    task.cancel = cancel
+    task.task_id_old = task_id_old
+    return task
+
+
+class Worker:
   """
   Tracks the status of a Worker.
 
-  Keys:
+  Task queues map task ID's to tasks. Their insertion order is the queue
+  order, so a task can be looked up, removed, or requeued in O(1).
+
+  Attributes:
     worker_id (str): ID of worker.
     n_cores (int): Number of cores on the worker.
-    active_tasks (List[Task]): Currently running tasks.
-    pending_tasks (List[Task]): Tasks to be sent to the worker.
+    active_tasks (Dict[str, Task]): Currently running tasks.
+    pending_tasks (Dict[str, Task]): Tasks to be sent to the worker.
+    seq (int): Sequence number of the last delta heartbeat response.
+    unacked (List[Dict[str, Any]]): Tasks sent in that response, resent until
+      the worker acknowledges it.
+    patches (Dict[str, List[str]]): New contacts of active tasks, to be sent
+      on the next heartbeat instead of the whole task.
+    unacked_patches (Dict[str, List[str]]): Patches sent in the last delta
+      heartbeat response, resent until the worker acknowledges it.
+    load (float): Smoothed load score from worker-reported task metrics. 0
+      when idle, about 1 when every core is busy or backed up.
+    metrics (Dict[str, Dict[str, float]]): Task metrics from the worker's
+      latest report; see report().
+    journal (Optional[Journal]): Where changes to the worker's queues are
+      logged, if anywhere.
+    held (int): Cores promised to a cross-shard allocation that has not been
+      committed yet; see shard.py.
   """
-  def __init__(self, worker_id: int, n_cores: int,
-               deregister: Callable[[int], None]):
-    dict.__init__(self)
-    self['worker_id'] = worker_id
-    self['n_cores'] = n_cores
-    self['active_tasks'] = []
-    self['pending_tasks'] = []
-    self.deregister: Callable[[int], None] = deregister
-    self.timer: Timer = Timer(TIMEOUT, deregister, [worker_id])
+  __slots__ = ('worker_id', 'n_cores', 'active_tasks', 'pending_tasks',
+               'capacity', 'reaper', 'heartbeat_lock', 'seq', 'unacked',
+               'patches', 'unacked_patches', 'load', 'metrics', 'journal',
+               'held')
+
+  def __init__(self, worker_id: str, n_cores: int, capacity: CapacityIndex,
+               reaper: Reaper, journal: Optional[Journal] = None):
+    self.worker_id: str = worker_id
+    self.n_cores: int = n_cores
+    self.active_tasks: Dict[str, Task] = {}
+    self.pending_tasks: Dict[str, Task] = {}
+    self.capacity: CapacityIndex = capacity
+    self.reaper: Reaper = reaper
     if 'immortal' not in worker_id:
-      self.timer.start()
-    self.heartbeat_lock: Lock = Lock()
+      self.reaper.touch(worker_id)
+    self.heartbeat_lock: TimedLock = \
+      TimedLock(HEARTBEAT_LOCK_WAIT, HEARTBEAT_LOCK_HOLD)
+    self.seq: int = 0
+    self.unacked: List[Dict[str, Any]] = []
+    self.patches: Dict[str, List[str]] = {}
+    self.unacked_patches: Dict[str, List[str]] = {}
+    self.load: float = 0.0
+    self.metrics: Dict[str, Dict[str, float]] = {}
+    self.journal: Optional[Journal] = journal
+    self.held: int = 0
+
+  def to_json(self) -> Dict[str, Any]:
+    """
+    Returns:
+      (Dict[str, Any]): JSON representation of the worker.
+    """
+    return {
+      'worker_id': self.worker_id,
+      'n_cores': self.n_cores,
+      'active_tasks': list(self.active_tasks),
+      'pending_tasks': list(self.pending_tasks),
+      'load': self.load,
+    }
+
+  def to_record(self) -> Dict[str, Any]:
+    """
+    Must be called with heartbeat_lock held.
+
+    Returns:
+      (Dict[str, Any]): Journal record of the worker's state.
+    """
+    return {
+      'op': 'worker',
+      'worker_id': self.worker_id,
+      'n_cores': self.n_cores,
+      'seq': self.seq,
+      'unacked': self.unacked,
+      'patches': {**self.unacked_patches, **self.patches},
+      'active_tasks': [task.to_record()
+                       for task in self.active_tasks.values()],
+      'pending_tasks': [task.to_record()
+                        for task in self.pending_tasks.values()],
+    }
+
+  def log(self):
+    """
+    Logs the worker's state to the journal, if any. Must be called with
+    heartbeat_lock held.
+    """
+    if self.journal is not None:
+      self.journal.append(self.to_record())
 
   def availability(self) -> int:
     """
     Returns:
       (int): Number of free cores on the worker.
     """
-    return self['n_cores'] - len(self['active_tasks']) \
-                           - len(self['pending_tasks'])
+    return self.n_cores - len(self.active_tasks) - len(self.pending_tasks) - \
+           self.held
+
+  def reindex(self):
+    """
+    Records the worker's availability and load in the capacity index. Must be
+    called with heartbeat_lock held.
+    """
+    self.capacity.update(self.worker_id, self.availability(), self.load)
+
+  def report(self, metrics: Dict[str, Dict[str, float]]):
+    """
+    Folds worker-reported task metrics into the smoothed load score. Each
+    task's load is the fraction of a core its processing keeps busy, plus its
+    input backlog relative to QUEUE_CAPACITY. Must be called with
+    heartbeat_lock held.
+
+    Args:
+      metrics (Dict[str, Dict[str, float]]): Maps task ID's to metrics:
+        queue (float): Messages waiting for the task.
+        rate (float): Messages processed per second.
+        time (float): Milliseconds of processing per message.
+    """
+    busy: float = sum(task_load(task_metrics)
+                      for task_metrics in metrics.values())
+    sample: float = busy / max(self.n_cores, 1)
+    self.load = LOAD_ALPHA * sample + (1 - LOAD_ALPHA) * self.load
+    self.metrics = metrics
+
+  def tasks(self) -> List[Task]:
+    """
+    Returns:
+      (List[Task]): All tasks on the worker, active ones first.
+    """
+    return list(self.active_tasks.values()) + \
+           list(self.pending_tasks.values())
+
+  def enqueue(self, task: Task):
+    """
+    Queues a task to be sent on the next heartbeat. A task that is already
+    active is moved back to the pending queue.
+
+    Args:
+      task (Task): Task assigned to this worker.
+    """
+    self.active_tasks.pop(task.task_id, None)
+    self.pending_tasks[task.task_id] = task
+
+  def patch(self, task: Task):
+    """
+    Queues a task's current contacts to be sent on the next heartbeat. Unlike
+    enqueue(), the task keeps its core and is not resent.
+
+    Args:
+      task (Task): Active task on this worker.
+    """
+    self.patches[task.task_id] = list(task.contacts)
 
-  def heartbeat(self, active_tasks: List[str]) -> List[Task]:
+  def discard(self, task: Task) -> Optional[str]:
     """
+    Removes a task from whichever queue holds it.
+
+    Args:
+      task (Task): Task assigned to this worker.
+
+    Returns:
+      (Optional[str]): Name of the queue the task was in, if any.
+    """
+    self.patches.pop(task.task_id, None)
+    self.unacked_patches.pop(task.task_id, None)
+    if self.pending_tasks.pop(task.task_id, None) is not None:
+      return 'pending_tasks'
+    if self.active_tasks.pop(task.task_id, None) is not None:
+      return 'active_tasks'
+    return None
+
+  def heartbeat(self, active_tasks: List[str],
+                metrics: Optional[Dict[str, Dict[str, float]]] = None) \
+      -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Processes a full heartbeat, which lists every still-running task.
+
     Args:
       active_tasks (List[str]): List of ID's of still-running tasks.
+      metrics (Optional[Dict[str, Dict[str, float]]]): Task metrics; see
+        report().
 
     Returns:
-      (List[Task]): List of new tasks for the worker to run.
+      (List[Dict[str, Any]]): List of new tasks for the worker to run.
+      (List[Dict[str, Any]]): List of contact patches for running tasks.
+    """
+    with self.heartbeat_lock:
+      # Remove completed tasks.
+      active_set: Set[str] = set(active_tasks)
+      done: List[str] = [task_id for task_id in self.active_tasks
+                         if task_id not in active_set]
+      for task_id in done:
+        del self.active_tasks[task_id]
+        self.patches.pop(task_id, None)
+      if metrics is not None:
+        self.report(metrics)
+      send: List[Dict[str, Any]] = self.dispatch()
+      patches: List[Dict[str, Any]] = to_patches(self.patches)
+      self.patches = {}
+      if done or send or patches:
+        self.log()
+      return send, patches
+
+  def heartbeat_delta(self, finished: List[str], ack: int,
+                      metrics: Optional[Dict[str, Dict[str, float]]] = None) \
+      -> Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]:
     """
-    self.heartbeat_lock.acquire()
+    Processes a delta heartbeat, which lists only the tasks that finished or
+    failed since the last acknowledged response. Responses are numbered; if
+    the worker did not acknowledge the previous one, its tasks are resent.
 
-    # Remove completed tasks.
-    active_set: Set[str] = set(active_tasks)
-    self['active_tasks'] = list(filter(
-      lambda task: task['task_id'] in active_set,
-      self['active_tasks']
-    ))
+    Args:
+      finished (List[str]): ID's of tasks that stopped running.
+      ack (int): Sequence number of the last response the worker applied.
+      metrics (Optional[Dict[str, Dict[str, float]]]): Task metrics; see
+        report().
 
-    # Create list of new tasks.
-    n_send: int = self['n_cores'] - len(self['active_tasks'])
-    send: List[Task] = self['pending_tasks'][:n_send]
-    send_copy: List[Task] = [task.copy() for task in send]
+    Returns:
+      (int): Sequence number of this response.
+      (List[Dict[str, Any]]): List of new or changed tasks for the worker to
+        run.
+      (List[Dict[str, Any]]): List of contact patches for running tasks,
+        applied after the tasks.
+    """
+    with self.heartbeat_lock:
+      changed: bool = False
+      if ack >= self.seq and (self.unacked or self.unacked_patches):
+        self.unacked = []
+        self.unacked_patches = {}
+        changed = True
+      for task_id in finished:
+        changed |= self.active_tasks.pop(task_id, None) is not None
+        self.patches.pop(task_id, None)
+        self.unacked_patches.pop(task_id, None)
+      if metrics is not None:
+        self.report(metrics)
+      send: List[Dict[str, Any]] = self.dispatch()
+      self.unacked += send
+      if self.patches:
+        self.unacked_patches.update(self.patches)
+        self.patches = {}
+        changed = True
+      self.seq += 1
+      if changed or send:
+        self.log()  # idle heartbeats only bump seq; see restore()
+      return self.seq, list(self.unacked), to_patches(self.unacked_patches)
+
+  def dispatch(self) -> List[Dict[str, Any]]:
+    """
+    Moves as many pending tasks to the active queue as there are free cores.
+    Must be called with heartbeat_lock held.
+
+    Returns:
+      (List[Dict[str, Any]]): Tasks to send to the worker, serialized before
+        their update flags are cleared.
+    """
+    n_send: int = self.n_cores - len(self.active_tasks)
+    send: List[Task] = list(islice(self.pending_tasks.values(),
+                                   max(n_send, 0)))
+    send_json: List[Dict[str, Any]] = [task.to_json() for task in send]
     for task in send:
-      task['update'] = False
-
-    # Update fields.
-    self['active_tasks'] += send
-    self['pending_tasks'] = self['pending_tasks'][n_send:]
-    self.timer.cancel()
-    self.timer = Timer(TIMEOUT, self.deregister, [self['worker_id']])
-    if 'immortal' not in self['worker_id']:
-      self.timer.start()
-    self.heartbeat_lock.release()
-    return send_copy
+      task.update = False
+      del self.pending_tasks[task.task_id]
+      self.active_tasks[task.task_id] = task
+    self.reindex()
+    if 'immortal' not in self.worker_id:
+      self.reaper.touch(self.worker_id)
+    return send_json
+
+
+def task_load(metrics: Dict[str, float]) -> float:
+  """
+  Args:
+    metrics (Dict[str, float]): One task's metrics; see Worker.report().
+
+  Returns:
+    (float): Fraction of a core the task keeps busy, plus its input backlog
+      relative to QUEUE_CAPACITY.
+  """
+  return float(metrics.get('rate', 0)) * \
+         float(metrics.get('time', 0)) / 1000 + \
+         float(metrics.get('queue', 0)) / QUEUE_CAPACITY
+
+
+def to_patches(patches: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+  """
+  Args:
+    patches (Dict[str, List[str]]): Maps task ID's to new contacts.
+
+  Returns:
+    (List[Dict[str, Any]]): The patches, as sent to workers.
+  """
+  return [{'task_id': task_id, 'contacts': list(contacts)}
+          for task_id, contacts in patches.items()]
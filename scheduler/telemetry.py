@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+SPIT-Browser Scheduler: Stream Telemetry
+
+Per-vertex time series of the counters workers report with their heartbeats,
+so that the bottleneck of a running pipeline can be found. Each vertex keeps a
+fixed ring of buckets, so a job's telemetry takes fixed memory however long it
+runs.
+"""
+
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+import time
+
+# Seconds covered by each bucket of a series. Buckets start on multiples of
+# BUCKET in wall-clock time, so that shards' series line up.
+BUCKET: float = 10.0
+
+# Buckets kept per vertex; the oldest is overwritten by the next.
+BUCKETS: int = 60
+
+# Complete buckets summarized by the rates in stats().
+WINDOW: int = 6
+
+# Counters summed over each bucket, in the order they are stored: records
+# delivered to the task, records it emitted, bytes it emitted, milliseconds it
+# spent on timed records, and how many records were timed.
+FIELDS: List[str] = ['in', 'out', 'bytes', 'busy', 'timed']
+
+class Series:
+  """
+  Ring buffer of one vertex's counters, summed over each bucket, along with
+  the deepest input queue any of its reports showed.
+  """
+  __slots__ = ('buckets', 'sums', 'queues')
+
+  def __init__(self):
+    self.buckets: List[Optional[int]] = [None] * BUCKETS
+    self.sums: List[List[float]] = [[0.0] * len(FIELDS)
+                                    for _ in range(BUCKETS)]
+    self.queues: List[float] = [0.0] * BUCKETS
+
+  def add(self, bucket: int, values: List[float], queue: float):
+    """
+    Args:
+      bucket (int): Number of the bucket, counting from the epoch.
+      values (List[float]): Counters, in the order of FIELDS.
+      queue (float): Messages waiting for the task.
+    """
+    slot: int = bucket % BUCKETS
+    sums: List[float] = self.sums[slot]
+    if self.buckets[slot] != bucket:
+      self.buckets[slot] = bucket
+      sums[:] = values
+      self.queues[slot] = queue
+      return
+    for i, value in enumerate(values):
+      sums[i] += value
+    self.queues[slot] = max(self.queues[slot], queue)
+
+  def to_json(self, now: int) -> Dict[str, Any]:
+    """
+    Args:
+      now (int): Number of the current bucket, which is still filling up.
+
+    Returns:
+      (Dict[str, Any]): Rates over the last WINDOW complete buckets that have
+        reports, and every bucket still held, oldest first; see
+        /jobs/<client_id>/stats.
+    """
+    slots: List[int] = sorted(
+      (slot for slot in range(BUCKETS) if self.buckets[slot] is not None and
+       now - BUCKETS < self.buckets[slot] <= now),
+      key=lambda slot: self.buckets[slot])
+    window: List[int] = [slot for slot in slots
+                         if now - WINDOW <= self.buckets[slot] < now]
+    totals: List[float] = [sum(self.sums[slot][i] for slot in window)
+                           for i in range(len(FIELDS))]
+    seconds: float = max(len(window), 1) * BUCKET
+    res: Dict[str, Any] = {
+      'in_rate': totals[0] / seconds,
+      'out_rate': totals[1] / seconds,
+      'byte_rate': totals[2] / seconds,
+      'queue': max((self.queues[slot] for slot in window), default=0.0),
+      'utilization': totals[3] / 1000 / seconds,
+    }
+    if totals[4]:
+      res['time'] = totals[3] / totals[4]
+    res['series'] = [bucket_json(self.buckets[slot] * BUCKET,
+                                 self.sums[slot], self.queues[slot])
+                     for slot in slots]
+    return res
+
+
+class Telemetry:
+  """
+  Series of every vertex of every job, fed by worker heartbeats.
+  """
+  def __init__(self, clock: Callable[[], float] = time.time):
+    """
+    Args:
+      clock (Callable[[], float]): Current wall-clock time in seconds.
+    """
+    self.clock: Callable[[], float] = clock
+    self.jobs: Dict[str, Dict[int, Series]] = {}
+    self.lock: Lock = Lock()
+
+  def record(self, client_id: str, vertex_id: int,
+             metrics: Dict[str, Any]):
+    """
+    Adds one task's report to its vertex's series. Reports with counters that
+    are not numbers are dropped.
+
+    Args:
+      client_id (str): ID of the task's client.
+      vertex_id (int): Task's index within the job.
+      metrics (Dict[str, Any]): Task metrics since the worker's last report:
+        in (float): Records delivered to the task.
+        out (float): Records the task emitted.
+        bytes (float): Bytes the task emitted.
+        time (float): Milliseconds of processing per record. Optional.
+        queue (float): Messages waiting for the task.
+    """
+    try:
+      delivered: float = float(metrics.get('in', 0))
+      timed: float = delivered if 'time' in metrics else 0.0
+      values: List[float] = [delivered, float(metrics.get('out', 0)),
+                             float(metrics.get('bytes', 0)),
+                             float(metrics.get('time', 0)) * timed, timed]
+      queue: float = float(metrics.get('queue', 0))
+    except (AttributeError, TypeError, ValueError):
+      return
+    bucket: int = int(self.clock() // BUCKET)
+    with self.lock:
+      self.jobs.setdefault(client_id, {}) \
+               .setdefault(vertex_id, Series()).add(bucket, values, queue)
+
+  def forget(self, client_id: str):
+    """
+    Drops a job's series, once the job is replaced or cancelled.
+
+    Args:
+      client_id (str): ID of client.
+    """
+    with self.lock:
+      self.jobs.pop(client_id, None)
+
+  def stats(self, client_id: str, vertex_ids: List[int]) -> Dict[str, Any]:
+    """
+    Args:
+      client_id (str): ID of client.
+      vertex_ids (List[int]): Indices of the job's tasks.
+
+    Returns:
+      (Dict[str, Any]): The job's telemetry; see /jobs/<client_id>/stats.
+    """
+    now: int = int(self.clock() // BUCKET)
+    with self.lock:
+      series: Dict[int, Series] = self.jobs.get(client_id, {})
+      vertices: List[Dict[str, Any]] = [
+        {'vertex_id': vertex_id,
+         **series.get(vertex_id, Series()).to_json(now)}
+        for vertex_id in vertex_ids]
+    return summarize(vertices)
+
+
+def bucket_json(start: float, sums: List[float],
+                queue: float) -> Dict[str, Any]:
+  """
+  Returns:
+    (Dict[str, Any]): One bucket of a series: its start time and counters,
+      with time (ms per record) in place of busy and timed.
+  """
+  res: Dict[str, Any] = {'start': start}
+  res.update(zip(FIELDS[:3], sums[:3]))
+  res['queue'] = queue
+  if sums[4]:
+    res['time'] = sums[3] / sums[4]
+  return res
+
+
+def summarize(vertices: List[Dict[str, Any]]) -> Dict[str, Any]:
+  """
+  Args:
+    vertices (List[Dict[str, Any]]): Telemetry of each of a job's vertices, as
+      returned by Series.to_json() plus their vertex_id.
+
+  Returns:
+    (Dict[str, Any]): Job telemetry, naming the bottleneck: the vertex whose
+      processing keeps its core busiest, or if none was timed, the one with
+      the deepest input queue. Omitted while the job is idle.
+  """
+  res: Dict[str, Any] = {
+    'bucket': BUCKET,
+    'window': WINDOW * BUCKET,
+    'vertices': sorted(vertices, key=lambda vertex: vertex['vertex_id']),
+  }
+  busiest: Optional[Dict[str, Any]] = max(
+    vertices, key=lambda vertex: (vertex['utilization'], vertex['queue']),
+    default=None)
+  if busiest is not None and (busiest['utilization'] or busiest['queue']):
+    res['bottleneck'] = busiest['vertex_id']
+  return res
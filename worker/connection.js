@@ -53,7 +53,9 @@ class Connection {
         this.peers[peerId] = newPeer;
     })
     newPeer.on('data', data => {
-      this.onmessagecb(JSON.parse(data));
+      // Binary frames arrive as bytes, JSON as text.
+      this.onmessagecb(data instanceof Uint8Array ?
+                       Wire.decode(data) : JSON.parse(data));
     });
     newPeer.on('close', () => {
       delete this.peers[peerId];
@@ -61,9 +63,12 @@ class Connection {
     this.pending[peerId] = newPeer;
   }
 
-  send(peerId, data) {
+  // Sends data to a peer, as a binary frame (see wire.js) if binary is set and
+  // the peer is connected directly. Data relayed through the server is JSON.
+  send(peerId, data, binary = false) {
     if (peerId in this.peers) {
-      this.peers[peerId].send(JSON.stringify(data));
+      this.peers[peerId].send(binary ? Wire.encode(data) :
+                                       JSON.stringify(data));
     } else {
       this.connect(peerId);
       this.server.send(JSON.stringify({
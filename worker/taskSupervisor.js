@@ -7,6 +7,7 @@ const TASK_SCRIPT = "program/";
 const BATCH_DELAY_MS = 1000;
 const RESEND_DELAY_MS = 500;
 const HEARTBEAT_INTERVAL_MS = 5000;
+const HEARTBEAT_WAIT_S = 25; // Long-poll time; ignored by the Flask scheduler
 const NUM_CORES = 1;//window.navigator.hardwareConcurrency;
 
 // Message Queues
@@ -17,10 +18,22 @@ var outPending = {};
 // Communication Info
 var contacts = {};  // Running Task -> Downstream Task
 var addresses = {}; // Downstream Task -> Hosting Supervisor
+var wires = {};     // Client -> Encoding of its job's data ('json'/'binary')
+var partitions = {}; // Running Task -> Split of its output among contacts
 var connection;
 
 var tasks = {};
 var my_id;
+var heartbeatAddr = SCHEDULER_ADDR; // Our shard, if the scheduler is sharded
+
+// Heartbeat State
+var heartbeatSeq = 0;   // Last heartbeat response applied
+var finishedTasks = {}; // Tasks that stopped, reported until acknowledged
+var counters = {};      // Running Task -> Traffic since last report
+var timing = {};        // Running Task -> [Time, records] of a batch awaiting
+                        // the task's next output
+var lastReport = new Date().getTime();
+var heartbeatInterval = HEARTBEAT_INTERVAL_MS; // As last set by the scheduler
 
 
 function register() {
@@ -30,6 +43,7 @@ function register() {
   ).then(function(data){
     data.json().then(json => {
       my_id = json["worker_id"];
+      heartbeatAddr = json["scheduler"] || SCHEDULER_ADDR;
       console.log("Successfully registered. Worker ID: " + my_id);
       setupWorker();
     });
@@ -40,7 +54,7 @@ function register() {
   });
 }
 
-function postToServer(jsonData, api) {
+function postToServer(jsonData, api, addr = SCHEDULER_ADDR) {
   const requestParams = {
     'headers': {
       'content-type': 'application/json'
@@ -48,7 +62,7 @@ function postToServer(jsonData, api) {
     'method': 'POST',
     'body': JSON.stringify(jsonData)
   }
-  return fetch(SCHEDULER_ADDR + api, requestParams)
+  return fetch(addr + api, requestParams)
 }
 
 function setupWorker() {
@@ -67,29 +81,134 @@ function setupWorker() {
   // Schedule recurring tasks
   setInterval(deliverMessages, BATCH_DELAY_MS)
   setInterval(sendMessages, BATCH_DELAY_MS)
-  setInterval(sendHeartbeat, HEARTBEAT_INTERVAL_MS)
+  sendHeartbeat()
 }
 
+// Sends a heartbeat and schedules the next one. A scheduler that supports long
+// polling holds the heartbeat open until it has tasks for us, so we heartbeat
+// again right away; otherwise we wait out the rest of the interval. The
+// scheduler sets the interval, stretching it as the fleet grows.
 function sendHeartbeat() {
+  const finished = Object.keys(finishedTasks);
+  const start = new Date().getTime();
+  var nextDelay = heartbeatInterval;
   postToServer({
-      'active_tasks': Object.keys(tasks),
+      'ack': heartbeatSeq,
+      'finished': finished,
+      'metrics': collectMetrics(),
+      'wait': HEARTBEAT_WAIT_S,
       'worker_id': my_id
     },
-    "/heartbeat"
+    "/heartbeat",
+    heartbeatAddr
   ).then(function(data){
-    data.json().then(json => {
+    return data.json().then(json => {
+      for (const taskId of finished) {
+        delete finishedTasks[taskId];
+      }
+      heartbeatSeq = json["seq"]
       newTasks = json["new_tasks"]
       for (const task of newTasks) {
-        registerTask(task['task_id'], task['contacts'])
+        if (task['cancel']) {
+          finishTask(task['task_id'])
+        } else {
+          registerTask(task['task_id'], task['program_id'], task['contacts'],
+                       task['wire'], task['partition'])
+        }
+      }
+      // Running tasks whose contacts moved get just their new contacts.
+      const patches = json["patches"] || []
+      for (const patch of patches) {
+        if (patch['task_id'] in tasks) {
+          setContacts(patch['task_id'], patch['contacts'])
+        }
       }
+      if (typeof json["interval"] === 'number') {
+        heartbeatInterval = json["interval"] * 1000;
+      }
+      const elapsed = new Date().getTime() - start;
+      nextDelay = newTasks.length > 0 || patches.length > 0 ? 0 :
+        Math.max(0, heartbeatInterval - elapsed);
     })
   })
   .catch(function(error){
     console.error("Failed to send heartbeat:")
     console.error(error)
+  })
+  .then(function(){
+    setTimeout(sendHeartbeat, nextDelay)
   });
 }
 
+// Reports each running task's input backlog, processing rate, and traffic
+// since the last report, so the scheduler can steer new work away from
+// backed-up workers and chart each job's throughput.
+function collectMetrics() {
+  const now = new Date().getTime();
+  const elapsedS = Math.max(now - lastReport, 1) / 1000;
+  var metrics = {};
+  for (const taskId in tasks) {
+    const counts = countersOf(taskId);
+    metrics[taskId] = {
+      'queue': inQueue[taskId].length,
+      'rate': counts['in'] / elapsedS,
+      'in': counts['in'],
+      'out': counts['out'],
+      'bytes': counts['bytes']
+    };
+    if (counts['timed'] > 0) {
+      metrics[taskId]['time'] = counts['busy'] / counts['timed'];
+    }
+    delete counters[taskId];
+  }
+  lastReport = now;
+  return metrics;
+}
+
+function countersOf(taskId) {
+  if (!(taskId in counters)) {
+    counters[taskId] = {'in': 0, 'out': 0, 'bytes': 0, 'busy': 0, 'timed': 0};
+  }
+  return counters[taskId];
+}
+
+// Counts a task's output. Tasks don't say when they finish a batch, so the
+// time from delivering a batch to the task's next output stands in for the
+// time it took to process.
+function countOutput(taskId, data) {
+  const counts = countersOf(taskId);
+  counts['out'] += recordCount(data);
+  counts['bytes'] += byteSize(data);
+  if (taskId in timing) {
+    const [delivered, records] = timing[taskId];
+    counts['busy'] += new Date().getTime() - delivered;
+    counts['timed'] += records;
+    delete timing[taskId];
+  }
+}
+
+// Approximate encoded size of a task's output: exact for binary data, and the
+// length of its JSON otherwise.
+function byteSize(data) {
+  if (data instanceof ArrayBuffer || ArrayBuffer.isView(data)) {
+    return data.byteLength;
+  }
+  return typeof data === 'string' ? data.length :
+                                    (JSON.stringify(data) || '').length;
+}
+
+function finishTask(taskId) {
+  if (taskId in tasks) {
+    tasks[taskId].terminate()
+    delete tasks[taskId]
+    delete inQueue[taskId]
+    delete counters[taskId]
+    delete timing[taskId]
+    delete partitions[taskId]
+  }
+  finishedTasks[taskId] = true
+}
+
 function recieveMessages(all_messages) {
   for (const task_id in all_messages) {
     messages = all_messages[task_id]
@@ -103,16 +222,32 @@ function recieveMessages(all_messages) {
   }
 }
 
-function registerTask(taskId, contacts) {
-  var task;
-  // Create webworker to run task
+function registerTask(taskId, programId, contacts, wire = 'json',
+                      partition = null) {
+  wires[taskId.split("~")[0]] = wire;
+  // Contacts that are instances of a data-parallel vertex come in runs, each
+  // [mode, length]; every record goes to one contact of each run. Without a
+  // partition, every record goes to every contact.
+  partitions[taskId] = partition ||
+    contacts.map(() => ['round_robin', 1]);
+  // Create webworker to run task. Programs are fetched by content hash so the
+  // browser can cache them across tasks and jobs.
   if (!(taskId in tasks)) {
-    task = new Worker(TASK_SCRIPT + taskId)
+    const task = new Worker(TASK_SCRIPT + programId)
+    task.onerror = function(e) {
+      console.error("Task " + taskId + " failed:")
+      console.error(e)
+      finishTask(taskId)
+    }
     tasks[taskId] = task
     inQueue[taskId] = []
-  } else {
-    task = tasks[taskId]
   }
+  setContacts(taskId, contacts)
+}
+
+// Points a running task's output at its (possibly moved) contacts.
+function setContacts(taskId, contacts) {
+  const task = tasks[taskId]
 
   // Add/update outgoing addresses
   for (const outTask of contacts) {
@@ -121,18 +256,25 @@ function registerTask(taskId, contacts) {
   }
 
   // Add outgoing messages to queue
+  const runs = partitions[taskId];
+  var turns = runs.map(() => 0); // Next instance of each round-robin run
   task.onmessage = function(e) {
-    for (const outTask of contacts) {
-      outTaskWorkerId = outTask.split("~")[2]
-      if (my_id === outTaskWorkerId) {
-        inQueue[outTask].push(e.data)
+    countOutput(taskId, e.data);
+    var first = 0;
+    runs.forEach(function([mode, length], run) {
+      if (length === 1) {
+        sendOut(contacts[first], e.data);
       } else {
-        if (!outQueue[outTaskWorkerId].hasOwnProperty(outTask)) {
-          outQueue[outTaskWorkerId][outTask] = []
-        }
-        outQueue[outTaskWorkerId][outTask].push(e.data)
+        const parts = splitRecords(e.data, mode, length, turns[run]);
+        turns[run] = (turns[run] + recordCount(e.data)) % length;
+        parts.forEach(function(part, i) {
+          if (part !== null) {
+            sendOut(contacts[first + i], part);
+          }
+        });
       }
-    }
+      first += length;
+    });
   }
 
   // Setup queues for incoming and outgoing messages
@@ -147,11 +289,79 @@ function registerTask(taskId, contacts) {
   }
 }
 
+// Queues a task's output for one of its contacts.
+function sendOut(outTask, data) {
+  outTaskWorkerId = outTask.split("~")[2]
+  if (my_id === outTaskWorkerId) {
+    inQueue[outTask].push(data)
+  } else {
+    if (!outQueue[outTaskWorkerId].hasOwnProperty(outTask)) {
+      outQueue[outTaskWorkerId][outTask] = []
+    }
+    outQueue[outTaskWorkerId][outTask].push(data)
+  }
+}
+
+// Tasks post either one record or a batch of them (an array or typed array).
+function recordCount(data) {
+  return Array.isArray(data) || ArrayBuffer.isView(data) ? data.length : 1;
+}
+
+// Splits a task's output among the instances of a data-parallel vertex.
+// Batches are split record by record and each part is sent as a batch of the
+// same kind. Returns the part for each instance, or null if it gets none.
+function splitRecords(data, mode, length, turn) {
+  const batch = Array.isArray(data) || ArrayBuffer.isView(data);
+  const records = batch ? Array.from(data) : [data];
+  var parts = [];
+  for (var i = 0; i < length; i++) {
+    parts.push([]);
+  }
+  records.forEach(function(record, i) {
+    const instance = mode === 'hash' ? hashKey(record) % length :
+                                       (turn + i) % length;
+    parts[instance].push(record);
+  });
+  return parts.map(function(part) {
+    if (part.length === 0) {
+      return null;
+    }
+    if (!batch) {
+      return part[0];
+    }
+    return Array.isArray(data) ? part : data.constructor.from(part);
+  });
+}
+
+// Hashes a record's key: its 'key' field if it is an object that has one,
+// its first element if it is an array, and otherwise the record itself.
+// Records with equal keys always hash alike (32-bit FNV-1a of the JSON).
+function hashKey(record) {
+  var key = record;
+  if (Array.isArray(record)) {
+    key = record[0];
+  } else if (record !== null && typeof record === 'object' &&
+             'key' in record) {
+    key = record['key'];
+  }
+  const text = JSON.stringify(key) || '';
+  var hash = 0x811c9dc5;
+  for (var i = 0; i < text.length; i++) {
+    hash ^= text.charCodeAt(i);
+    hash = Math.imul(hash, 0x01000193);
+  }
+  return hash >>> 0;
+}
+
 function deliverMessages() {
   for (var id in inQueue) {
     try {
       if (inQueue[id].length > 0) {
         tasks[id].postMessage(inQueue[id])
+        countersOf(id)['in'] += inQueue[id].length
+        if (!(id in timing)) {
+          timing[id] = [new Date().getTime(), inQueue[id].length]
+        }
       }
     } catch(error) {
       continue;
@@ -160,12 +370,22 @@ function deliverMessages() {
   }
 }
 
+// Whether any of the messages, keyed by destination task, belong to a job that
+// exchanges binary data.
+function isBinary(messages) {
+  return Object.keys(messages).some(
+    taskId => wires[taskId.split("~")[0]] === 'binary');
+}
+
 function sendMessages() {
   for (const workerId in outQueue) {
     if (Object.getOwnPropertyNames(outQueue[workerId]).length > 0) {
       connection.connect(workerId)
       var timestamp = new Date().getTime();
-      connection.send(workerId, {'messages': outQueue[workerId], 'tag': timestamp, 'id': my_id});
+      connection.send(workerId,
+                      {'messages': outQueue[workerId], 'tag': timestamp,
+                       'id': my_id},
+                      isBinary(outQueue[workerId]));
       addToPending(outQueue[workerId], workerId, timestamp);
       outQueue[workerId] = {}
     }
@@ -200,7 +420,8 @@ function addToPending(messages, workerId, tag) {
       delete outPending[tag];
       return;
     }
-    connection.send(workerId, {'messages': messages, 'tag': tag, 'id': my_id});
+    connection.send(workerId, {'messages': messages, 'tag': tag, 'id': my_id},
+                    isBinary(messages));
   }, RESEND_DELAY_MS);
   outPending[tag] = interval;
 }
@@ -0,0 +1,148 @@
+// Binary batch format for stream data, shared with client/wire.py. Jobs
+// allocated with 'wire': 'binary' exchange data this way instead of as JSON.
+//
+// A batch holds a list of records. It starts with an 8-byte header: the kind
+// (uint8), 3 bytes of padding, and the number of records (uint32). The body
+// depends on the kind:
+//   FLOAT64: The records, as float64s. Used when every record is a number.
+//   TEXT: The UTF-8 length of each record (uint32s), then the UTF-8 bytes.
+//     Used when every record is a string.
+//   JSON: The UTF-8 length (uint32) of a JSON array of the records, then the
+//     array. Used for anything else.
+// Bodies are padded to a multiple of 8 bytes, so batches laid end to end keep
+// their float64s aligned and can be read without copying.
+//
+// A frame carries the batches of several tasks between supervisors. It starts
+// with the length (uint32) of a UTF-8 JSON header {"tag", "id", "tasks"}, then
+// the header, padded to a multiple of 8 bytes, then one batch per task listed
+// in "tasks".
+//
+// Numbers are little-endian.
+
+const Wire = (function() {
+  const TEXT = 0;
+  const FLOAT64 = 1;
+  const JSON_ = 2;
+  const HEADER_BYTES = 8;
+  const encoder = new TextEncoder();
+  const decoder = new TextDecoder();
+
+  function padding(n) {
+    return new Uint8Array((8 - n % 8) % 8);
+  }
+
+  function concat(parts) {
+    var length = 0;
+    for (const part of parts) {
+      length += part.length;
+    }
+    const bytes = new Uint8Array(length);
+    var offset = 0;
+    for (const part of parts) {
+      bytes.set(part, offset);
+      offset += part.length;
+    }
+    return bytes;
+  }
+
+  function batchParts(records) {
+    var kind = JSON_;
+    var body;
+    if (records.every(record => typeof record === 'number')) {
+      kind = FLOAT64;
+      body = new Uint8Array(Float64Array.from(records).buffer);
+    } else if (records.every(record => typeof record === 'string')) {
+      kind = TEXT;
+      const strings = records.map(record => encoder.encode(record));
+      const lengths = Uint32Array.from(strings, string => string.length);
+      body = concat([new Uint8Array(lengths.buffer)].concat(strings));
+    } else {
+      const text = encoder.encode(JSON.stringify(records));
+      const length = Uint32Array.of(text.length);
+      body = concat([new Uint8Array(length.buffer), text]);
+    }
+    const header = new DataView(new ArrayBuffer(HEADER_BYTES));
+    header.setUint8(0, kind);
+    header.setUint32(4, records.length, true);
+    return [new Uint8Array(header.buffer), body, padding(body.length)];
+  }
+
+  // Returns a list of records as a batch (Uint8Array).
+  function encodeBatch(records) {
+    return concat(batchParts(records));
+  }
+
+  // Returns the records of the batch at offset in bytes (Uint8Array), and the
+  // offset just past it.
+  function decodeBatch(bytes, offset = 0) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset + offset);
+    const kind = view.getUint8(0);
+    const count = view.getUint32(4, true);
+    const start = offset + HEADER_BYTES;
+    var records;
+    var end;
+    if (kind === FLOAT64) {
+      end = start + 8 * count;
+      const at = bytes.byteOffset + start;
+      const numbers = at % 8 === 0 ?
+        new Float64Array(bytes.buffer, at, count) :
+        new Float64Array(bytes.slice(start, end).buffer);
+      records = Array.from(numbers);
+    } else if (kind === TEXT) {
+      records = new Array(count);
+      end = start + 4 * count;
+      for (var i = 0; i < count; i++) {
+        const length = view.getUint32(HEADER_BYTES + 4 * i, true);
+        records[i] = decoder.decode(bytes.subarray(end, end + length));
+        end += length;
+      }
+    } else if (kind === JSON_) {
+      end = start + 4 + view.getUint32(HEADER_BYTES, true);
+      records = JSON.parse(decoder.decode(bytes.subarray(start + 4, end)));
+    } else {
+      throw new Error('Unknown batch kind ' + kind);
+    }
+    return [records, end + (8 - end % 8) % 8];
+  }
+
+  // Returns a supervisor message {'messages': {taskId: [records]}, 'tag',
+  // 'id'} as a frame (Uint8Array).
+  function encode(message) {
+    const tasks = Object.keys(message['messages']);
+    const header = encoder.encode(JSON.stringify({
+      'tag': message['tag'],
+      'id': message['id'],
+      'tasks': tasks
+    }));
+    const length = new DataView(new ArrayBuffer(4));
+    length.setUint32(0, header.length, true);
+    var parts = [new Uint8Array(length.buffer), header,
+                 padding(4 + header.length)];
+    for (const taskId of tasks) {
+      parts = parts.concat(batchParts(message['messages'][taskId]));
+    }
+    return concat(parts);
+  }
+
+  // Returns the supervisor message in a frame (Uint8Array).
+  function decode(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset);
+    const length = view.getUint32(0, true);
+    const header = JSON.parse(decoder.decode(bytes.subarray(4, 4 + length)));
+    var offset = 4 + length + (8 - (4 + length) % 8) % 8;
+    const messages = {};
+    for (const taskId of header['tasks']) {
+      const batch = decodeBatch(bytes, offset);
+      messages[taskId] = batch[0];
+      offset = batch[1];
+    }
+    return {'messages': messages, 'tag': header['tag'], 'id': header['id']};
+  }
+
+  return {
+    'encodeBatch': encodeBatch,
+    'decodeBatch': decodeBatch,
+    'encode': encode,
+    'decode': decode
+  };
+})();